@@ -10,12 +10,26 @@ All common, shared functionalities are available through `SmartDevice` class::
 For device type specific actions `SmartBulb` or `SmartPlug` must be used instead.
 
 Module-specific errors are raised as `SmartDeviceException` and are expected
-to be handled by the user of the library.
+to be handled by the user of the library. Its subclasses tell failures to
+reach the device (`CommunicationError`, `DeviceTimeoutError`,
+`DeadlineExceeded`, `ConnectionRefused`, `CircuitOpen`) from errors reported
+by the device (`DeviceError`).
+
+Asynchronous counterparts of the device classes and of discovery are
+available in `tplink.asyncdevice` and `tplink.asyncdiscover`, these require
+trollius to be installed.
 """
 # flake8: noqa
 from __future__ import absolute_import
-from .smartdevice import SmartDevice, SmartDeviceException
+from .smartdevice import (SmartDevice, SmartDeviceException,
+                          CommunicationError, DeviceTimeoutError,
+                          DeadlineExceeded, ConnectionRefused, CircuitOpen,
+                          DeviceError)
 from .smartplug import SmartPlug
 from .smartbulb import SmartBulb
-from .protocol import TPLinkSmartHomeProtocol
+from .protocol import TPLinkSmartHomeProtocol, PooledTPLinkSmartHomeProtocol
+from .fleet import DeviceFleet
+from .gate import GatedProtocol
+from .health import DeviceHealth
+from .multiplex import MultiplexedTPLinkSmartHomeProtocol
 from .discover import Discover
@@ -0,0 +1,397 @@
+u"""
+Vectorized roll-ups of the energy statistics of many devices.
+
+    matrix = load_daily(fleet, datetime.date(2017, 1, 1),
+                        datetime.date(2017, 12, 31))
+    site_total = matrix.total()
+    per_model = matrix.mean(matrix.by_model())
+    p95 = matrix.quantile(matrix.by_alias_prefix(), 0.95)
+
+Statistics are held in a device x period matrix of kWh, with NaN for
+periods a device did not report. Devices reporting Wh (those with
+emeter_units) are converted when the matrix is filled. All aggregations
+reduce over the devices of each group for every period and are computed
+by numpy without looping over devices in Python.
+
+This module requires numpy.
+"""
+from __future__ import absolute_import
+import logging
+from collections import namedtuple
+from typing import Any, Dict, List, Optional
+
+import numpy
+
+from .fleet import DeviceFleet
+
+_LOGGER = logging.getLogger(__name__)
+
+GroupedEnergy = namedtuple(u"GroupedEnergy", [u"labels", u"values"])
+
+_WH_PER_KWH = 1000.0
+
+
+class EnergyMatrix(object):
+    u"""
+    Energy statistics of many devices, one row per device and one column
+    per day or month.
+    """
+
+    def __init__(self, keys, periods, infos=None):
+        u"""
+        Create an empty matrix.
+
+        :param list keys: device identifiers, one per row
+        :param periods: numpy datetime64[D] or datetime64[M] array of the
+                        periods, one per column
+        :param list infos: sysinfo of each device, used for grouping
+        """
+        self.keys = list(keys)
+        self.periods = numpy.asarray(periods)
+        self.infos = list(infos) if infos is not None \
+            else [{} for _ in self.keys]
+        self.values = numpy.full((len(self.keys), len(self.periods)),
+                                 numpy.nan)
+        self._rows = dict((key, row) for row, key in enumerate(self.keys))
+
+    @classmethod
+    def daily(cls, keys, start, end, infos=None):
+        u"""
+        Create an empty matrix with one column per day.
+
+        :param list keys: device identifiers
+        :param datetime.date start: first day
+        :param datetime.date end: last day
+        :param list infos: sysinfo of each device
+        :rtype: EnergyMatrix
+        """
+        periods = numpy.arange(numpy.datetime64(start, u"D"),
+                               numpy.datetime64(end, u"D") +
+                               numpy.timedelta64(1, u"D"))
+        return cls(keys, periods, infos)
+
+    @classmethod
+    def monthly(cls, keys, first_year, last_year, infos=None):
+        u"""
+        Create an empty matrix with one column per month.
+
+        :param list keys: device identifiers
+        :param int first_year: first year
+        :param int last_year: last year
+        :param list infos: sysinfo of each device
+        :rtype: EnergyMatrix
+        """
+        periods = numpy.arange(numpy.datetime64(u"%04d-01" % first_year),
+                               numpy.datetime64(u"%04d-01" % (last_year + 1)))
+        return cls(keys, periods, infos)
+
+    @property
+    def resolution(self):
+        u"""
+        numpy time unit of the columns, "D" or "M".
+
+        :rtype: str
+        """
+        return numpy.datetime_data(self.periods.dtype)[0]
+
+    def fill(self, key, stats, year, month=None, emeter_units=False):
+        u"""
+        Store statistics as returned by get_emeter_daily or
+        get_emeter_monthly.
+
+        Values outside of the periods of the matrix are ignored.
+
+        :param key: device identifier
+        :param dict stats: mapping of day (or month) to energy
+        :param int year: year of the statistics
+        :param int month: month of daily statistics, None for monthly ones
+        :param bool emeter_units: whether the values are in Wh
+        """
+        if not stats:
+            return
+        row = self._rows[key]
+        offsets = numpy.fromiter(stats.keys(), dtype=numpy.int64,
+                                 count=len(stats)) - 1
+        values = numpy.fromiter(stats.values(), dtype=numpy.float64,
+                                count=len(stats))
+        if emeter_units:
+            values /= _WH_PER_KWH
+
+        if month is None:
+            first = numpy.datetime64(u"%04d-01" % year)
+        else:
+            first = numpy.datetime64(u"%04d-%02d-01" % (year, month))
+        first = first.astype(self.periods.dtype)
+        columns = (first - self.periods[0]).astype(numpy.int64) + offsets
+        valid = (columns >= 0) & (columns < len(self.periods))
+        self.values[row, columns[valid]] = values[valid]
+
+    def to_monthly(self):
+        u"""
+        Sum a daily matrix into a monthly one.
+
+        Months in which a device reported no day at all stay NaN.
+
+        :rtype: EnergyMatrix
+        """
+        if self.resolution == u"M":
+            return self
+        months = self.periods.astype(u"datetime64[M]")
+        unique, starts = numpy.unique(months, return_index=True)
+        result = EnergyMatrix(self.keys, unique, self.infos)
+        if not len(self.periods):
+            return result
+        reported = numpy.add.reduceat(
+            (~numpy.isnan(self.values)).astype(numpy.int64), starts, axis=1)
+        sums = numpy.add.reduceat(numpy.nan_to_num(self.values), starts,
+                                  axis=1)
+        result.values = numpy.where(reported > 0, sums, numpy.nan)
+        return result
+
+    def by_model(self):
+        u"""
+        Group labels by device model.
+
+        :rtype: list
+        """
+        return [info.get(u"model") for info in self.infos]
+
+    def by_alias_prefix(self, separator=u" ", length=None):
+        u"""
+        Group labels by the beginning of the device alias.
+
+        :param str separator: use the part of the alias before the first
+                              separator
+        :param int length: use the first length characters instead
+        :rtype: list
+        """
+        labels = []
+        for info in self.infos:
+            alias = info.get(u"alias") or u""
+            if length is not None:
+                labels.append(alias[:length])
+            else:
+                labels.append(alias.split(separator, 1)[0])
+        return labels
+
+    def by_location(self, digits=2):
+        u"""
+        Group labels by device location, rounded to the given number of
+        decimal degrees.
+
+        :param int digits: decimals of latitude and longitude to keep
+        :rtype: list
+        """
+        labels = []
+        for info in self.infos:
+            if u"latitude" in info and u"longitude" in info:
+                latitude, longitude = info[u"latitude"], info[u"longitude"]
+            elif u"latitude_i" in info and u"longitude_i" in info:
+                # integer coordinates are in units of 1e-4 degrees
+                latitude = info[u"latitude_i"] / 10000.0
+                longitude = info[u"longitude_i"] / 10000.0
+            else:
+                labels.append(None)
+                continue
+            labels.append((round(latitude, digits), round(longitude, digits)))
+        return labels
+
+    def _groups(self, labels):
+        u"""
+        Return the unique labels, the row order sorting devices by group
+        and the index of the first sorted row of every group.
+        """
+        if labels is None:
+            labels = [None] * len(self.keys)
+        if len(labels) != len(self.keys):
+            raise ValueError(u"Expected one label per device")
+        unique = sorted(set(labels))
+        index = dict((label, position) for position, label
+                     in enumerate(unique))
+        groups = numpy.array([index[label] for label in labels],
+                             dtype=numpy.int64)
+        order = numpy.argsort(groups, kind=u"mergesort")
+        starts = numpy.searchsorted(groups[order],
+                                    numpy.arange(len(unique)))
+        return unique, order, starts
+
+    def sum(self, labels=None):
+        u"""
+        Total energy of every group for every period.
+
+        :param list labels: group label of every device (default: one
+                            group of all devices)
+        :return: labels and a group x period array of kWh
+        :rtype: GroupedEnergy
+        """
+        unique, order, starts = self._groups(labels)
+        if not len(self.keys):
+            return GroupedEnergy(unique, numpy.zeros((0, len(self.periods))))
+        values = numpy.nan_to_num(self.values[order])
+        return GroupedEnergy(unique,
+                             numpy.add.reduceat(values, starts, axis=0))
+
+    def mean(self, labels=None):
+        u"""
+        Mean energy per reporting device of every group for every period.
+
+        :param list labels: group label of every device
+        :return: labels and a group x period array of kWh, NaN where no
+                 device of the group reported
+        :rtype: GroupedEnergy
+        """
+        unique, order, starts = self._groups(labels)
+        if not len(self.keys):
+            return GroupedEnergy(unique, numpy.zeros((0, len(self.periods))))
+        values = self.values[order]
+        sums = numpy.add.reduceat(numpy.nan_to_num(values), starts, axis=0)
+        counts = numpy.add.reduceat(
+            (~numpy.isnan(values)).astype(numpy.int64), starts, axis=0)
+        with numpy.errstate(invalid=u"ignore", divide=u"ignore"):
+            means = sums / counts
+        return GroupedEnergy(unique, means)
+
+    def quantile(self, labels=None, q=0.5):
+        u"""
+        Quantiles of the energy of the devices in every group for every
+        period, interpolated linearly between the reported values like
+        numpy.nanpercentile.
+
+        :param list labels: group label of every device
+        :param q: quantile or sequence of quantiles between 0 and 1
+        :return: labels and a group x period array of kWh (group x
+                 quantile x period for a sequence of quantiles), NaN where
+                 no device of the group reported
+        :rtype: GroupedEnergy
+        """
+        unique, order, starts = self._groups(labels)
+        quantiles = numpy.asarray(q, dtype=numpy.float64)
+        if numpy.any((quantiles < 0) | (quantiles > 1)):
+            raise ValueError(u"Quantiles must be between 0 and 1")
+        shape = (len(unique),) + quantiles.shape + (len(self.periods),)
+        if not len(self.keys):
+            return GroupedEnergy(unique, numpy.zeros(shape))
+
+        values = self.values[order]
+        columns = numpy.arange(len(self.periods))
+        ends = numpy.append(starts[1:], len(order))
+        for start, end in zip(starts, ends):
+            if end - start > 1:
+                # every period of the group at once, NaN last
+                values[start:end].sort(axis=0)
+        counts = numpy.add.reduceat(
+            (~numpy.isnan(values)).astype(numpy.int64), starts, axis=0)
+
+        # positions of the quantiles among the reported values, as
+        # group x quantile x period
+        positions = quantiles.reshape(-1)[None, :, None] * \
+            numpy.maximum(counts - 1, 0)[:, None, :]
+        low = numpy.floor(positions).astype(numpy.int64)
+        high = numpy.ceil(positions).astype(numpy.int64)
+        rows = starts[:, None, None]
+        below = values[rows + low, columns]
+        above = values[rows + high, columns]
+        with numpy.errstate(invalid=u"ignore"):
+            results = below + (above - below) * (positions - low)
+        results[numpy.broadcast_to(counts[:, None, :] == 0,
+                                   results.shape)] = numpy.nan
+        return GroupedEnergy(unique, results.reshape(shape))
+
+    def total(self):
+        u"""
+        Total energy of all devices for every period.
+
+        :return: period array of kWh
+        :rtype: numpy.ndarray
+        """
+        return numpy.nansum(self.values, axis=0)
+
+
+def load_daily(devices, start, end, history=None, timeout=None,
+               max_workers=DeviceFleet.DEFAULT_MAX_WORKERS):
+    u"""
+    Fetch the daily statistics of many devices concurrently into a matrix.
+
+    Devices without an energy meter or which fail are left out.
+
+    :param devices: SmartDevice instances or a DeviceFleet
+    :param datetime.date start: first day
+    :param datetime.date end: last day
+    :param history: EmeterHistory to read the statistics through
+    :param float timeout: overall deadline in seconds
+    :param int max_workers: maximum number of devices talked to at once
+    :rtype: EnergyMatrix
+    """
+    months = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    def fetch(device):
+        if history is not None:
+            return [(year, month, history.daily(device, year, month))
+                    for year, month in months]
+        return [(year, month, device.get_emeter_daily(year, month))
+                for year, month in months]
+
+    matrix = EnergyMatrix.daily([], start, end)
+    return _load(matrix, devices, fetch, timeout, max_workers)
+
+
+def load_monthly(devices, first_year, last_year, history=None, timeout=None,
+                 max_workers=DeviceFleet.DEFAULT_MAX_WORKERS):
+    u"""
+    Fetch the monthly statistics of many devices concurrently into a
+    matrix.
+
+    Devices without an energy meter or which fail are left out.
+
+    :param devices: SmartDevice instances or a DeviceFleet
+    :param int first_year: first year
+    :param int last_year: last year
+    :param history: EmeterHistory to read the statistics through
+    :param float timeout: overall deadline in seconds
+    :param int max_workers: maximum number of devices talked to at once
+    :rtype: EnergyMatrix
+    """
+    years = range(first_year, last_year + 1)
+
+    def fetch(device):
+        if history is not None:
+            return [(year, None, history.monthly(device, year))
+                    for year in years]
+        return [(year, None, device.get_emeter_monthly(year))
+                for year in years]
+
+    matrix = EnergyMatrix.monthly([], first_year, last_year)
+    return _load(matrix, devices, fetch, timeout, max_workers)
+
+
+def _load(template, devices, fetch, timeout, max_workers):
+    if isinstance(devices, DeviceFleet):
+        fleet = devices
+    else:
+        fleet = DeviceFleet(devices, max_workers=max_workers)
+
+    def operation(device):
+        if not device.has_emeter:
+            return None
+        return device.sys_info, device.emeter_units, fetch(device)
+
+    fetched = []
+    for result in fleet.run(operation, timeout=timeout):
+        if result.exception is not None:
+            _LOGGER.warning(u"Unable to fetch statistics of %s: %s",
+                            result.device.ip_address, result.exception)
+        elif result.result is not None:
+            fetched.append((result.device, result.result))
+
+    matrix = EnergyMatrix([device.ip_address for device, _ in fetched],
+                          template.periods,
+                          [sysinfo for _, (sysinfo, _, _) in fetched])
+    for device, (_, emeter_units, stats) in fetched:
+        for year, month, values in stats:
+            matrix.fill(device.ip_address, values, year, month,
+                        emeter_units)
+    return matrix
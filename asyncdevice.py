@@ -0,0 +1,257 @@
+u"""
+Asynchronous counterparts of SmartDevice, SmartPlug and SmartBulb.
+
+Every method talking to the device is a coroutine::
+
+    loop = asyncio.get_event_loop()
+    protocol = AsyncTPLinkSmartHomeProtocol(max_connections=500)
+    plugs = [AsyncSmartPlug(ip, protocol) for ip in addresses]
+    infos = loop.run_until_complete(asyncio.gather(
+        *[plug.get_sysinfo() for plug in plugs], return_exceptions=True))
+
+Errors are raised as `SmartDeviceException`, just like for the blocking
+classes. Cancellation is passed through unchanged.
+"""
+from __future__ import absolute_import
+import logging
+import socket
+from typing import Any, Dict, Optional
+
+import trollius as asyncio
+from trollius import From, Return
+
+from .asyncprotocol import AsyncTPLinkSmartHomeProtocol
+from .smartdevice import SmartDevice, _communication_error
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AsyncSmartDevice(object):
+    u"""
+    Asynchronous base class for TP-Link Smart Home devices.
+    """
+
+    def __init__(self,
+                 ip_address,
+                 protocol=None):
+        u"""
+        Create a new AsyncSmartDevice instance, identified through its IP
+        address.
+
+        :param str ip_address: ip address on which the device listens
+        :param protocol: AsyncTPLinkSmartHomeProtocol to use, should be shared
+                         between devices (default: a new instance)
+        """
+        socket.inet_pton(socket.AF_INET, ip_address)
+        self.ip_address = ip_address
+        if not protocol:
+            protocol = AsyncTPLinkSmartHomeProtocol()
+        self.protocol = protocol
+        self.emeter_type = u"emeter"  # type: str
+        self.emeter_units = False
+        self._capabilities = {}  # type: Dict[str, Any]
+        self._capability_source = None  # type: Optional[Dict]
+
+    @asyncio.coroutine
+    def _query_helper(self,
+                      target,
+                      cmd,
+                      arg=None):
+        u"""
+        Helper returning unwrapped result object and doing error handling.
+
+        :param target: Target system {system, time, emeter, ..}
+        :param cmd: Command to execute
+        :param arg: JSON object passed as parameter to the command
+        :return: Unwrapped result for the call.
+        :rtype: dict
+        :raises SmartDeviceException: if command was not executed correctly
+        """
+        if arg is None:
+            arg = {}
+        try:
+            response = yield From(self.protocol.query(
+                host=self.ip_address,
+                request={target: {cmd: arg}}
+            ))
+        except asyncio.CancelledError:
+            raise
+        except Exception, ex:
+            raise _communication_error(ex)
+
+        raise Return(SmartDevice._process_response(target, cmd, response))
+
+    @asyncio.coroutine
+    def get_sysinfo(self):
+        u"""
+        Retrieve system information.
+
+        :return: sysinfo
+        :rtype dict
+        :raises SmartDeviceException: on error
+        """
+        sysinfo = yield From(self._query_helper(u"system", u"get_sysinfo"))
+        self.load_capabilities(sysinfo)
+        raise Return(sysinfo)
+
+    def load_capabilities(self, sysinfo):
+        u"""
+        Provide system information to derive the capabilities of the device
+        from, see SmartDevice.load_capabilities.
+
+        :param dict sysinfo: system information of the device
+        """
+        source = self._capability_source
+        if source is not None and all(
+                source.get(key) == sysinfo.get(key)
+                for key in SmartDevice.FIRMWARE_KEYS):
+            return
+        self._capabilities = {}
+        self._capability_source = dict(sysinfo)
+
+    @asyncio.coroutine
+    def _capability(self, name, func):
+        u"""
+        Return a capability of the device, computed by func from the system
+        information only once, as for the capabilities of SmartDevice.
+        """
+        if name not in self._capabilities:
+            if self._capability_source is None:
+                yield From(self.get_sysinfo())
+            self._capabilities[name] = func(self._capability_source)
+        raise Return(self._capabilities[name])
+
+    @asyncio.coroutine
+    def has_emeter(self):
+        u"""
+        Checks for energy meter support.
+        Note: this has to be implemented on a device specific class.
+
+        :return: True if energey meter is available
+                 False if energymeter is missing
+        """
+        raise NotImplementedError()
+
+    @asyncio.coroutine
+    def get_emeter_realtime(self):
+        u"""
+        Retrive current energy readings from device.
+
+        :returns: current readings or None
+        :rtype: dict, None
+                  None if device has no energy meter
+        :raises SmartDeviceException: on error
+        """
+        has_emeter = yield From(self.has_emeter())
+        if not has_emeter:
+            raise Return(None)
+
+        realtime = yield From(self._query_helper(self.emeter_type,
+                                                 u"get_realtime"))
+        raise Return(realtime)
+
+    @asyncio.coroutine
+    def turn_on(self):
+        u"""
+        Turns the device on.
+        """
+        raise NotImplementedError(u"Device subclass needs to implement this.")
+
+    @asyncio.coroutine
+    def turn_off(self):
+        u"""
+        Turns the device off.
+        """
+        raise NotImplementedError(u"Device subclass needs to implement this.")
+
+    def __repr__(self):
+        return u"<%s at %s>" % (self.__class__.__name__, self.ip_address)
+
+
+class AsyncSmartPlug(AsyncSmartDevice):
+    u"""
+    Asynchronous representation of a TP-Link Smart Switch.
+    """
+
+    def __init__(self,
+                 ip_address,
+                 protocol=None):
+        AsyncSmartDevice.__init__(self, ip_address, protocol)
+        self.emeter_type = u"emeter"
+        self.emeter_units = False
+
+    @asyncio.coroutine
+    def has_emeter(self):
+        u"""
+        Returns whether device has an energy meter.
+        :return: True if energy meter is available
+                 False otherwise
+        """
+        has_emeter = yield From(self._capability(
+            u"has_emeter", lambda sysinfo: SmartDevice.FEATURE_ENERGY_METER
+            in sysinfo[u'feature'].split(u':')))
+        raise Return(has_emeter)
+
+    @asyncio.coroutine
+    def turn_on(self):
+        u"""
+        Turn the switch on.
+
+        :raises SmartDeviceException: on error
+        """
+        yield From(self._query_helper(u"system", u"set_relay_state",
+                                      {u"state": 1}))
+
+    @asyncio.coroutine
+    def turn_off(self):
+        u"""
+        Turn the switch off.
+
+        :raises SmartDeviceException: on error
+        """
+        yield From(self._query_helper(u"system", u"set_relay_state",
+                                      {u"state": 0}))
+
+
+class AsyncSmartBulb(AsyncSmartDevice):
+    u"""
+    Asynchronous representation of a TP-Link Smart Bulb.
+    """
+
+    def __init__(self,
+                 ip_address,
+                 protocol=None):
+        AsyncSmartDevice.__init__(self, ip_address, protocol)
+        self.emeter_type = u"smartlife.iot.common.emeter"
+        self.emeter_units = True
+
+    @asyncio.coroutine
+    def has_emeter(self):
+        return True
+
+    @asyncio.coroutine
+    def get_light_state(self):
+        light_state = yield From(self._query_helper(
+            u"smartlife.iot.smartbulb.lightingservice", u"get_light_state"))
+        raise Return(light_state)
+
+    @asyncio.coroutine
+    def set_light_state(self, state):
+        light_state = yield From(self._query_helper(
+            u"smartlife.iot.smartbulb.lightingservice",
+            u"transition_light_state", state))
+        raise Return(light_state)
+
+    @asyncio.coroutine
+    def turn_on(self):
+        u"""
+        Turn the bulb on.
+        """
+        yield From(self.set_light_state({u"on_off": 1}))
+
+    @asyncio.coroutine
+    def turn_off(self):
+        u"""
+        Turn the bulb off.
+        """
+        yield From(self.set_light_state({u"on_off": 0}))
@@ -0,0 +1,192 @@
+u"""
+Asynchronous discovery of TP-Link Smart Home devices.
+
+    stream = AsyncDiscover.discover_iter(timeout=2, max_devices=10)
+    while True:
+        device = yield From(stream.next())
+        if device is None:
+            break
+        ...
+
+Devices are handed out as AsyncSmartPlug and AsyncSmartBulb instances as
+soon as their answer has been received, with their capabilities taken
+from it.
+"""
+from __future__ import absolute_import
+import logging
+import socket
+from typing import Optional
+
+import trollius as asyncio
+from trollius import From, Return
+
+from .asyncdevice import AsyncSmartBulb, AsyncSmartPlug
+from .asyncprotocol import AsyncTPLinkSmartHomeProtocol
+from .discover import Discover
+from .protocol import TPLinkSmartHomeProtocol
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class DiscoveryStream(object):
+    u"""
+    Devices answering a discovery broadcast, in order of arrival.
+
+    next() is a coroutine returning the next device, or None once discovery
+    has finished. close() stops discovery early.
+    """
+
+    def __init__(self,
+                 protocol=None,
+                 port=9999,
+                 timeout=0.1,
+                 max_devices=None,
+                 macs=None,
+                 targets=None,
+                 retries=Discover.DEFAULT_RETRIES,
+                 loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        if protocol is None:
+            # shared by the devices found, bound to the loop of the stream
+            protocol = AsyncTPLinkSmartHomeProtocol(loop=self.loop)
+        self.protocol = protocol
+        self.max_devices = max_devices
+        self.wanted = None
+        if macs is not None:
+            self.wanted = set(Discover._normalize_mac(mac) for mac in macs)
+        self.found = 0
+        self._seen = set()
+        self._queue = asyncio.Queue(loop=self.loop)
+        self._closed = False
+        if targets is None:
+            targets = Discover.broadcast_addresses()
+
+        self._sock = Discover._open_socket()
+        self._sock.setblocking(False)
+        self.loop.add_reader(self._sock.fileno(), self._on_readable)
+        self._timers = [self.loop.call_later(timeout, self.close)]
+        for offset in Discover._send_offsets(timeout, retries):
+            self._timers.append(self.loop.call_later(
+                offset, Discover._send_probes, self._sock,
+                TPLinkSmartHomeProtocol, port, targets))
+
+    @asyncio.coroutine
+    def next(self):
+        u"""
+        Wait for the next device.
+
+        :return: AsyncSmartPlug or AsyncSmartBulb, None when done
+        """
+        if self._closed and self._queue.empty():
+            raise Return(None)
+        device = yield From(self._queue.get())
+        if device is None:
+            # keep the end marker for further calls
+            self._queue.put_nowait(None)
+        raise Return(device)
+
+    def close(self):
+        u"""
+        Stop discovery, devices already received are still handed out.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for timer in self._timers:
+            timer.cancel()
+        self.loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._queue.put_nowait(None)
+
+    def _on_readable(self):
+        try:
+            data, addr = self._sock.recvfrom(4096)
+        except socket.error:
+            return
+
+        ip, _ = addr
+        info = Discover._parse_response(TPLinkSmartHomeProtocol, data)
+        if info is None:
+            return
+        try:
+            device_type = Discover._device_type(info)
+            if device_type is None:
+                return
+            mac = Discover._mac(info) or ip
+        except (TypeError, ValueError, KeyError, AttributeError), ex:
+            _LOGGER.warning(u"Skipping malformed answer from %s: %s", ip, ex)
+            return
+        if mac in self._seen:
+            return
+        self._seen.add(mac)
+        if device_type == u"plug":
+            device = AsyncSmartPlug(ip, self.protocol)
+        else:
+            device = AsyncSmartBulb(ip, self.protocol)
+        device.load_capabilities(info[u"system"][u"get_sysinfo"])
+        self._queue.put_nowait(device)
+
+        self.found += 1
+        if self.max_devices is not None and self.found >= self.max_devices:
+            self.close()
+        elif self.wanted is not None:
+            self.wanted.discard(mac)
+            if not self.wanted:
+                self.close()
+
+
+class AsyncDiscover(object):
+    @staticmethod
+    def discover_iter(protocol=None,
+                      port=9999,
+                      timeout=0.1,
+                      max_devices=None,
+                      macs=None,
+                      targets=None,
+                      retries=Discover.DEFAULT_RETRIES,
+                      loop=None):
+        u"""
+        Sends discovery message to the broadcast address of every local
+        network interface and to 255.255.255.255 and returns a stream
+        handing out each device as soon as its answer has been received.
+        See Discover.discover_iter for details.
+
+        :param protocol: AsyncTPLinkSmartHomeProtocol for the devices
+                         (default: one instance shared by the devices)
+        :param timeout: How long to wait for responses at most
+        :param port: port to send broadcast messages, defaults to 9999.
+        :param int max_devices: stop after this many devices
+        :param macs: stop once devices with all of these mac addresses
+                     have been found
+        :param targets: addresses to send the discovery message to
+                        (default: Discover.broadcast_addresses())
+        :param int retries: how often to repeat the discovery message
+        :param loop: event loop to use
+        :rtype: DiscoveryStream
+        """
+        return DiscoveryStream(protocol, port, timeout, max_devices, macs,
+                               targets, retries, loop)
+
+    @staticmethod
+    @asyncio.coroutine
+    def discover(protocol=None,
+                 port=9999,
+                 timeout=0.1,
+                 targets=None,
+                 retries=Discover.DEFAULT_RETRIES,
+                 loop=None):
+        u"""
+        Discover devices, waiting for the given timeout for answers.
+
+        :rtype: dict
+        :return: mapping of ip address to device
+        """
+        stream = DiscoveryStream(protocol, port, timeout, targets=targets,
+                                 retries=retries, loop=loop)
+        devices = {}
+        while True:
+            device = yield From(stream.next())
+            if device is None:
+                break
+            devices[device.ip_address] = device
+        raise Return(devices)
@@ -0,0 +1,122 @@
+u"""
+Asynchronous implementation of the TP-Link Smart Home Protocol.
+
+Built on asyncio streams as provided by trollius, the asyncio backport for
+Python 2, so that a single event loop can talk to many devices at once.
+"""
+from __future__ import absolute_import
+import json
+import logging
+import socket
+import struct
+
+import trollius as asyncio
+from trollius import From, Return
+
+from .protocol import TPLinkSmartHomeProtocol, ResponseFrame
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AsyncTPLinkSmartHomeProtocol(object):
+    u"""
+    Asynchronous TP-Link Smart Home Protocol.
+
+    query() is a coroutine, each call opens its own connection. Timeouts
+    cover the whole query, from connecting to reading the last byte, and
+    cancelling a query closes its connection.
+
+    A single instance is meant to be shared between devices. The number of
+    connections open at the same time can be limited with
+    `max_connections`, which keeps large fleets from running out of file
+    descriptors; queries exceeding it wait for a free slot.
+    """
+    DEFAULT_PORT = TPLinkSmartHomeProtocol.DEFAULT_PORT
+    DEFAULT_TIMEOUT = TPLinkSmartHomeProtocol.DEFAULT_TIMEOUT
+
+    def __init__(self,
+                 timeout=DEFAULT_TIMEOUT,
+                 max_connections=None,
+                 loop=None):
+        u"""
+        Create a new asynchronous protocol instance.
+
+        :param float timeout: seconds a single query may take
+        :param int max_connections: maximum number of open connections,
+                                    None for no limit
+        :param loop: event loop to use (default: the current event loop)
+        """
+        self.timeout = timeout
+        self.loop = loop or asyncio.get_event_loop()
+        self._semaphore = None
+        if max_connections is not None:
+            self._semaphore = asyncio.Semaphore(max_connections,
+                                                loop=self.loop)
+
+    @asyncio.coroutine
+    def query(self,
+              host,
+              request,
+              port=DEFAULT_PORT):
+        u"""
+        Request information from a TP-Link SmartHome Device and return the
+        response.
+
+        :param str host: ip address of the device
+        :param int port: port on the device (default: 9999)
+        :param request: command to send to the device (can be either dict or
+        json string)
+        :return: parsed json response
+        :raises socket.timeout: when the query takes longer than the
+                                timeout, like the blocking protocols
+        """
+        if isinstance(request, dict):
+            request = json.dumps(request)
+
+        if self._semaphore is None:
+            response = yield From(self._query_with_timeout(host, request,
+                                                           port))
+        else:
+            with (yield From(self._semaphore)):
+                response = yield From(self._query_with_timeout(host, request,
+                                                               port))
+        raise Return(response)
+
+    @asyncio.coroutine
+    def _query_with_timeout(self, host, request, port):
+        try:
+            response = yield From(asyncio.wait_for(
+                self._query(host, request, port), self.timeout,
+                loop=self.loop))
+        except asyncio.TimeoutError:
+            raise socket.timeout(u"timed out")
+        raise Return(response)
+
+    @asyncio.coroutine
+    def _query(self, host, request, port):
+        reader, writer = yield From(asyncio.open_connection(
+            host, port, loop=self.loop))
+        try:
+            _LOGGER.debug(u"> (%i) %s", len(request), request)
+            writer.write(bytes(TPLinkSmartHomeProtocol.encrypt(request)))
+            yield From(writer.drain())
+
+            header = yield From(reader.readexactly(4))
+            length = struct.unpack(u">I", header)[0]
+            ResponseFrame.check_length(length)
+            # Some devices send a length header of 0 and terminate the
+            # response by closing the connection.
+            if length:
+                payload = yield From(reader.readexactly(length))
+            else:
+                payload = bytearray()
+                while True:
+                    chunk = yield From(reader.read(ResponseFrame.CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    payload.extend(chunk)
+                    ResponseFrame.check_length(len(payload))
+        finally:
+            writer.close()
+
+        raise Return(TPLinkSmartHomeProtocol._decode(payload))
@@ -0,0 +1,12 @@
+u"""
+Micro-benchmarks for the hot paths of the library.
+
+Run a benchmark as a module, e.g.::
+
+    python -m tplink.benchmarks.cipher
+
+The complete suite, run against emulated devices, writes its results as
+JSON so that releases can be compared::
+
+    python -m tplink.benchmarks.suite -o results.json
+"""
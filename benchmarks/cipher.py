@@ -0,0 +1,112 @@
+u"""
+Micro-benchmark of the XOR autokey cipher used by the protocol.
+
+Compares the original per-character loop with the bulk pure Python and
+NumPy implementations on payloads from 1 KB to 1 MB::
+
+    python -m tplink.benchmarks.cipher
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import timeit
+
+from tplink import protocol
+
+SIZES = (1 << 10, 16 << 10, 256 << 10, 1 << 20)
+
+
+def reference_encrypt(plaintext):
+    u"""
+    Per-character encryption as originally implemented.
+    """
+    key = protocol.TPLinkSmartHomeProtocol.INITIALIZATION_VECTOR
+    buffer = bytearray()
+    for char in plaintext:
+        cipher = key ^ ord(char)
+        key = cipher
+        buffer.append(cipher)
+    return buffer
+
+
+def reference_decrypt(ciphertext):
+    u"""
+    Per-character decryption as originally implemented.
+    """
+    key = protocol.TPLinkSmartHomeProtocol.INITIALIZATION_VECTOR
+    buffer = []
+    for char in ciphertext.decode(u'latin-1'):
+        plain = key ^ ord(char)
+        key = ord(char)
+        buffer.append(unichr(plain))
+    return u''.join(buffer)
+
+
+def implementations():
+    u"""
+    Return the available (name, encrypt, decrypt) implementations.
+    """
+    impls = [
+        (u"reference", reference_encrypt, reference_decrypt),
+        (u"python", protocol._encrypt_python, protocol._decrypt_python),
+    ]
+    if protocol.numpy is not None:
+        impls.append((u"numpy", protocol._encrypt_numpy,
+                      protocol._decrypt_numpy))
+    return impls
+
+
+def measure(func, data, min_time=0.2):
+    u"""
+    Return the best time per call of func(data) in seconds.
+    """
+    number = 1
+    while True:
+        elapsed = timeit.timeit(lambda: func(data), number=number)
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = min(timeit.repeat(lambda: func(data), number=number, repeat=3))
+    return best / number
+
+
+def run(sizes=SIZES):
+    u"""
+    Run the benchmark.
+
+    :return: list of dicts with size, implementation, operation, seconds
+             per call and throughput in MB/s
+    """
+    results = []
+    for size in sizes:
+        plaintext = os.urandom(size)
+        ciphertext = protocol._encrypt_python(plaintext)
+        for name, encrypt, decrypt in implementations():
+            for operation, func, data in ((u"encrypt", encrypt, plaintext),
+                                          (u"decrypt", decrypt, ciphertext)):
+                seconds = measure(func, data)
+                results.append({
+                    u"size": size,
+                    u"implementation": name,
+                    u"operation": operation,
+                    u"seconds": seconds,
+                    u"mb_per_s": size / seconds / (1 << 20),
+                })
+    return results
+
+
+def main():
+    results = run()
+    reference = dict(((r[u"size"], r[u"operation"]), r[u"seconds"])
+                     for r in results if r[u"implementation"] == u"reference")
+    print(u"%8s  %-9s  %-7s  %12s  %10s  %8s" % (
+        u"size", u"impl", u"op", u"us/call", u"MB/s", u"speedup"))
+    for r in results:
+        print(u"%8d  %-9s  %-7s  %12.1f  %10.1f  %7.1fx" % (
+            r[u"size"], r[u"implementation"], r[u"operation"],
+            r[u"seconds"] * 1e6, r[u"mb_per_s"],
+            reference[(r[u"size"], r[u"operation"])] / r[u"seconds"]))
+
+
+if __name__ == u"__main__":
+    main()
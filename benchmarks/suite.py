@@ -0,0 +1,267 @@
+u"""
+Benchmark suite of the protocol and device hot paths, run against
+emulated devices on the local machine.
+
+    python -m tplink.benchmarks.suite -o results.json
+    python -m tplink.benchmarks.suite --compare results.json
+
+Measures cipher throughput, query latency percentiles of the protocol
+implementations, queries per second for serial and concurrent polling and
+the number of network round trips made by high-level device properties.
+Results are written as JSON. With --compare, the run is checked against
+earlier results and the exit status is non-zero if a property makes more
+round trips than before or throughput dropped by more than the tolerance.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+
+from tplink import (DeviceFleet, MultiplexedTPLinkSmartHomeProtocol,
+                    PooledTPLinkSmartHomeProtocol, SmartBulb, SmartPlug,
+                    TPLinkSmartHomeProtocol, protocol)
+from tplink.benchmarks import cipher
+from tplink.emulator import Emulator, make_devices
+
+SYSINFO = {u"system": {u"get_sysinfo": None}}
+
+# properties and methods whose round trips are counted, per device class
+PROPERTIES = {
+    u"SmartPlug": (u"state_information", u"__repr__", u"current_consumption",
+                   u"state", u"has_emeter"),
+    u"SmartBulb": (u"state_information", u"__repr__", u"current_consumption",
+                   u"hsv", u"brightness", u"color_temp", u"state"),
+}
+
+
+class _PortProtocol(object):
+    u"""
+    Protocol wrapper sending every query to the port of the emulator.
+    """
+
+    def __init__(self, protocol, port):
+        self.protocol = protocol
+        self.port = port
+
+    def query(self, host, request, **kwargs):
+        return self.protocol.query(host=host, request=request,
+                                   port=self.port, **kwargs)
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    u"""
+    Summarize samples by their nearest-rank percentiles, minimum and
+    maximum.
+
+    :param list samples: measured values
+    :rtype: dict
+    """
+    ordered = sorted(samples)
+    summary = {u"min": ordered[0], u"max": ordered[-1],
+               u"count": len(ordered)}
+    for point in points:
+        rank = max(int(round(point / 100.0 * len(ordered))) - 1, 0)
+        summary[u"p%d" % point] = ordered[rank]
+    return summary
+
+
+def bench_latency(port, addresses, queries):
+    u"""
+    Latency of single get_sysinfo queries for each protocol implementation.
+    """
+    implementations = (
+        (u"TPLinkSmartHomeProtocol", TPLinkSmartHomeProtocol()),
+        (u"PooledTPLinkSmartHomeProtocol", PooledTPLinkSmartHomeProtocol()),
+        (u"MultiplexedTPLinkSmartHomeProtocol",
+         MultiplexedTPLinkSmartHomeProtocol()),
+    )
+    results = {}
+    for name, implementation in implementations:
+        samples = []
+        for number in range(queries):
+            host = addresses[number % len(addresses)]
+            start = time.time()
+            implementation.query(host=host, request=SYSINFO, port=port)
+            samples.append(time.time() - start)
+        results[name] = percentiles(samples)
+        if hasattr(implementation, u"close"):
+            implementation.close()
+    return results
+
+
+def bench_throughput(port, addresses, rounds):
+    u"""
+    Queries per second polling get_sysinfo of all devices, serially and
+    concurrently.
+    """
+    plain = _PortProtocol(TPLinkSmartHomeProtocol(), port)
+    devices = [SmartPlug(address, protocol=plain) for address in addresses]
+
+    def serial():
+        for device in devices:
+            device.get_sysinfo()
+
+    fleet = DeviceFleet(devices)
+
+    def threaded():
+        for result in fleet.get_sysinfo():
+            if result.exception is not None:
+                raise result.exception
+
+    multiplexed = MultiplexedTPLinkSmartHomeProtocol()
+    requests = [(address, SYSINFO) for address in addresses]
+
+    def multiplex():
+        for result in multiplexed.query_many(requests, port=port):
+            if isinstance(result, Exception):
+                raise result
+
+    results = {}
+    for name, poll in ((u"serial", serial),
+                       (u"fleet", threaded),
+                       (u"multiplexed", multiplex)):
+        start = time.time()
+        for _ in range(rounds):
+            poll()
+        elapsed = time.time() - start
+        results[name] = {u"queries": rounds * len(addresses),
+                         u"seconds": elapsed,
+                         u"qps": rounds * len(addresses) / elapsed}
+    return results
+
+
+def bench_round_trips(port, plug, bulb):
+    u"""
+    Network round trips made by reading each property on a new device,
+    without and with caching of the system information.
+    """
+    results = {}
+    for virtual, device_class in ((plug, SmartPlug), (bulb, SmartBulb)):
+        counts = {}
+        for name in PROPERTIES[device_class.__name__]:
+            for cache_ttl in (0, 60):
+                device = device_class(
+                    virtual.ip_address,
+                    protocol=_PortProtocol(TPLinkSmartHomeProtocol(), port),
+                    cache_ttl=cache_ttl)
+                before = virtual.requests
+                if name == u"__repr__":
+                    repr(device)
+                else:
+                    value = getattr(device, name)
+                    if callable(value):
+                        value()
+                key = name if not cache_ttl else u"%s (cached)" % name
+                counts[key] = virtual.requests - before
+        results[device_class.__name__] = counts
+    return results
+
+
+def run(quick=False):
+    u"""
+    Run the whole suite.
+
+    :param bool quick: fewer repetitions, for a smoke test
+    :return: results, ready to be serialized as JSON
+    :rtype: dict
+    """
+    device_count = 20 if quick else 200
+    devices = make_devices(plugs=device_count // 2,
+                           bulbs=device_count - device_count // 2, seed=0)
+    addresses = [device.ip_address for device in devices]
+    plug = devices[0]
+    bulb = devices[-1]
+
+    with Emulator(devices, port=0, udp=False) as emulator:
+        results = {
+            u"meta": {
+                u"date": datetime.datetime.utcnow().isoformat(),
+                u"python": platform.python_version(),
+                u"platform": platform.platform(),
+                u"numpy": getattr(protocol.numpy, u"__version__", None),
+                u"devices": device_count,
+            },
+            u"cipher": cipher.run(cipher.SIZES[:2] if quick
+                                  else cipher.SIZES),
+            u"latency": bench_latency(emulator.port, addresses,
+                                      50 if quick else 1000),
+            u"throughput": bench_throughput(emulator.port, addresses,
+                                            1 if quick else 5),
+            u"round_trips": bench_round_trips(emulator.port, plug, bulb),
+        }
+    return results
+
+
+def compare(baseline, results, tolerance=0.2):
+    u"""
+    Compare results against a baseline.
+
+    :param dict baseline: results of an earlier run
+    :param dict results: results of this run
+    :param float tolerance: allowed relative drop of throughput
+    :return: descriptions of the regressions found
+    :rtype: list
+    """
+    regressions = []
+    for device_class, counts in results[u"round_trips"].items():
+        before = baseline.get(u"round_trips", {}).get(device_class, {})
+        for name, count in sorted(counts.items()):
+            if name in before and count > before[name]:
+                regressions.append(u"%s.%s: %d round trips, was %d" % (
+                    device_class, name, count, before[name]))
+
+    for name, measured in results[u"throughput"].items():
+        before = baseline.get(u"throughput", {}).get(name)
+        if before and measured[u"qps"] < before[u"qps"] * (1 - tolerance):
+            regressions.append(u"%s polling: %.0f queries/s, was %.0f" % (
+                name, measured[u"qps"], before[u"qps"]))
+
+    before = dict(((r[u"size"], r[u"implementation"], r[u"operation"]),
+                   r[u"mb_per_s"]) for r in baseline.get(u"cipher", []))
+    for r in results[u"cipher"]:
+        key = (r[u"size"], r[u"implementation"], r[u"operation"])
+        if key in before and r[u"mb_per_s"] < before[key] * (1 - tolerance):
+            regressions.append(u"%s %s of %d bytes: %.1f MB/s, was %.1f" % (
+                r[u"implementation"], r[u"operation"], r[u"size"],
+                r[u"mb_per_s"], before[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=u"Benchmark the protocol and device hot paths.")
+    parser.add_argument(u"-o", u"--output",
+                        help=u"file to write the results to "
+                             u"(default: standard output)")
+    parser.add_argument(u"--compare", metavar=u"BASELINE",
+                        help=u"results of an earlier run to compare with")
+    parser.add_argument(u"--tolerance", type=float, default=0.2,
+                        help=u"allowed relative drop of throughput")
+    parser.add_argument(u"--quick", action=u"store_true",
+                        help=u"fewer repetitions, for a smoke test")
+    args = parser.parse_args()
+
+    results = run(quick=args.quick)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, u"w") as stream:
+            stream.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as stream:
+            baseline = json.load(stream)
+        regressions = compare(baseline, results, args.tolerance)
+        for regression in regressions:
+            print(u"REGRESSION: %s" % regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == u"__main__":
+    main()
@@ -1,83 +1,574 @@
 from __future__ import absolute_import
+import errno
+import select
 import socket
 import logging
 import json
+import struct
 import time
-from typing import Dict
+from typing import Dict, Iterator, Optional
 import os
 import sys
 dirname = os.path.dirname(__file__)
 sys.path.append(dirname)
 
 from tplink import TPLinkSmartHomeProtocol, SmartDevice, SmartPlug, SmartBulb
+from tplink import SmartDeviceException
+from tplink import MultiplexedTPLinkSmartHomeProtocol
 
 _LOGGER = logging.getLogger(__name__)
 
+# ioctl requests and interface flags from <linux/sockios.h> and <net/if.h>
+_SIOCGIFFLAGS = 0x8913
+_SIOCGIFBRDADDR = 0x8919
+_IFF_UP = 0x1
+_IFF_BROADCAST = 0x2
+
 
 class Discover(object):
+    DISCOVERY_QUERY = {
+        u"emeter": {u"get_realtime": None},
+        u"system": {u"get_sysinfo": None},
+    }
+
+    # Discovered devices are seeded with the system information and energy
+    # readings from the discovery answer, which serve their first use. Like
+    # devices created directly, they do not cache by default.
+    DEFAULT_CACHE_TTL = 0
+    DEFAULT_RETRIES = 2
+    DEFAULT_SWEEP_RATE = 1000
+    # connections open at once by the TCP fallback of a sweep, well below
+    # the usual limit of 1024 file descriptors
+    DEFAULT_SWEEP_CONNECTIONS = 64
+    # pause of a sweep after the send buffer ran full
+    SWEEP_BACKOFF = 0.005
+
     @staticmethod
     def discover(protocol=None,
                  port=9999,
-                 timeout=0.1):
+                 timeout=0.1,
+                 cache_ttl=DEFAULT_CACHE_TTL,
+                 targets=None,
+                 retries=DEFAULT_RETRIES):
         u"""
-        Sends discovery message to 255.255.255.255:9999 in order
+        Sends discovery message to the broadcast address of every local
+        network interface and to 255.255.255.255 on port 9999 in order
         to detect available supported devices in the local network,
         and waits for given timeout for answers from devices.
 
         :param protocol: Protocol implementation to use
         :param timeout: How long to wait for responses, defaults to 5
         :param port: port to send broadcast messages, defaults to 9999.
+        :param cache_ttl: cache_ttl of the created devices; pass e.g. 5 to
+                          keep using the system information from the
+                          discovery answer after its first use
+        :param targets: addresses to send the discovery message to
+                        (default: Discover.broadcast_addresses())
+        :param int retries: how often to repeat the discovery message
         :rtype: dict
         :return: Array of json objects {"ip", "port", "sys_info"}
         """
+        devices = {}
+        for device in Discover.discover_iter(protocol=protocol,
+                                             port=port,
+                                             timeout=timeout,
+                                             cache_ttl=cache_ttl,
+                                             targets=targets,
+                                             retries=retries):
+            devices[device.ip_address] = device
+        return devices
+
+    @staticmethod
+    def discover_iter(protocol=None,
+                      port=9999,
+                      timeout=0.1,
+                      max_devices=None,
+                      macs=None,
+                      cache_ttl=DEFAULT_CACHE_TTL,
+                      targets=None,
+                      retries=DEFAULT_RETRIES):
+        u"""
+        Sends discovery message to the broadcast address of every local
+        network interface and to 255.255.255.255 and yields each device as
+        soon as its answer has been received.
+
+        The discovery message is repeated `retries` times within the
+        timeout, with exponentially growing pauses, to make up for lost
+        packets. Devices answering more than once, be it to repeated
+        messages or on several networks, are only reported once.
+
+        Stops after `timeout` seconds, or earlier once `max_devices` devices
+        have been found or all devices in `macs` have answered.
+
+        The devices are seeded with the system information and energy
+        readings from their answer (see SmartDevice.seed_cache), and their
+        `discovered_at` is set to the time the answer arrived. The seeded
+        data serves the first access to it without a further round trip,
+        and afterwards for `cache_ttl` seconds; with the default of 0 later
+        accesses query the device as before. The capabilities of the device
+        are taken from the answer either way.
+
+        :param protocol: Protocol implementation to use
+        :param timeout: How long to wait for responses at most
+        :param port: port to send broadcast messages, defaults to 9999.
+        :param int max_devices: stop after this many devices
+        :param macs: stop once devices with all of these mac addresses
+                     have been found
+        :param cache_ttl: cache_ttl of the created devices
+        :param targets: addresses to send the discovery message to
+                        (default: Discover.broadcast_addresses())
+        :param int retries: how often to repeat the discovery message
+        :rtype: Iterator[SmartDevice]
+        :return: SmartPlug and SmartBulb instances
+        """
         if protocol is None:
             protocol = TPLinkSmartHomeProtocol()
+        if targets is None:
+            targets = Discover.broadcast_addresses()
 
-        discovery_query = {
-            u"emeter": {u"get_realtime": None},
-            u"system": {u"get_sysinfo": None},
-        }
-        target = u"255.255.255.255"
+        wanted = None
+        if macs is not None:
+            wanted = set(Discover._normalize_mac(mac) for mac in macs)
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(timeout)
+        sock = Discover._open_socket()
+        start = time.time()
+        deadline = start + timeout
+        send_times = [start + offset
+                      for offset in Discover._send_offsets(timeout, retries)]
+        seen = set()
+        found = 0
+        _LOGGER.debug(u"Waiting %s seconds for responses...", timeout)
 
-        req = json.dumps(discovery_query)
-        _LOGGER.debug(u"Sending discovery to %s:%s", target, port)
+        try:
+            while True:
+                now = time.time()
+                while send_times and send_times[0] <= now:
+                    send_times.pop(0)
+                    Discover._send_probes(sock, protocol, port, targets)
 
-        encrypted_req = protocol.encrypt(req)
-        sock.sendto(encrypted_req[4:], (target, port))
+                remaining = deadline - now
+                if remaining <= 0:
+                    break
+                wait = remaining
+                if send_times:
+                    wait = min(wait, send_times[0] - now)
+                readable, _, _ = select.select([sock], [], [], wait)
+                if not readable:
+                    continue
+
+                data, addr = sock.recvfrom(4096)
+                ip, _ = addr
+                device, mac = Discover._device_from_data(ip, data, protocol,
+                                                         cache_ttl, seen)
+                if device is None:
+                    continue
 
+                yield device
+
+                found += 1
+                if max_devices is not None and found >= max_devices:
+                    break
+                if wanted is not None:
+                    wanted.discard(mac)
+                    if not wanted:
+                        break
+        finally:
+            sock.close()
+
+    @staticmethod
+    def sweep(networks,
+              port=9999,
+              timeout=1.0,
+              rate=DEFAULT_SWEEP_RATE,
+              tcp_fallback=True,
+              cache_ttl=DEFAULT_CACHE_TTL,
+              max_connections=DEFAULT_SWEEP_CONNECTIONS):
+        u"""
+        Find devices by probing every address of the given networks, for
+        networks where broadcasts do not get through.
+
+        See sweep_iter for details.
+
+        :rtype: dict
+        :return: mapping of ip address to device
+        """
         devices = {}
-        _LOGGER.debug(u"Waiting %s seconds for responses...", timeout)
+        for device in Discover.sweep_iter(networks, port=port,
+                                          timeout=timeout, rate=rate,
+                                          tcp_fallback=tcp_fallback,
+                                          cache_ttl=cache_ttl,
+                                          max_connections=max_connections):
+            devices[device.ip_address] = device
+        return devices
+
+    @staticmethod
+    def sweep_iter(networks,
+                   port=9999,
+                   timeout=1.0,
+                   rate=DEFAULT_SWEEP_RATE,
+                   tcp_fallback=True,
+                   cache_ttl=DEFAULT_CACHE_TTL,
+                   max_connections=DEFAULT_SWEEP_CONNECTIONS):
+        u"""
+        Find devices by probing every address of the given networks, for
+        networks where broadcasts do not get through.
 
+        The discovery message is sent by unicast UDP to each address, paced
+        to at most `rate` packets per second, and answers are collected
+        while sending. Addresses which have not answered `timeout` seconds
+        after the last message was sent are then asked for their system
+        information over TCP, if `tcp_fallback` is set, using the same rate
+        for new connections and keeping at most `max_connections` of them
+        open at once.
+
+        :param networks: networks in CIDR notation, e.g. "192.168.0.0/22",
+                         or single addresses
+        :param port: port of the devices, defaults to 9999.
+        :param float timeout: how long to wait for answers
+        :param float rate: maximum number of packets or connections per
+                           second
+        :param bool tcp_fallback: whether to try TCP for silent addresses
+        :param cache_ttl: cache_ttl of the created devices
+        :param int max_connections: maximum number of TCP connections open
+                                    at once
+        :rtype: Iterator[SmartDevice]
+        :return: SmartPlug and SmartBulb instances
+        """
+        hosts = []
+        for network in networks:
+            hosts.extend(Discover._network_hosts(network))
+
+        protocol = TPLinkSmartHomeProtocol
+        request = protocol.encrypt(json.dumps(Discover.DISCOVERY_QUERY))[4:]
+        interval = 1.0 / rate
+        answered = set()
+        seen = set()
+
+        sock = Discover._open_socket()
+        sock.setblocking(False)
         try:
+            pending = list(reversed(hosts))
+            next_send = time.time()
+            deadline = next_send + timeout
             while True:
-                data, addr = sock.recvfrom(4096)
-                ip, port = addr
-                info = json.loads(protocol.decrypt(data))
-                if u"system" in info and u"get_sysinfo" in info[u"system"]:
-                    sysinfo = info[u"system"][u"get_sysinfo"]
-                    if u"type" in sysinfo:
-                        type = sysinfo[u"type"]
-                    elif u"mic_type" in sysinfo:
-                        type = sysinfo[u"mic_type"]
-                    else:
-                        _LOGGER.error(u"Unable to find the device type field!")
-                        type = u"UNKNOWN"
-                else:
-                    _LOGGER.error(u"No 'system' nor 'get_sysinfo' in response")
-                if u"smartplug" in type.lower():
-                    devices[ip] = SmartPlug(ip)
-                elif u"smartbulb" in type.lower():
-                    devices[ip] = SmartBulb(ip)
-        except socket.timeout:
-            _LOGGER.debug(u"Got socket timeout, which is okay.")
+                now = time.time()
+                while pending and next_send <= now:
+                    host = pending.pop()
+                    try:
+                        sock.sendto(request, (host, port))
+                    except socket.error, ex:
+                        if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                          errno.ENOBUFS):
+                            # retry this host after a pause, reading answers
+                            # meanwhile instead of spinning on the socket
+                            pending.append(host)
+                            next_send = now + max(interval,
+                                                  Discover.SWEEP_BACKOFF)
+                            break
+                        _LOGGER.debug(u"Unable to probe %s: %s", host, ex)
+                    next_send += interval
+                    deadline = next_send + timeout
+
+                if not pending and now >= deadline:
+                    break
+                wait = (next_send if pending else deadline) - now
+                readable, _, _ = select.select([sock], [], [], max(wait, 0))
+                if not readable:
+                    continue
+
+                try:
+                    data, addr = sock.recvfrom(4096)
+                except socket.error:
+                    continue
+                ip, _ = addr
+                device, _ = Discover._device_from_data(ip, data, protocol,
+                                                       cache_ttl, seen)
+                if device is not None:
+                    answered.add(ip)
+                    yield device
+        finally:
+            sock.close()
+
+        if not tcp_fallback:
+            return
+
+        silent = [host for host in hosts if host not in answered]
+        engine = MultiplexedTPLinkSmartHomeProtocol(
+            timeout=timeout, max_connections=max_connections)
+        request = {u"system": {u"get_sysinfo": None}}
+        chunk_size = max(int(rate), 1)
+        for start in range(0, len(silent), chunk_size):
+            chunk_start = time.time()
+            chunk = silent[start:start + chunk_size]
+            results = engine.query_many([(host, request) for host in chunk],
+                                        port=port)
+            for host, info in zip(chunk, results):
+                if isinstance(info, Exception):
+                    continue
+                device, _ = Discover._device_from_info(host, info, cache_ttl,
+                                                       seen)
+                if device is not None:
+                    yield device
+            # keep new connections within the rate limit
+            remaining = chunk_start + len(chunk) * interval - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+
+    @staticmethod
+    def _network_hosts(network):
+        u"""
+        Host addresses of a network in CIDR notation.
+
+        Network and broadcast addresses are left out, unless the network is
+        too small to have any other addresses.
+
+        :param str network: e.g. "192.168.0.0/24" or "192.168.0.10"
+        :rtype: list
+        """
+        address, _, prefix = network.partition(u"/")
+        prefix = int(prefix) if prefix else 32
+        if not 0 <= prefix <= 32:
+            raise ValueError(u"Invalid network %s" % network)
+        base = struct.unpack(b">I", socket.inet_aton(address))[0]
+        mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+        first = base & mask
+        last = first | (~mask & 0xffffffff)
+        if prefix < 31:
+            first += 1
+            last -= 1
+        return [socket.inet_ntoa(struct.pack(b">I", value))
+                for value in xrange(first, last + 1)]
+
+    @staticmethod
+    def _device_from_data(ip, data, protocol, cache_ttl, seen):
+        u"""
+        Create a device from a raw discovery answer, unless a device with
+        the same mac address has already been seen.
+
+        :param set seen: mac addresses seen so far, updated
+        :return: SmartPlug or SmartBulb and its normalized mac address, or
+                 (None, None)
+        :rtype: tuple
+        """
+        info = Discover._parse_response(protocol, data)
+        if info is None:
+            return None, None
+        return Discover._device_from_info(ip, info, cache_ttl, seen)
+
+    @staticmethod
+    def _device_from_info(ip, info, cache_ttl, seen):
+        u"""
+        Create a device from a parsed discovery answer, unless a device with
+        the same mac address has already been seen. Malformed answers, e.g.
+        ones reporting an error instead of the system information, are
+        logged and skipped.
+
+        :param set seen: mac addresses seen so far, updated
+        :return: SmartPlug or SmartBulb and its normalized mac address, or
+                 (None, None)
+        :rtype: tuple
+        """
+        try:
+            device = Discover._make_device(ip, info, cache_ttl)
+            if device is None:
+                return None, None
+            mac = Discover._mac(info) or ip
+        except (SmartDeviceException, TypeError, ValueError, KeyError,
+                AttributeError), ex:
+            _LOGGER.warning(u"Skipping malformed answer from %s: %s", ip, ex)
+            return None, None
+        if mac in seen:
+            return None, None
+        seen.add(mac)
+        return device, mac
+
+    @staticmethod
+    def broadcast_addresses():
+        u"""
+        Returns the broadcast addresses of all local network interfaces,
+        followed by 255.255.255.255.
+
+        Interfaces are enumerated with netifaces when it is installed,
+        otherwise with ioctl() on Linux. Elsewhere only 255.255.255.255 is
+        returned.
+
+        :return: addresses as unicode strings, whichever way they were found
+        :rtype: list
+        """
+        addresses = []
+        for address in Discover._interface_broadcast_addresses():
+            address = unicode(address)
+            if address not in addresses and \
+                    not address.startswith(u"127."):
+                addresses.append(address)
+        addresses.append(u"255.255.255.255")
+        return addresses
+
+    @staticmethod
+    def _interface_broadcast_addresses():
+        try:
+            import netifaces
+        except ImportError:
+            netifaces = None
+
+        if netifaces is not None:
+            addresses = []
+            for interface in netifaces.interfaces():
+                for addr in netifaces.ifaddresses(interface).get(
+                        netifaces.AF_INET, []):
+                    if u"broadcast" in addr:
+                        addresses.append(addr[u"broadcast"])
+            return addresses
+
+        try:
+            import fcntl
+            interfaces = os.listdir(u"/sys/class/net")
+        except (ImportError, OSError):
+            return []
+
+        addresses = []
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for interface in interfaces:
+                request = struct.pack(b"256s", interface[:15].encode(u"ascii"))
+                try:
+                    flags = struct.unpack(b"H", fcntl.ioctl(
+                        sock.fileno(), _SIOCGIFFLAGS, request)[16:18])[0]
+                    if not flags & _IFF_UP or not flags & _IFF_BROADCAST:
+                        continue
+                    address = fcntl.ioctl(sock.fileno(), _SIOCGIFBRDADDR,
+                                          request)[20:24]
+                except IOError:
+                    # no IPv4 address on this interface
+                    continue
+                addresses.append(socket.inet_ntoa(address))
+        finally:
+            sock.close()
+        return addresses
+
+    @staticmethod
+    def _send_offsets(timeout, retries):
+        u"""
+        Times, relative to the start, at which to send the discovery message.
+        The pauses double each time, and after the last message there is at
+        least timeout / 2 ** retries left for the answers.
+        """
+        interval = timeout / 2.0 ** max(retries, 1)
+        return [interval * (2 ** attempt - 1)
+                for attempt in range(retries + 1)]
+
+    @staticmethod
+    def _open_socket():
+        u"""
+        Create the socket used to broadcast the discovery query and to
+        receive the answers.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        return sock
+
+    @staticmethod
+    def _send_probes(sock, protocol, port, targets):
+        u"""
+        Send the discovery query to all targets.
+        """
+        req = json.dumps(Discover.DISCOVERY_QUERY)
+        encrypted_req = protocol.encrypt(req)[4:]
+        for target in targets:
+            _LOGGER.debug(u"Sending discovery to %s:%s", target, port)
+            try:
+                sock.sendto(encrypted_req, (target, port))
+            except socket.error, ex:
+                _LOGGER.debug(u"Unable to send discovery to %s: %s",
+                              target, ex)
+
+    @staticmethod
+    def _parse_response(protocol, data):
+        u"""
+        Decrypt and parse a discovery answer.
+
+        :return: parsed answer or None if it is not valid
+        """
+        try:
+            return json.loads(protocol.decrypt_bytes(data))
         except Exception, ex:
             _LOGGER.error(u"Got exception %s", ex, exc_info=True)
-        return devices
+            return None
+
+    @staticmethod
+    def _make_device(ip, info, cache_ttl, timestamp=None):
+        u"""
+        Create a device from its discovery answer, seeded with the data
+        contained in it.
+
+        :return: SmartPlug, SmartBulb or None for unsupported devices
+        """
+        device_type = Discover._device_type(info)
+        if device_type == u"plug":
+            device = SmartPlug(ip, cache_ttl=cache_ttl)
+        elif device_type == u"bulb":
+            device = SmartBulb(ip, cache_ttl=cache_ttl)
+        else:
+            return None
+
+        if timestamp is None:
+            timestamp = time.time()
+        sysinfo = SmartDevice._process_response(u"system", u"get_sysinfo",
+                                                info)
+        emeter_realtime = None
+        if device.emeter_type in info:
+            try:
+                emeter_realtime = SmartDevice._process_response(
+                    device.emeter_type, u"get_realtime", info)
+            except SmartDeviceException:
+                # not all devices have an energy meter
+                pass
+        device.seed_cache(sysinfo, emeter_realtime, timestamp)
+        device.discovered_at = timestamp
+        return device
+
+    @staticmethod
+    def _device_type(info):
+        u"""
+        Classify a device by its discovery answer.
+
+        :return: "plug", "bulb" or None for unsupported devices
+        """
+        if u"system" in info and u"get_sysinfo" in info[u"system"]:
+            sysinfo = info[u"system"][u"get_sysinfo"]
+            if u"type" in sysinfo:
+                type = sysinfo[u"type"]
+            elif u"mic_type" in sysinfo:
+                type = sysinfo[u"mic_type"]
+            else:
+                _LOGGER.error(u"Unable to find the device type field!")
+                type = u"UNKNOWN"
+        else:
+            _LOGGER.error(u"No 'system' nor 'get_sysinfo' in response")
+            return None
+        if u"smartplug" in type.lower():
+            return u"plug"
+        elif u"smartbulb" in type.lower():
+            return u"bulb"
+        return None
+
+    @staticmethod
+    def _mac(info):
+        u"""
+        Mac address from a discovery answer, normalized by _normalize_mac.
+        """
+        sysinfo = info[u"system"][u"get_sysinfo"]
+        return Discover._normalize_mac(sysinfo.get(u"mac") or
+                                       sysinfo.get(u"mic_mac") or u"")
+
+    @staticmethod
+    def _normalize_mac(mac):
+        u"""
+        Bring mac addresses into a single format, e.g. 50C7BF0123AB.
+        Plugs report them with colons, bulbs without.
+        """
+        return mac.replace(u":", u"").replace(u"-", u"").upper()
 
 def main():
     found = Discover.discover()
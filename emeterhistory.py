@@ -0,0 +1,228 @@
+u"""
+Persistent cache of daily and monthly energy statistics.
+
+    history = EmeterHistory("emeter.db")
+    history.backfill([SmartPlug(ip) for ip in addresses])
+    print(history.daily(plug, 2017, 3))
+
+Statistics of completed months and years never change, so once fetched
+they are stored permanently in an SQLite database keyed by the mac address
+of the device, its emeter type, the year and the month (0 for the monthly
+statistics of a whole year). Statistics of the current month or year are
+still growing; they are cached as well, but only for current_ttl seconds.
+
+The mac address is taken from the system information the device already
+holds, e.g. seeded from discovery, or can be passed in, so that stored
+statistics are served without talking to the device at all. The device is
+only queried for statistics missing from the database.
+"""
+from __future__ import absolute_import
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from .discover import Discover
+from .fleet import DeviceFleet
+from .smartdevice import SmartDevice, SmartDeviceException
+
+_LOGGER = logging.getLogger(__name__)
+
+_SCHEMA = u"""
+CREATE TABLE IF NOT EXISTS emeter_stats (
+    mac TEXT NOT NULL,
+    emeter_type TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    stats TEXT NOT NULL,
+    final INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (mac, emeter_type, year, month)
+)
+"""
+
+# month stored for the monthly statistics of a whole year
+_WHOLE_YEAR = 0
+
+
+class EmeterHistory(object):
+    u"""
+    Energy statistics cache stored in an SQLite database.
+    """
+    DEFAULT_CURRENT_TTL = 60
+
+    def __init__(self, path, current_ttl=DEFAULT_CURRENT_TTL):
+        u"""
+        Open or create a statistics cache.
+
+        :param str path: path of the database file, ":memory:" for a
+                         temporary cache
+        :param float current_ttl: seconds the statistics of the current
+                                  month or year are cached
+        """
+        self.path = path
+        self.current_ttl = current_ttl
+        self._lock = threading.Lock()
+        self._macs = {}  # type: Dict[SmartDevice, str]
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(_SCHEMA)
+
+    def close(self):
+        u"""
+        Close the database.
+        """
+        with self._lock:
+            self._db.close()
+
+    def daily(self, device, year=None, month=None, mac=None):
+        u"""
+        Return daily statistics of a device, like get_emeter_daily.
+
+        :param SmartDevice device: device to get the statistics of
+        :param year: year of the statistics (default: this year)
+        :param month: month of the statistics (default: this month)
+        :param str mac: mac address of the device (default: from its
+                        system information)
+        :return: mapping of day of month to value
+                 None if device has no energy meter
+        :rtype: dict
+        :raises SmartDeviceException: on error
+        """
+        now = datetime.datetime.now()
+        if year is None:
+            year = now.year
+        if month is None:
+            month = now.month
+        final = (year, month) < (now.year, now.month)
+        return self._get(device, mac, year, month, final,
+                         lambda: device.get_emeter_daily(year, month))
+
+    def monthly(self, device, year=None, mac=None):
+        u"""
+        Return monthly statistics of a device, like get_emeter_monthly.
+
+        :param SmartDevice device: device to get the statistics of
+        :param year: year of the statistics (default: this year)
+        :param str mac: mac address of the device (default: from its
+                        system information)
+        :return: mapping of month to value
+                 None if device has no energy meter
+        :rtype: dict
+        :raises SmartDeviceException: on error
+        """
+        now = datetime.datetime.now()
+        if year is None:
+            year = now.year
+        final = year < now.year
+        return self._get(device, mac, year, _WHOLE_YEAR, final,
+                         lambda: device.get_emeter_monthly(year))
+
+    def _get(self, device, mac, year, month, final, fetch):
+        key = [self._mac(device, mac), device.emeter_type, year, month]
+        with self._lock:
+            row = self._db.execute(
+                u"SELECT stats, final, fetched_at FROM emeter_stats "
+                u"WHERE mac = ? AND emeter_type = ? AND year = ? "
+                u"AND month = ?", key).fetchone()
+        if row is not None:
+            stats, stored_final, fetched_at = row
+            if stored_final or \
+                    time.time() - fetched_at < self.current_ttl:
+                return dict((int(period), value) for period, value
+                            in json.loads(stats).items())
+
+        stats = fetch()
+        if stats is None:
+            return None
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    u"INSERT OR REPLACE INTO emeter_stats "
+                    u"(mac, emeter_type, year, month, stats, final, "
+                    u"fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    key + [json.dumps(stats), int(final), time.time()])
+        return stats
+
+    def invalidate(self, device=None, mac=None):
+        u"""
+        Drop cached statistics, e.g. after erase_emeter_stats.
+
+        :param SmartDevice device: device to drop the statistics of
+                                   (default: all devices)
+        :param str mac: mac address of the device (default: from its
+                        system information)
+        """
+        with self._lock:
+            with self._db:
+                if device is None:
+                    self._db.execute(u"DELETE FROM emeter_stats")
+                else:
+                    self._db.execute(
+                        u"DELETE FROM emeter_stats WHERE mac = ?",
+                        [self._mac(device, mac)])
+
+    def backfill(self, devices, first_year=None, timeout=None,
+                 max_workers=DeviceFleet.DEFAULT_MAX_WORKERS):
+        u"""
+        Fetch the full statistics history of many devices concurrently.
+
+        For every device the monthly statistics are fetched year by year,
+        going back until a year without any data or first_year, followed
+        by the daily statistics of every month with data. Periods which
+        are already cached are not fetched again, and requests to a single
+        device are made one after another.
+
+        :param devices: SmartDevice instances or a DeviceFleet
+        :param int first_year: earliest year to fetch
+        :param float timeout: overall deadline in seconds
+        :param int max_workers: maximum number of devices talked to at once
+        :return: list of FleetResult in order of completion, with the
+                 number of months with data as result
+        :rtype: List[FleetResult]
+        """
+        if isinstance(devices, DeviceFleet):
+            fleet = devices
+        else:
+            fleet = DeviceFleet(devices, max_workers=max_workers)
+        return fleet.run(self._backfill_device, args=(first_year,),
+                         timeout=timeout)
+
+    def _backfill_device(self, device, first_year):
+        if not device.has_emeter:
+            return 0
+        months = 0
+        year = datetime.datetime.now().year
+        while first_year is None or year >= first_year:
+            monthly = self.monthly(device, year)
+            with_data = sorted(month for month, value in monthly.items()
+                               if value)
+            if not with_data:
+                break
+            for month in with_data:
+                self.daily(device, year, month)
+            months += len(with_data)
+            year -= 1
+        return months
+
+    def _mac(self, device, mac=None):
+        u"""
+        Mac address keying the statistics of a device. Unless given, it is
+        taken from the system information the device already holds, which
+        is only fetched if there is none at all.
+        """
+        if mac is None:
+            mac = self._macs.get(device)
+            if mac is not None:
+                return mac
+            sysinfo = device._capability_sys_info()
+            mac = sysinfo[u"mac"] or sysinfo[u"mic_mac"] or u""
+        normalized = Discover._normalize_mac(mac)
+        if not normalized:
+            raise SmartDeviceException(u"Device %s did not report a mac "
+                                       u"address" % device.ip_address)
+        self._macs[device] = normalized
+        return normalized
@@ -0,0 +1,788 @@
+u"""
+Emulation of many plugs and bulbs on the local machine, for testing and
+load-testing without hardware.
+
+    with Emulator(make_devices(plugs=500, bulbs=500,
+                               profile=PROFILES[u"wifi"])) as emulator:
+        devices = Discover.discover(targets=[u"127.255.255.255"])
+        SmartPlug(u"127.0.1.1").state
+
+or as a standalone server::
+
+    python -m tplink.emulator --plugs 1000 --bulbs 1000 --profile wifi
+
+Every virtual device has its own loopback address (127.0.1.1, 127.0.1.2,
+...) and answers the encrypted protocol on TCP and discovery messages on
+UDP, with sysinfo, light state and energy meter answers modelled on
+HS110 plugs and LB130 bulbs. Network behaviour is set per device by a
+Profile: latency, jitter, lost answers, limited bandwidth and devices
+sending a zero length header.
+
+All devices are served by a single thread driven by epoll (or poll/
+select). TCP connections are accepted on one listening socket and routed
+by the address they were made to. Each device has a UDP socket bound to
+its address; a further UDP socket bound to all addresses receives
+broadcasts, which all devices answer, each after its own latency and
+jitter; with little jitter a burst of answers can overflow the receive
+buffer of the client, just like on a real network. Serving thousands of
+devices needs as many file descriptors, the standalone server raises its
+limit as far as allowed.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import datetime
+import errno
+import heapq
+import json
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from .multiplex import Poller
+from .protocol import TPLinkSmartHomeProtocol
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Profile(object):
+    u"""
+    Network behaviour of a virtual device.
+    """
+
+    def __init__(self,
+                 latency=0.0,
+                 jitter=0.0,
+                 loss=0.0,
+                 bandwidth=None,
+                 zero_length=False):
+        u"""
+        :param float latency: seconds before an answer is sent
+        :param float jitter: maximum random seconds added to the latency
+        :param float loss: probability of an answer never being sent
+        :param int bandwidth: bytes per second an answer is sent with,
+                              None for unlimited
+        :param bool zero_length: send 0 as length header and close the
+                                 connection after the answer, like some
+                                 firmware versions do
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.bandwidth = bandwidth
+        self.zero_length = zero_length
+
+    def __repr__(self):
+        return u"<Profile latency=%s jitter=%s loss=%s bandwidth=%s " \
+               u"zero_length=%s>" % (self.latency, self.jitter, self.loss,
+                                     self.bandwidth, self.zero_length)
+
+
+PROFILES = {
+    u"ideal": Profile(),
+    u"lan": Profile(latency=0.005, jitter=0.002),
+    u"wifi": Profile(latency=0.03, jitter=0.05, loss=0.01),
+    u"flaky": Profile(latency=0.1, jitter=0.4, loss=0.1),
+    u"slow": Profile(latency=0.5, jitter=0.5, bandwidth=2048),
+    u"zero_length": Profile(latency=0.005, zero_length=True),
+}
+
+
+class VirtualDevice(object):
+    u"""
+    State and command handling of an emulated device.
+
+    Subclasses register their commands in `commands`, a mapping of
+    (target, command) to a method taking the command argument and
+    returning the answer without err_code.
+    """
+
+    def __init__(self, ip_address, index=0, profile=None, seed=None):
+        u"""
+        :param str ip_address: address the device is served on
+        :param int index: number of the device, used for its mac and alias
+        :param Profile profile: network behaviour (default: ideal)
+        :param seed: seed of the random energy readings
+        """
+        self.ip_address = ip_address
+        self.index = index
+        self.profile = profile or PROFILES[u"ideal"]
+        self.random = random.Random(seed if seed is not None else index)
+        self.requests = 0
+        self.created_at = time.time()
+        self.commands = {
+            (u"system", u"get_sysinfo"): self.get_sysinfo,
+            (u"system", u"set_dev_alias"): self.set_dev_alias,
+            (u"system", u"set_mac_addr"): self.set_mac_addr,
+            (u"time", u"get_time"): self.get_time,
+            (u"time", u"get_timezone"): self.get_timezone,
+        }  # type: Dict[Any, Callable]
+        self.sysinfo = {}  # type: Dict[str, Any]
+
+    def __repr__(self):
+        return u"<%s at %s>" % (type(self).__name__, self.ip_address)
+
+    def mac(self, separator=u":"):
+        octets = [0x50, 0xC7, 0xBF, (self.index >> 16) & 0xff,
+                  (self.index >> 8) & 0xff, self.index & 0xff]
+        return separator.join(u"%02X" % octet for octet in octets)
+
+    def handle(self, request):
+        u"""
+        Answer a decoded request. Malformed requests and commands are
+        answered with an err_code, like real devices do.
+
+        :param dict request: request as sent by TPLinkSmartHomeProtocol
+        :return: answer to be encoded
+        :rtype: dict
+        """
+        self.requests += 1
+        if not isinstance(request, dict):
+            return {u"err_code": -1, u"err_msg": u"invalid request"}
+        response = {}
+        for target, commands in request.items():
+            if target == u"context":
+                continue
+            if not any(known == target for known, _ in self.commands):
+                response[target] = {u"err_code": -1,
+                                    u"err_msg": u"module not support"}
+                continue
+            if not isinstance(commands, (dict, type(None))):
+                response[target] = {u"err_code": -1,
+                                    u"err_msg": u"invalid request"}
+                continue
+            response[target] = {}
+            for command, argument in (commands or {}).items():
+                method = self.commands.get((target, command))
+                if method is None:
+                    response[target][command] = {
+                        u"err_code": -2, u"err_msg": u"member not support"}
+                    continue
+                try:
+                    answer = dict(method(argument))
+                except Exception, ex:
+                    _LOGGER.debug(u"Invalid argument to %s.%s of %s: %r",
+                                  target, command, self, ex)
+                    response[target][command] = {
+                        u"err_code": -3, u"err_msg": u"invalid argument"}
+                    continue
+                answer[u"err_code"] = 0
+                response[target][command] = answer
+        return response
+
+    def get_sysinfo(self, argument):
+        return self.sysinfo
+
+    def set_dev_alias(self, argument):
+        self.sysinfo[u"alias"] = argument[u"alias"]
+        return {}
+
+    def set_mac_addr(self, argument):
+        return {}
+
+    def get_time(self, argument):
+        now = datetime.datetime.now()
+        return {u"year": now.year, u"month": now.month, u"mday": now.day,
+                u"hour": now.hour, u"min": now.minute, u"sec": now.second}
+
+    def get_timezone(self, argument):
+        return {u"index": 39}
+
+    def power(self):
+        u"""
+        Current power draw in W.
+        """
+        return 0.0
+
+    def _energy(self, year, month, day=None):
+        u"""
+        Deterministic energy in kWh used on a day, or in a whole month.
+        """
+        if day is None:
+            days = (datetime.date(year + month // 12, month % 12 + 1, 1) -
+                    datetime.date(year, month, 1)).days
+            return sum(self._energy(year, month, day)
+                       for day in range(1, days + 1))
+        daily = random.Random(u"%s-%d-%d-%d" % (self.mac(), year, month, day))
+        return round(daily.uniform(0.1, 0.5) * self.nominal_power() / 10.0,
+                     3)
+
+    def nominal_power(self):
+        return 0.0
+
+    def _days(self, year, month):
+        u"""
+        Days of a month on which energy was recorded: none in the future
+        and none more than two years back.
+        """
+        today = datetime.date.today()
+        if (year, month) > (today.year, today.month) or \
+                year < today.year - 2:
+            return []
+        if (year, month) == (today.year, today.month):
+            return range(1, today.day + 1)
+        days = (datetime.date(year + month // 12, month % 12 + 1, 1) -
+                datetime.date(year, month, 1)).days
+        return range(1, days + 1)
+
+    def daystat(self, argument, key, factor):
+        year, month = argument[u"year"], argument[u"month"]
+        return {u"day_list": [
+            {u"year": year, u"month": month, u"day": day,
+             key: self._energy(year, month, day) * factor}
+            for day in self._days(year, month)]}
+
+    def monthstat(self, argument, key, factor):
+        year = argument[u"year"]
+        months = []
+        for month in range(1, 13):
+            days = self._days(year, month)
+            if days:
+                energy = sum(self._energy(year, month, day) for day in days)
+                months.append({u"year": year, u"month": month,
+                               key: energy * factor})
+        return {u"month_list": months}
+
+    def total(self):
+        u"""
+        Energy in kWh used since the device was created.
+        """
+        return self.nominal_power() * (time.time() - self.created_at) / 3.6e6
+
+
+class VirtualPlug(VirtualDevice):
+    u"""
+    Emulated HS110 plug with energy meter.
+    """
+
+    def __init__(self, ip_address, index=0, profile=None, seed=None,
+                 emeter=True):
+        u"""
+        :param bool emeter: whether the plug has an energy meter (HS110)
+                            or not (HS100)
+        """
+        super(VirtualPlug, self).__init__(ip_address, index, profile, seed)
+        self.load = self.random.choice((5.0, 40.0, 60.0, 800.0, 2000.0))
+        self.on_since = time.time()
+        self.sysinfo = {
+            u"sw_ver": u"1.2.5 Build 171213 Rel.101523",
+            u"hw_ver": u"1.0",
+            u"type": u"IOT.SMARTPLUGSWITCH",
+            u"model": u"HS110(EU)" if emeter else u"HS100(EU)",
+            u"mac": self.mac(),
+            u"deviceId": u"8006%036X" % index,
+            u"hwId": u"45E29DA8382494D2E82688B52A0B2EB5",
+            u"fwId": u"00000000000000000000000000000000",
+            u"oemId": u"3D341ECE302C0642C99E31CE2430544B",
+            u"alias": u"plug %d" % index,
+            u"dev_name": u"Wi-Fi Smart Plug With Energy Monitoring",
+            u"icon_hash": u"",
+            u"relay_state": 1,
+            u"on_time": 0,
+            u"active_mode": u"schedule",
+            u"feature": u"TIM:ENE" if emeter else u"TIM",
+            u"updating": 0,
+            u"rssi": -40 - index % 40,
+            u"led_off": 0,
+            u"latitude": 52.37 + (index % 100) / 1000.0,
+            u"longitude": 4.89,
+        }
+        self.commands.update({
+            (u"system", u"set_relay_state"): self.set_relay_state,
+            (u"system", u"set_led_off"): self.set_led_off,
+        })
+        if emeter:
+            self.commands.update({
+                (u"emeter", u"get_realtime"): self.get_realtime,
+                (u"emeter", u"get_daystat"):
+                    lambda argument: self.daystat(argument, u"energy", 1.0),
+                (u"emeter", u"get_monthstat"):
+                    lambda argument: self.monthstat(argument, u"energy", 1.0),
+                (u"emeter", u"erase_emeter_stat"): lambda argument: {},
+            })
+
+    def get_sysinfo(self, argument):
+        if self.sysinfo[u"relay_state"]:
+            self.sysinfo[u"on_time"] = int(time.time() - self.on_since)
+        else:
+            self.sysinfo[u"on_time"] = 0
+        return self.sysinfo
+
+    def set_relay_state(self, argument):
+        state = int(argument[u"state"])
+        if state and not self.sysinfo[u"relay_state"]:
+            self.on_since = time.time()
+        self.sysinfo[u"relay_state"] = state
+        return {}
+
+    def set_led_off(self, argument):
+        self.sysinfo[u"led_off"] = int(argument[u"off"])
+        return {}
+
+    def nominal_power(self):
+        return self.load
+
+    def power(self):
+        if not self.sysinfo[u"relay_state"]:
+            return 0.0
+        return self.load * self.random.uniform(0.95, 1.05)
+
+    def get_realtime(self, argument):
+        power = self.power()
+        voltage = self.random.uniform(228.0, 232.0)
+        return {u"power": power, u"voltage": voltage,
+                u"current": power / voltage, u"total": self.total()}
+
+
+class VirtualBulb(VirtualDevice):
+    u"""
+    Emulated LB130 (color), LB120 (tunable white) or LB100 (dimmable) bulb.
+    """
+    LIGHT_SERVICE = u"smartlife.iot.smartbulb.lightingservice"
+    EMETER = u"smartlife.iot.common.emeter"
+
+    def __init__(self, ip_address, index=0, profile=None, seed=None,
+                 color=True, variable_color_temp=True):
+        super(VirtualBulb, self).__init__(ip_address, index, profile, seed)
+        if color:
+            model = u"LB130(EU)"
+        elif variable_color_temp:
+            model = u"LB120(EU)"
+        else:
+            model = u"LB100(EU)"
+        self.light_state = {u"on_off": 1, u"mode": u"normal", u"hue": 0,
+                            u"saturation": 0, u"color_temp": 2700,
+                            u"brightness": 100}
+        self.default_state = dict(self.light_state)
+        del self.default_state[u"on_off"]
+        self.sysinfo = {
+            u"sw_ver": u"1.8.6 Build 180809 Rel.091659",
+            u"hw_ver": u"1.0",
+            u"model": model,
+            u"description": u"Smart Wi-Fi LED Bulb",
+            u"alias": u"bulb %d" % index,
+            u"mic_type": u"IOT.SMARTBULB",
+            u"dev_state": u"normal",
+            u"mic_mac": self.mac(u""),
+            u"deviceId": u"8012%036X" % index,
+            u"oemId": u"D5C424D3C480911A1C5B2D2B7B4A8F93",
+            u"hwId": u"111E35908497A05512E259BB76801E10",
+            u"is_factory": False,
+            u"disco_ver": u"1.0",
+            u"ctrl_protocols": {u"name": u"Linkie", u"version": u"1.0"},
+            u"is_dimmable": 1,
+            u"is_color": int(color),
+            u"is_variable_color_temp": int(color or variable_color_temp),
+            u"preferred_state": [],
+            u"rssi": -40 - index % 40,
+            u"active_mode": u"none",
+            u"heapsize": 334532,
+            u"latitude_i": 523700 + index % 100,
+            u"longitude_i": 48900,
+        }
+        self.commands.update({
+            (VirtualBulb.LIGHT_SERVICE, u"get_light_state"):
+                lambda argument: self._light_state(),
+            (VirtualBulb.LIGHT_SERVICE, u"transition_light_state"):
+                self.transition_light_state,
+            (VirtualBulb.EMETER, u"get_realtime"):
+                lambda argument: {u"power_mw": int(self.power() * 1000)},
+            (VirtualBulb.EMETER, u"get_daystat"):
+                lambda argument: self.daystat(argument, u"energy_wh", 1000),
+            (VirtualBulb.EMETER, u"get_monthstat"):
+                lambda argument: self.monthstat(argument, u"energy_wh", 1000),
+            (VirtualBulb.EMETER, u"erase_emeter_stat"): lambda argument: {},
+        })
+
+    def get_sysinfo(self, argument):
+        self.sysinfo[u"light_state"] = self._light_state()
+        return self.sysinfo
+
+    def _light_state(self):
+        if self.light_state[u"on_off"]:
+            return dict(self.light_state)
+        return {u"on_off": 0, u"dft_on_state": dict(self.default_state)}
+
+    def transition_light_state(self, argument):
+        for key, value in argument.items():
+            if key in self.light_state:
+                self.light_state[key] = value
+                if key != u"on_off":
+                    self.default_state[key] = value
+        return self._light_state()
+
+    def nominal_power(self):
+        return 10.0
+
+    def power(self):
+        if not self.light_state[u"on_off"]:
+            return 0.0
+        return 1.0 + 9.0 * self.light_state[u"brightness"] / 100.0
+
+
+def make_devices(plugs=0, bulbs=0, first_address=u"127.0.1.1", profile=None,
+                 seed=None):
+    u"""
+    Create virtual plugs and bulbs on consecutive addresses.
+
+    :param int plugs: number of HS110 plugs
+    :param int bulbs: number of LB130 bulbs
+    :param str first_address: address of the first device
+    :param Profile profile: network behaviour of all devices
+    :param seed: seed for the random energy readings
+    :rtype: list
+    """
+    first = struct.unpack(u"!I", socket.inet_aton(first_address))[0]
+    devices = []
+    for index in range(plugs + bulbs):
+        address = socket.inet_ntoa(struct.pack(u"!I", first + index))
+        device_seed = None if seed is None else u"%s-%d" % (seed, index)
+        if index < plugs:
+            devices.append(VirtualPlug(address, index, profile, device_seed))
+        else:
+            devices.append(VirtualBulb(address, index, profile, device_seed))
+    return devices
+
+
+class _Connection(object):
+    u"""
+    State of a TCP connection to a virtual device.
+    """
+
+    def __init__(self, sock, device):
+        self.sock = sock
+        self.device = device
+        self.received = bytearray()
+        self.outgoing = bytearray()
+        self.pending = 0
+        self.close_when_sent = False
+        self.closed = False
+
+
+class Emulator(object):
+    u"""
+    Server for a set of virtual devices.
+    """
+    DEFAULT_PORT = 9999
+
+    def __init__(self,
+                 devices,
+                 port=DEFAULT_PORT,
+                 udp=True,
+                 seed=None):
+        u"""
+        :param devices: VirtualDevice instances to serve
+        :param int port: TCP and UDP port, 0 to pick a free one
+        :param bool udp: whether to answer discovery messages
+        :param seed: seed of the packet loss and jitter decisions
+        """
+        self.devices = dict((device.ip_address, device)
+                            for device in devices)
+        self.port = port
+        self.udp = udp
+        self.random = random.Random(seed)
+        self._poller = None  # type: Optional[Poller]
+        self._handlers = {}  # type: Dict[int, Callable]
+        self._timers = []  # type: List
+        self._sequence = 0
+        self._sockets = []  # type: List[socket.socket]
+        self._udp_sockets = {}  # type: Dict[str, socket.socket]
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        u"""
+        Bind the sockets and serve in a background thread.
+        """
+        self._bind()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        u"""
+        Stop serving and close all sockets.
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def serve_forever(self):
+        u"""
+        Bind the sockets and serve in the calling thread until stop() is
+        called from another thread.
+        """
+        self._bind()
+        self._stop.clear()
+        self._run()
+
+    def _bind(self):
+        self._poller = Poller()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((u"", self.port))
+        listener.listen(socket.SOMAXCONN)
+        listener.setblocking(False)
+        self.port = listener.getsockname()[1]
+        self._add(listener, lambda events: self._accept(listener))
+
+        if not self.udp:
+            return
+        broadcast = self._udp_socket(u"")
+        self._add(broadcast,
+                  lambda events: self._receive_datagram(broadcast, None))
+        for address, device in self.devices.items():
+            sock = self._udp_socket(address)
+            self._udp_sockets[address] = sock
+            self._add(sock, lambda events, sock=sock, device=device:
+                      self._receive_datagram(sock, device))
+
+    def _udp_socket(self, address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.bind((address, self.port))
+        sock.setblocking(False)
+        return sock
+
+    def _add(self, sock, handler, events=Poller.READ):
+        self._sockets.append(sock)
+        self._handlers[sock.fileno()] = handler
+        self._poller.register(sock.fileno(), events)
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                timeout = 0.1
+                if self._timers:
+                    timeout = min(timeout, self._timers[0][0] - time.time())
+                for fd, events in self._poller.poll(timeout):
+                    handler = self._handlers.get(fd)
+                    if handler is not None:
+                        handler(events)
+                now = time.time()
+                while self._timers and self._timers[0][0] <= now:
+                    _, _, callback = heapq.heappop(self._timers)
+                    callback()
+        finally:
+            for sock in self._sockets:
+                sock.close()
+            self._sockets = []
+            self._handlers.clear()
+            self._udp_sockets.clear()
+            self._timers = []
+            self._poller.close()
+
+    def _call_later(self, delay, callback):
+        self._sequence += 1
+        heapq.heappush(self._timers,
+                       (time.time() + delay, self._sequence, callback))
+
+    def _delay(self, device):
+        profile = device.profile
+        return profile.latency + self.random.uniform(0, profile.jitter)
+
+    def _lost(self, device):
+        return device.profile.loss and \
+            self.random.random() < device.profile.loss
+
+    def _answer(self, device, data):
+        u"""
+        Decrypt, handle and encrypt a request, None if it is not valid.
+        """
+        try:
+            request = json.loads(TPLinkSmartHomeProtocol.decrypt_bytes(data))
+        except ValueError, ex:
+            _LOGGER.debug(u"Invalid request to %s: %s", device, ex)
+            return None
+        return bytes(TPLinkSmartHomeProtocol.encrypt(
+            json.dumps(device.handle(request))))
+
+    def _accept(self, listener):
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except socket.error, ex:
+                if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                _LOGGER.warning(u"Accepting connection failed: %s", ex)
+                return
+            device = self.devices.get(sock.getsockname()[0])
+            if device is None:
+                sock.close()
+                continue
+            sock.setblocking(False)
+            connection = _Connection(sock, device)
+            self._sockets.append(sock)
+            self._handlers[sock.fileno()] = \
+                lambda events, connection=connection: \
+                self._on_connection(connection, events)
+            self._poller.register(sock.fileno(), Poller.READ)
+
+    def _on_connection(self, connection, events):
+        if events & Poller.READ and not connection.closed:
+            self._read(connection)
+        if events & Poller.WRITE and not connection.closed:
+            self._write(connection)
+
+    def _read(self, connection):
+        try:
+            data = connection.sock.recv(65536)
+        except socket.error, ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b""
+        if not data:
+            self._close(connection)
+            return
+        connection.received.extend(data)
+        while len(connection.received) >= 4:
+            length = struct.unpack(u">I", bytes(connection.received[:4]))[0]
+            if len(connection.received) < 4 + length:
+                break
+            payload = bytes(connection.received[4:4 + length])
+            del connection.received[:4 + length]
+            self._respond(connection, payload)
+
+    def _respond(self, connection, payload):
+        device = connection.device
+        answer = self._answer(device, payload)
+        if answer is None or self._lost(device):
+            # the client waits for an answer until its timeout
+            return
+        profile = device.profile
+        if profile.zero_length:
+            answer = b"\x00\x00\x00\x00" + answer[4:]
+        chunk = len(answer)
+        if profile.bandwidth:
+            # trickle the answer out in 50 ms slices
+            chunk = max(int(profile.bandwidth * 0.05), 1)
+        delay = self._delay(device)
+        for offset in range(0, len(answer), chunk):
+            connection.pending += 1
+            self._call_later(
+                delay + offset / chunk * 0.05,
+                lambda data=answer[offset:offset + chunk],
+                last=offset + chunk >= len(answer):
+                self._queue(connection, data, last and profile.zero_length))
+
+    def _queue(self, connection, data, close):
+        connection.pending -= 1
+        if connection.closed:
+            return
+        connection.outgoing.extend(data)
+        connection.close_when_sent |= close
+        self._poller.modify(connection.sock.fileno(),
+                            Poller.READ | Poller.WRITE)
+
+    def _write(self, connection):
+        if connection.outgoing:
+            try:
+                sent = connection.sock.send(connection.outgoing)
+            except socket.error, ex:
+                if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self._close(connection)
+                return
+            del connection.outgoing[:sent]
+        if not connection.outgoing:
+            if connection.close_when_sent and not connection.pending:
+                self._close(connection)
+                return
+            self._poller.modify(connection.sock.fileno(), Poller.READ)
+
+    def _close(self, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        fd = connection.sock.fileno()
+        self._poller.unregister(fd)
+        del self._handlers[fd]
+        self._sockets.remove(connection.sock)
+        connection.sock.close()
+
+    def _receive_datagram(self, sock, device):
+        try:
+            data, address = sock.recvfrom(65536)
+        except socket.error, ex:
+            if ex.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                _LOGGER.debug(u"Receiving datagram failed: %s", ex)
+            return
+        if device is not None:
+            devices = [device]
+        else:
+            devices = self.devices.values()
+        for device in devices:
+            if self._lost(device):
+                continue
+            answer = self._answer(device, data)
+            if answer is None:
+                continue
+            self._call_later(self._delay(device),
+                             lambda device=device, answer=answer:
+                             self._send_datagram(device, answer[4:], address))
+
+    def _send_datagram(self, device, data, address):
+        sock = self._udp_sockets.get(device.ip_address)
+        if sock is None:
+            return
+        try:
+            sock.sendto(data, address)
+        except socket.error, ex:
+            _LOGGER.debug(u"Sending discovery answer of %s failed: %s",
+                          device, ex)
+
+
+def _raise_file_limit():
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=u"Emulate TP-Link smart plugs and bulbs.")
+    parser.add_argument(u"--plugs", type=int, default=1)
+    parser.add_argument(u"--bulbs", type=int, default=1)
+    parser.add_argument(u"--first-address", default=u"127.0.1.1")
+    parser.add_argument(u"--port", type=int, default=Emulator.DEFAULT_PORT)
+    parser.add_argument(u"--profile", choices=sorted(PROFILES),
+                        default=u"ideal")
+    parser.add_argument(u"--no-udp", action=u"store_true")
+    parser.add_argument(u"--seed")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    _raise_file_limit()
+    devices = make_devices(args.plugs, args.bulbs, args.first_address,
+                           PROFILES[args.profile], args.seed)
+    emulator = Emulator(devices, port=args.port, udp=not args.no_udp,
+                        seed=args.seed)
+    print(u"Serving %d devices from %s on port %d" % (
+        len(devices), args.first_address, args.port))
+    try:
+        emulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == u"__main__":
+    main()
@@ -0,0 +1,287 @@
+u"""
+Concurrent operations on many devices at once.
+
+    fleet = DeviceFleet([SmartPlug(ip) for ip in addresses], max_workers=64)
+    for result in fleet.get_emeter_realtime(timeout=10):
+        if result.exception is None:
+            print(result.device.ip_address, result.result)
+
+Operations run on a bounded pool of worker threads, so a slow device does
+not hold up the others. run() and the shortcuts for common operations wait
+for all devices and return the list of results; iter_run() starts the same
+work right away and yields the results as soon as they are available.
+The optional timeout is an overall deadline for the whole operation;
+devices which have not answered by then are reported with a
+`DeadlineExceeded` error. The deadline applies to the queries the
+operations make, too: none is sent once it has passed, and queries still
+running are given up on. A write sent shortly before the deadline may
+still reach its device though, even if it is reported as failed.
+
+Devices are talked to healthiest first, so that devices whose circuit
+breaker is open, which fail fast anyway, do not hold up workers ahead of
+responsive ones. With skip_unhealthy, they are left out altogether. The
+circuit breakers of devices are off unless the fleet is created with a
+`failure_threshold`, or the devices with a DeviceHealth of their own.
+"""
+from __future__ import absolute_import
+import logging
+import threading
+import time
+from collections import namedtuple
+from Queue import Queue, Empty
+from typing import Any, Callable, Iterator, List, Optional, Union
+
+from .health import DeviceHealth
+from .smartdevice import SmartDevice, DeadlineExceeded, within_deadline
+
+_LOGGER = logging.getLogger(__name__)
+
+FleetResult = namedtuple(u"FleetResult",
+                         [u"device", u"result", u"exception", u"elapsed"])
+
+
+class DeviceFleet(object):
+    u"""
+    Container of devices running operations on all of them concurrently.
+    """
+    DEFAULT_MAX_WORKERS = 32
+
+    def __init__(self,
+                 devices=None,
+                 max_workers=DEFAULT_MAX_WORKERS,
+                 failure_threshold=None):
+        u"""
+        Create a new fleet.
+
+        :param devices: SmartDevice instances to manage
+        :param int max_workers: maximum number of devices talked to at once
+        :param int failure_threshold: if given, set as the failure
+                                      threshold of the circuit breaker of
+                                      every device of the fleet
+        """
+        self.devices = []  # type: List[SmartDevice]
+        self.max_workers = max_workers
+        self.failure_threshold = failure_threshold
+        for device in devices or []:
+            self.add(device)
+
+    def add(self, device):
+        u"""
+        Add a device to the fleet.
+
+        :param SmartDevice device: device to add
+        """
+        if self.failure_threshold is not None:
+            device.health.failure_threshold = self.failure_threshold
+        self.devices.append(device)
+
+    def remove(self, device):
+        u"""
+        Remove a device from the fleet.
+
+        :param SmartDevice device: device to remove
+        :raises ValueError: if the device is not part of the fleet
+        """
+        self.devices.remove(device)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def healthy(self):
+        u"""
+        Devices whose circuit breaker is closed.
+
+        :rtype: List[SmartDevice]
+        """
+        return [device for device in self.devices
+                if device.health.state == DeviceHealth.CLOSED]
+
+    def unhealthy(self):
+        u"""
+        Devices whose circuit breaker is open or half-open, the ones
+        failing longest first.
+
+        :rtype: List[SmartDevice]
+        """
+        return sorted((device for device in self.devices
+                       if device.health.state != DeviceHealth.CLOSED),
+                      key=lambda device: device.health.rank, reverse=True)
+
+    def run(self,
+            operation,
+            args=(),
+            kwargs=None,
+            timeout=None,
+            devices=None,
+            skip_unhealthy=False):
+        u"""
+        Run an operation on all devices concurrently, healthiest first, and
+        wait for it to complete. Takes the same parameters as iter_run().
+
+        :return: list of FleetResult in order of completion, with either
+                 result or exception set
+        :rtype: List[FleetResult]
+        """
+        return list(self.iter_run(operation, args, kwargs, timeout, devices,
+                                  skip_unhealthy))
+
+    def iter_run(self,
+                 operation,
+                 args=(),
+                 kwargs=None,
+                 timeout=None,
+                 devices=None,
+                 skip_unhealthy=False):
+        u"""
+        Start running an operation on all devices concurrently, healthiest
+        first. The operation runs whether or not the results are consumed.
+
+        :param operation: name of the device method to call, or a callable
+                          taking the device as its first argument
+        :param tuple args: positional arguments for the operation
+        :param dict kwargs: keyword arguments for the operation
+        :param float timeout: overall deadline in seconds, None to wait for
+                              all devices
+        :param devices: devices to run the operation on (default: all)
+        :param bool skip_unhealthy: leave out devices whose circuit breaker
+                                    is open; half-open ones are still run
+                                    so that they can recover
+        :return: iterator of FleetResult in order of completion, with
+                 either result or exception set
+        :rtype: Iterator[FleetResult]
+        """
+        if kwargs is None:
+            kwargs = {}
+        if devices is None:
+            devices = self.devices
+        if skip_unhealthy:
+            devices = [device for device in devices
+                       if device.health.state != DeviceHealth.OPEN]
+        devices = list(devices)
+        if not devices:
+            return iter([])
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        tasks = Queue()
+        for index, device in sorted(enumerate(devices),
+                                    key=lambda task: task[1].health.rank):
+            tasks.put((index, device))
+        results = Queue()
+        stop = threading.Event()
+
+        for _ in range(min(self.max_workers, len(devices))):
+            worker = threading.Thread(target=self._work,
+                                      args=(operation, args, kwargs,
+                                            tasks, results, stop, deadline))
+            worker.daemon = True
+            worker.start()
+
+        return self._collect(devices, results, stop, timeout, deadline)
+
+    @staticmethod
+    def _collect(devices, results, stop, timeout, deadline):
+        u"""
+        Yield the results of an operation as they arrive.
+        """
+        pending = set(range(len(devices)))
+        try:
+            while pending:
+                if timeout is None:
+                    index, result = results.get()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        index, result = results.get(timeout=remaining)
+                    except Empty:
+                        break
+                pending.discard(index)
+                yield result
+        finally:
+            stop.set()
+
+        for index in sorted(pending):
+            yield FleetResult(devices[index], None,
+                              DeadlineExceeded(u"Deadline exceeded"),
+                              timeout)
+
+    @staticmethod
+    def _work(operation, args, kwargs, tasks, results, stop, deadline):
+        u"""
+        Worker thread executing the operation for queued devices, with their
+        queries limited to the deadline.
+        """
+        while not stop.is_set():
+            try:
+                index, device = tasks.get_nowait()
+            except Empty:
+                return
+            start = time.time()
+            try:
+                with within_deadline(deadline):
+                    if callable(operation):
+                        value = operation(device, *args, **kwargs)
+                    else:
+                        value = getattr(device, operation)(*args, **kwargs)
+            except Exception, ex:
+                _LOGGER.debug(u"%s failed on %s: %s", operation, device, ex)
+                result = FleetResult(device, None, ex, time.time() - start)
+            else:
+                result = FleetResult(device, value, None, time.time() - start)
+            results.put((index, result))
+
+    def get_sysinfo(self, timeout=None):
+        u"""
+        Retrieve system information of all devices.
+
+        :param float timeout: overall deadline in seconds
+        :rtype: List[FleetResult]
+        """
+        return self.run(u"get_sysinfo", timeout=timeout)
+
+    def get_emeter_realtime(self, timeout=None):
+        u"""
+        Retrieve current energy readings of all devices.
+
+        :param float timeout: overall deadline in seconds
+        :rtype: List[FleetResult]
+        """
+        return self.run(u"get_emeter_realtime", timeout=timeout)
+
+    def turn_on(self, timeout=None):
+        u"""
+        Turn all devices on.
+
+        :param float timeout: overall deadline in seconds
+        :rtype: List[FleetResult]
+        """
+        return self.run(u"turn_on", timeout=timeout)
+
+    def turn_off(self, timeout=None):
+        u"""
+        Turn all devices off.
+
+        :param float timeout: overall deadline in seconds
+        :rtype: List[FleetResult]
+        """
+        return self.run(u"turn_off", timeout=timeout)
+
+    def set_light_state(self, state, timeout=None):
+        u"""
+        Set the light state of all bulbs in the fleet.
+
+        :param dict state: light state to transition to
+        :param float timeout: overall deadline in seconds
+        :rtype: List[FleetResult]
+        """
+        bulbs = [device for device in self.devices
+                 if hasattr(device, u"set_light_state")]
+        return self.run(u"set_light_state", args=(state,), timeout=timeout,
+                        devices=bulbs)
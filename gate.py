@@ -0,0 +1,307 @@
+u"""
+Per-device admission control for queries.
+
+Cheap device firmware does not cope well with several connections at
+once. GatedProtocol wraps another protocol and lets at most
+`max_connections` queries per device through at a time, in the order they
+were made::
+
+    protocol = GatedProtocol(PooledTPLinkSmartHomeProtocol())
+    plugs = [SmartPlug(ip, protocol=protocol) for ip in addresses]
+
+Identical reads (requests made only of get_ commands) to a device which
+are made while one of them is already in flight wait for its answer
+instead of sending another request, so ten threads asking for get_sysinfo
+at once cost a single round trip. Each caller receives its own copy of
+the response. A read never joins one made before a write which is still
+waiting or running, so it always sees the effect of that write. A read
+whose caller gives up on its own deadline is sent again for the callers
+waiting for it, which may still have time left; its new request takes a
+place at the end of the queue.
+
+Hedged reads (SmartDevice(hedge_after=...)) are not sent through a
+GatedProtocol: the duplicate would only share the flight of the read it
+is meant to race.
+
+Writes are never shared and run alone: a write waits for the queries
+admitted before it to finish and holds back the ones made after it, so
+writes reach the device strictly in the order they were made.
+
+The gate only coordinates queries going through the same GatedProtocol
+instance, so it has to be shared between all devices and threads talking
+to the same devices.
+"""
+from __future__ import absolute_import
+import copy
+import json
+import socket
+import threading
+import time
+from collections import deque
+from typing import Dict, Tuple
+
+from . import metrics, tracing
+from .protocol import TPLinkSmartHomeProtocol, _is_read
+
+
+def _wait(condition, deadline):
+    u"""
+    Wait on a condition or event until the deadline, if any.
+
+    :raises socket.timeout: if the deadline has passed
+    """
+    if deadline is None:
+        condition.wait()
+        return
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise socket.timeout(u"Deadline exceeded")
+    condition.wait(remaining)
+
+
+def _earlier(deadline, other):
+    u"""
+    Whether a deadline passes before another one, None being never.
+    """
+    return deadline is not None and (other is None or deadline < other)
+
+
+class HostGate(object):
+    u"""
+    First come, first served admission of queries to a single device.
+    """
+
+    def __init__(self, max_connections=1):
+        u"""
+        :param int max_connections: number of reads admitted at once
+        """
+        self.max_connections = max_connections
+        self.active = 0
+        self.writing = False
+        # number of writes queued so far
+        self.writes = 0
+        self._queue = deque()  # type: deque
+        self._condition = threading.Condition()
+
+    def enter(self, write, deadline=None):
+        u"""
+        Wait until it is the caller's turn. Every successful call must be
+        followed by a call to leave().
+
+        :param bool write: whether the query changes the device
+        :param float deadline: time.time() by which to give up
+        :raises socket.timeout: if the deadline passes while waiting
+        """
+        self.wait(self.join(write), write, deadline)
+
+    def join(self, write):
+        u"""
+        Take a place in the queue, to be waited for with wait().
+
+        :param bool write: whether the query changes the device
+        :return: ticket of the place
+        """
+        ticket = object()
+        with self._condition:
+            if write:
+                self.writes += 1
+            self._queue.append(ticket)
+        return ticket
+
+    def wait(self, ticket, write, deadline=None):
+        u"""
+        Wait until the turn of a ticket taken with join().
+
+        :param ticket: ticket returned by join()
+        :param bool write: whether the query changes the device
+        :param float deadline: time.time() by which to give up
+        :raises socket.timeout: if the deadline passes while waiting
+        """
+        with self._condition:
+            try:
+                while not self._admissible(ticket, write):
+                    _wait(self._condition, deadline)
+            except BaseException:
+                self._queue.remove(ticket)
+                self._condition.notify_all()
+                raise
+            self._queue.popleft()
+            self.active += 1
+            self.writing = write
+            # the next in line may be admitted alongside this one
+            self._condition.notify_all()
+
+    def leave(self):
+        u"""
+        Let the next query in.
+        """
+        with self._condition:
+            self.active -= 1
+            self.writing = False
+            self._condition.notify_all()
+
+    def _admissible(self, ticket, write):
+        if self._queue[0] is not ticket or self.writing:
+            return False
+        if write:
+            return self.active == 0
+        return self.active < self.max_connections
+
+
+class _Flight(object):
+    u"""
+    A read in flight, shared by all callers asking for it meanwhile.
+    """
+
+    def __init__(self, deadline):
+        self.done = threading.Event()
+        self.followers = 0
+        # deadline of the caller sending the read
+        self.deadline = deadline
+        self.response = None
+        self.error = None  # type: Exception
+
+
+class GatedProtocol(object):
+    u"""
+    Protocol wrapper limiting the concurrent queries per device, sharing
+    identical reads in flight and keeping writes in order.
+    """
+    DEFAULT_MAX_CONNECTIONS = 1
+    # tells SmartDevice not to hedge reads, see the module docstring
+    COALESCES_READS = True
+
+    def __init__(self,
+                 protocol=None,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        u"""
+        :param protocol: protocol to send the queries with
+                         (default: TPLinkSmartHomeProtocol)
+        :param int max_connections: maximum number of concurrent queries
+                                    per device
+        """
+        if protocol is None:
+            protocol = TPLinkSmartHomeProtocol()
+        self.protocol = protocol
+        self.max_connections = max_connections
+        self._gates = {}  # type: Dict[Tuple[str, int], HostGate]
+        self._flights = {}  # type: Dict[Tuple[str, int, str, int], _Flight]
+        self._lock = threading.Lock()
+
+    def query(self,
+              host,
+              request,
+              port=TPLinkSmartHomeProtocol.DEFAULT_PORT,
+              deadline=None):
+        u"""
+        Request information from a TP-Link SmartHome Device and return the
+        response, once it is the turn of the request.
+
+        :param str host: ip address of the device
+        :param int port: port on the device (default: 9999)
+        :param request: command to send to the device (can be either dict or
+        json string)
+        :param float deadline: time.time() by which the query must be
+                               complete, raising socket.timeout otherwise
+        :return: parsed json response
+        """
+        if isinstance(request, dict):
+            decoded = request
+            request = json.dumps(request, sort_keys=True)
+        else:
+            decoded = json.loads(request)
+
+        gate = self._gate(host, port)
+        if not _is_read(decoded):
+            with self._lock:
+                ticket = gate.join(True)
+            return self._send(gate, ticket, host, port, request, True,
+                              deadline)
+
+        with self._lock:
+            # reads made after a write never share a flight with the ones
+            # made before it
+            key = (host, port, request, gate.writes)
+            flight = self._flights.get(key)
+            if flight is None:
+                leader = True
+                flight = self._flights[key] = _Flight(deadline)
+                ticket = gate.join(False)
+            else:
+                leader = False
+                flight.followers += 1
+
+        if not leader:
+            return self._follow(host, port, request, flight, deadline)
+
+        try:
+            flight.response = self._send(gate, ticket, host, port, request,
+                                         False, deadline, key)
+        except BaseException, ex:
+            flight.error = ex
+            raise
+        finally:
+            flight.done.set()
+
+        if flight.followers:
+            # followers copy the response, it must not change under them
+            return copy.deepcopy(flight.response)
+        return flight.response
+
+    def _send(self, gate, ticket, host, port, request, write, deadline,
+              key=None):
+        u"""
+        Send a request through the gate of its device, once its ticket is
+        due. The flight of a read is ended before the gate is left, so that
+        a read made after a write never receives an answer from before it.
+        """
+        try:
+            gate.wait(ticket, write, deadline)
+        except BaseException:
+            if key is not None:
+                with self._lock:
+                    del self._flights[key]
+            raise
+        try:
+            if deadline is None:
+                return self.protocol.query(host=host, request=request,
+                                           port=port)
+            return self.protocol.query(host=host, request=request, port=port,
+                                       deadline=deadline)
+        finally:
+            if key is not None:
+                with self._lock:
+                    del self._flights[key]
+            gate.leave()
+
+    def _follow(self, host, port, request, flight, deadline):
+        u"""
+        Wait for the answer to a read already in flight. The read is sent
+        again if it timed out on a deadline earlier than the caller's.
+        """
+        if metrics.ENABLED:
+            metrics.COALESCED.inc((host,))
+        span = tracing.current_span()
+        if span is not None and span.kind == tracing.ROUND_TRIP:
+            span.attributes[u"coalesced"] = True
+        while not flight.done.is_set():
+            _wait(flight.done, deadline)
+        if flight.error is None:
+            return copy.deepcopy(flight.response)
+        if isinstance(flight.error, socket.timeout) and \
+                _earlier(flight.deadline, deadline):
+            if span is not None and span.kind == tracing.ROUND_TRIP:
+                del span.attributes[u"coalesced"]
+            return self.query(host, request, port, deadline)
+        raise flight.error
+
+    def _gate(self, host, port):
+        with self._lock:
+            gate = self._gates.get((host, port))
+            if gate is None:
+                gate = self._gates[(host, port)] = HostGate(
+                    self.max_connections)
+            return gate
+
+    def __getattr__(self, name):
+        return getattr(self.protocol, name)
@@ -0,0 +1,195 @@
+u"""
+Health tracking and circuit breaking of single devices.
+
+Every SmartDevice keeps a DeviceHealth recording the outcome of its
+queries: consecutive failures, time of the last success and failure, and
+an exponentially weighted moving average of the round trip latency.
+
+A query counts as one failure when it could not reach the device, after
+all of its retries. The circuit breaker is off by default, health is only
+tracked. With a `failure_threshold`, the breaker opens after that many
+consecutive failures, and queries fail fast with a CircuitOpen error
+instead of waiting for the socket timeouts again. Once `reset_timeout`
+seconds have passed, the breaker is half-open: a single query is let
+through as a probe. If it succeeds the breaker closes, otherwise it stays
+open for another `reset_timeout`.
+
+    plug = SmartPlug(ip, health=DeviceHealth(failure_threshold=2,
+                                             reset_timeout=60))
+    ...
+    if plug.health.state != DeviceHealth.CLOSED:
+        print(plug.health)
+"""
+from __future__ import absolute_import
+import threading
+import time
+from typing import Optional
+
+
+class DeviceHealth(object):
+    u"""
+    Health and circuit breaker state of a device.
+    """
+    CLOSED = u"closed"
+    HALF_OPEN = u"half_open"
+    OPEN = u"open"
+
+    # no circuit breaking unless asked for
+    DEFAULT_FAILURE_THRESHOLD = None
+    DEFAULT_RESET_TIMEOUT = 30.0
+    DEFAULT_LATENCY_WEIGHT = 0.2
+
+    # states in the order devices are best talked to
+    RANKS = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 latency_weight=DEFAULT_LATENCY_WEIGHT):
+        u"""
+        :param int failure_threshold: consecutive failures opening the
+                                      breaker, None to only track health
+                                      (default)
+        :param float reset_timeout: seconds the breaker stays open before
+                                    a probe is let through
+        :param float latency_weight: weight of a new latency in the moving
+                                     average, between 0 and 1
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency_weight = latency_weight
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_success = None  # type: Optional[float]
+        self.last_failure = None  # type: Optional[float]
+        self.latency = None  # type: Optional[float]
+        self.opened_at = None  # type: Optional[float]
+        self._probe_started = None  # type: Optional[float]
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return u"<DeviceHealth %s failures=%s/%s latency=%s>" % (
+            self.state, self.consecutive_failures, self.failures,
+            u"%.1f ms" % (self.latency * 1000)
+            if self.latency is not None else None)
+
+    @property
+    def state(self):
+        u"""
+        State of the circuit breaker: CLOSED, HALF_OPEN or OPEN.
+
+        :rtype: str
+        """
+        with self._lock:
+            return self._state(time.time())
+
+    def _state(self, now):
+        if self.opened_at is None:
+            return DeviceHealth.CLOSED
+        if self._probe_started is not None or \
+                now - self.opened_at >= self.reset_timeout:
+            return DeviceHealth.HALF_OPEN
+        return DeviceHealth.OPEN
+
+    @property
+    def rank(self):
+        u"""
+        Sort key putting healthy devices first.
+
+        :rtype: tuple
+        """
+        return DeviceHealth.RANKS[self.state], self.consecutive_failures
+
+    def retry_after(self):
+        u"""
+        Seconds until the breaker lets the next query through, 0 if it does
+        now.
+
+        :rtype: float
+        """
+        with self._lock:
+            now = time.time()
+            if self.opened_at is None:
+                return 0.0
+            start = self.opened_at
+            if self._probe_started is not None:
+                start = max(start, self._probe_started)
+            return max(start + self.reset_timeout - now, 0.0)
+
+    def acquire(self):
+        u"""
+        Ask whether a query may be sent to the device. While the breaker is
+        half-open, only one caller is allowed to probe the device; a probe
+        not reporting back within `reset_timeout` is given up on.
+
+        :return: True if the query may be sent
+        :rtype: bool
+        """
+        if self.opened_at is None:
+            return True
+        with self._lock:
+            now = time.time()
+            if self.opened_at is None:
+                return True
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            if self._probe_started is not None and \
+                    now - self._probe_started < self.reset_timeout:
+                return False
+            self._probe_started = now
+            return True
+
+    def record_success(self, latency):
+        u"""
+        Record a query the device answered.
+
+        :param float latency: seconds the round trip took
+        :return: True if this closed the breaker
+        :rtype: bool
+        """
+        with self._lock:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.last_success = time.time()
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.latency_weight * (latency - self.latency)
+            recovered = self.opened_at is not None
+            self.opened_at = None
+            self._probe_started = None
+            return recovered
+
+    def record_failure(self):
+        u"""
+        Record a query which failed to reach the device.
+
+        :return: True if this opened the breaker
+        :rtype: bool
+        """
+        with self._lock:
+            now = time.time()
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_failure = now
+            if self.opened_at is not None:
+                # a failed probe keeps the breaker open for another period
+                self.opened_at = now
+                self._probe_started = None
+                return False
+            if self.failure_threshold is not None and \
+                    self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = now
+                return True
+            return False
+
+    def reset(self):
+        u"""
+        Close the breaker and forget the consecutive failures, e.g. after
+        the device has been seen again by discovery.
+        """
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._probe_started = None
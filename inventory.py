@@ -0,0 +1,336 @@
+u"""
+Persistent inventory of known devices, to skip discovery on start-up.
+
+    inventory = DeviceInventory("devices.db")
+    if not len(inventory):
+        found = Discover.discover(timeout=2, cache_ttl=60)
+        inventory.record_all(found.values())
+    devices = inventory.load()
+
+Devices are stored in an SQLite database keyed by their mac address,
+together with their ip address, class, model, features, capabilities and
+firmware versions. Devices created by load() notice when their address
+stops answering and look for the device in the background, updating both
+the inventory and the device once it has been found at its new address.
+"""
+from __future__ import absolute_import
+import json
+import logging
+import sqlite3
+import threading
+import time
+import weakref
+from typing import Any, Dict, List, Optional
+
+from .discover import Discover
+from .health import DeviceHealth
+from .protocol import TPLinkSmartHomeProtocol
+from .smartbulb import SmartBulb
+from .smartdevice import SmartDevice
+from .smartplug import SmartPlug
+
+_LOGGER = logging.getLogger(__name__)
+
+DEVICE_CLASSES = {
+    u"SmartPlug": SmartPlug,
+    u"SmartBulb": SmartBulb,
+}
+
+_SCHEMA = u"""
+CREATE TABLE IF NOT EXISTS devices (
+    mac TEXT PRIMARY KEY,
+    ip_address TEXT NOT NULL,
+    device_class TEXT NOT NULL,
+    model TEXT,
+    alias TEXT,
+    feature TEXT,
+    is_color INTEGER,
+    is_dimmable INTEGER,
+    is_variable_color_temp INTEGER,
+    sw_ver TEXT,
+    hw_ver TEXT,
+    sysinfo TEXT,
+    updated_at REAL NOT NULL
+)
+"""
+
+_COLUMNS = (u"mac", u"ip_address", u"device_class", u"model", u"alias",
+            u"feature", u"is_color", u"is_dimmable",
+            u"is_variable_color_temp", u"sw_ver", u"hw_ver", u"sysinfo",
+            u"updated_at")
+
+_SELECT = u"SELECT %s FROM devices" % u", ".join(_COLUMNS)
+
+
+class DeviceInventory(object):
+    u"""
+    Device inventory stored in an SQLite database.
+    """
+    DEFAULT_REVALIDATION_TIMEOUT = 2
+
+    def __init__(self,
+                 path,
+                 protocol=None,
+                 cache_ttl=0,
+                 revalidation_timeout=DEFAULT_REVALIDATION_TIMEOUT,
+                 failure_threshold=None):
+        u"""
+        Open or create an inventory.
+
+        :param str path: path of the database file, ":memory:" for a
+                         temporary inventory
+        :param protocol: protocol used by the devices created by load()
+                         (default: TPLinkSmartHomeProtocol)
+        :param cache_ttl: cache_ttl of the devices created by load()
+        :param float revalidation_timeout: how long to look for a device
+                                           which stopped answering
+        :param int failure_threshold: failure threshold of the circuit
+                                      breakers of the devices created by
+                                      load() (default: no circuit breaking)
+        """
+        self.path = path
+        self.protocol = protocol or TPLinkSmartHomeProtocol()
+        self.cache_ttl = cache_ttl
+        self.revalidation_timeout = revalidation_timeout
+        self.failure_threshold = failure_threshold
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(_SCHEMA)
+        self._devices = weakref.WeakValueDictionary()
+        self._revalidating = set()
+
+    def close(self):
+        u"""
+        Close the database.
+        """
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                u"SELECT COUNT(*) FROM devices").fetchone()[0]
+
+    def record(self, device, sysinfo=None):
+        u"""
+        Add a device to the inventory or update its entry.
+
+        :param SmartDevice device: device to record
+        :param dict sysinfo: its system information (default: read from
+                             the device, which may use its cache)
+        :return: mac address the device was recorded under
+        :rtype: str
+        """
+        if sysinfo is None:
+            sysinfo = device.sys_info
+        mac = Discover._normalize_mac(sysinfo.get(u"mac") or
+                                      sysinfo.get(u"mic_mac") or u"")
+        if not mac:
+            raise ValueError(u"Device %s did not report a mac address"
+                             % device.ip_address)
+
+        row = {
+            u"mac": mac,
+            u"ip_address": device.ip_address,
+            u"device_class": type(device).__name__,
+            u"model": sysinfo.get(u"model"),
+            u"alias": sysinfo.get(u"alias"),
+            u"feature": sysinfo.get(u"feature"),
+            u"is_color": sysinfo.get(u"is_color"),
+            u"is_dimmable": sysinfo.get(u"is_dimmable"),
+            u"is_variable_color_temp": sysinfo.get(u"is_variable_color_temp"),
+            u"sw_ver": sysinfo.get(u"sw_ver"),
+            u"hw_ver": sysinfo.get(u"hw_ver"),
+            u"sysinfo": json.dumps(sysinfo),
+            u"updated_at": time.time(),
+        }
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    u"INSERT OR REPLACE INTO devices (%s) VALUES (%s)" % (
+                        u", ".join(_COLUMNS),
+                        u", ".join(u"?" * len(_COLUMNS))),
+                    [row[column] for column in _COLUMNS])
+        return mac
+
+    def record_all(self, devices):
+        u"""
+        Record several devices, e.g. the result of a discovery.
+
+        Devices which cannot be reached are skipped.
+
+        :param devices: devices to record
+        :return: mac addresses of the recorded devices
+        :rtype: list
+        """
+        macs = []
+        for device in devices:
+            try:
+                macs.append(self.record(device))
+            except Exception, ex:
+                _LOGGER.warning(u"Unable to record %s: %s",
+                                device.ip_address, ex)
+        return macs
+
+    def remove(self, mac):
+        u"""
+        Remove a device from the inventory.
+
+        :param str mac: mac address of the device
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute(u"DELETE FROM devices WHERE mac = ?",
+                                 [Discover._normalize_mac(mac)])
+
+    def get(self, mac):
+        u"""
+        Return the stored entry of a device.
+
+        :param str mac: mac address of the device
+        :return: entry with the stored columns, sysinfo decoded, or None
+        :rtype: dict
+        """
+        with self._lock:
+            row = self._db.execute(_SELECT + u" WHERE mac = ?",
+                                   [Discover._normalize_mac(mac)]).fetchone()
+        return self._entry(row) if row is not None else None
+
+    def entries(self):
+        u"""
+        Return all stored entries.
+
+        :rtype: list
+        """
+        with self._lock:
+            rows = self._db.execute(
+                _SELECT + u" ORDER BY mac").fetchall()
+        return [self._entry(row) for row in rows]
+
+    def load(self):
+        u"""
+        Create devices for all entries of the inventory, without talking to
+        them.
+
+        :return: mapping of mac address to device
+        :rtype: dict
+        """
+        devices = {}
+        for entry in self.entries():
+            device = self._make_device(entry)
+            if device is not None:
+                devices[entry[u"mac"]] = device
+        return devices
+
+    def device(self, mac):
+        u"""
+        Create the device with the given mac address.
+
+        :param str mac: mac address of the device
+        :return: SmartPlug or SmartBulb, None if it is unknown
+        """
+        entry = self.get(mac)
+        if entry is None:
+            return None
+        return self._make_device(entry)
+
+    def revalidate(self, mac):
+        u"""
+        Look for a device on the network and update its entry and the
+        device created for it with its current address.
+
+        :param str mac: mac address of the device
+        :return: the current ip address, None if the device was not found
+        """
+        mac = Discover._normalize_mac(mac)
+        # keep the system information from the discovery answer
+        for device in Discover.discover_iter(
+                timeout=self.revalidation_timeout, macs=[mac],
+                cache_ttl=None):
+            sysinfo = device.sys_info
+            if Discover._normalize_mac(sysinfo.get(u"mac") or
+                                       sysinfo.get(u"mic_mac") or
+                                       u"") != mac:
+                continue
+            self.record(device, sysinfo)
+            known = self._devices.get(mac)
+            if known is not None:
+                if known.ip_address != device.ip_address:
+                    _LOGGER.info(u"Device %s moved from %s to %s", mac,
+                                 known.ip_address, device.ip_address)
+                    known.ip_address = device.ip_address
+                # the device answered, no need to wait for the breaker
+                known.health.reset()
+            return device.ip_address
+
+        _LOGGER.debug(u"Device %s not found", mac)
+        return None
+
+    def _revalidate_in_background(self, mac):
+        u"""
+        Start revalidation of a device, unless it is already running.
+        """
+        with self._lock:
+            if mac in self._revalidating:
+                return
+            self._revalidating.add(mac)
+
+        def run():
+            try:
+                self.revalidate(mac)
+            except Exception, ex:
+                _LOGGER.warning(u"Revalidation of %s failed: %s", mac, ex)
+            finally:
+                with self._lock:
+                    self._revalidating.discard(mac)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def _make_device(self, entry):
+        device_class = DEVICE_CLASSES.get(entry[u"device_class"])
+        if device_class is None:
+            _LOGGER.warning(u"Unknown device class %s for %s",
+                            entry[u"device_class"], entry[u"mac"])
+            return None
+        protocol = _RevalidatingProtocol(self.protocol, self, entry[u"mac"])
+        device = device_class(
+            entry[u"ip_address"], protocol=protocol,
+            cache_ttl=self.cache_ttl,
+            health=DeviceHealth(failure_threshold=self.failure_threshold))
+        if entry[u"sysinfo"] is not None:
+            device.load_capabilities(entry[u"sysinfo"])
+        self._devices[entry[u"mac"]] = device
+        return device
+
+    @staticmethod
+    def _entry(row):
+        entry = dict(zip(_COLUMNS, row))
+        if entry[u"sysinfo"] is not None:
+            entry[u"sysinfo"] = json.loads(entry[u"sysinfo"])
+        return entry
+
+
+class _RevalidatingProtocol(object):
+    u"""
+    Protocol wrapper starting a background revalidation of the device in
+    the inventory when it cannot be reached.
+    """
+
+    def __init__(self, protocol, inventory, mac):
+        self.protocol = protocol
+        self.inventory = inventory
+        self.mac = mac
+
+    def query(self, host, request, **kwargs):
+        try:
+            return self.protocol.query(host=host, request=request, **kwargs)
+        except (IOError, OSError):
+            # socket.error and socket.timeout are IOErrors
+            self.inventory._revalidate_in_background(self.mac)
+            raise
+
+    def __getattr__(self, name):
+        return getattr(self.protocol, name)
@@ -0,0 +1,373 @@
+u"""
+In-process metrics of device queries, rendered in the Prometheus text
+format.
+
+    from tplink import metrics
+    metrics.enable()
+    ...
+    print(metrics.REGISTRY.render())
+
+or served for scraping::
+
+    metrics.start_http_server(9100)
+
+When enabled, TPLinkSmartHomeProtocol.query records per host and per
+(target, cmd) counts and latency histograms, broken down into the connect,
+send, first byte, receive, decrypt and decode phases, together with the
+bytes sent and received and failures by kind. SmartDevice counts the
+SmartDeviceExceptions raised from its queries, GatedProtocol the reads
+sharing a round trip already in flight.
+
+Metrics are disabled by default. Disabled, the only cost is a check of
+the module level ENABLED flag per query.
+"""
+from __future__ import absolute_import
+import bisect
+import errno
+import socket
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, List, Optional, Tuple
+
+ENABLED = False
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+PHASES = (u"connect", u"send", u"first_byte", u"receive", u"decrypt",
+          u"decode")
+
+
+def _escape(value):
+    return unicode(value).replace(u"\\", u"\\\\").replace(
+        u"\"", u"\\\"").replace(u"\n", u"\\n")
+
+
+def _format_labels(names, values, extra=u""):
+    pairs = [u"%s=\"%s\"" % (name, _escape(value))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return u""
+    return u"{%s}" % u",".join(pairs)
+
+
+def _format_value(value):
+    if value == float(u"inf"):
+        return u"+Inf"
+    return repr(float(value)) if isinstance(value, float) else unicode(value)
+
+
+class Counter(object):
+    u"""
+    Monotonically increasing value per combination of label values.
+    """
+    TYPE = u"counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}  # type: Dict[Tuple, float]
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        u"""
+        Increase the value for the given label values.
+
+        :param tuple labels: values of the labels, in order
+        :param amount: increment
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        u"""
+        Current value for the given label values.
+        """
+        with self._lock:
+            return self._values.get(tuple(labels), 0)
+
+    def samples(self):
+        u"""
+        :return: list of (suffix, label values, extra label, value)
+        """
+        with self._lock:
+            return [(u"", labels, u"", value)
+                    for labels, value in sorted(self._values.items())]
+
+
+class Histogram(object):
+    u"""
+    Distribution of observed values per combination of label values.
+    """
+    TYPE = u"histogram"
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: [count per bucket and +Inf, sum]
+        self._values = {}  # type: Dict[Tuple, List]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        u"""
+        Record a value for the given label values.
+
+        :param tuple labels: values of the labels, in order
+        :param float value: observed value
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = \
+                    [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def count(self, labels=()):
+        u"""
+        Number of values observed for the given label values.
+        """
+        with self._lock:
+            state = self._values.get(tuple(labels))
+            return sum(state[0]) if state is not None else 0
+
+    def samples(self):
+        u"""
+        :return: list of (suffix, label values, extra label, value)
+        """
+        samples = []
+        with self._lock:
+            items = sorted((labels, (list(state[0]), state[1]))
+                           for labels, state in self._values.items())
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float(u"inf"),),
+                                    counts):
+                cumulative += count
+                samples.append((u"_bucket", labels,
+                                u"le=\"%s\"" % _format_value(float(bound)),
+                                cumulative))
+            samples.append((u"_sum", labels, u"", total))
+            samples.append((u"_count", labels, u"", cumulative))
+        return samples
+
+
+class MetricsRegistry(object):
+    u"""
+    Collection of metrics which can be rendered together.
+    """
+
+    def __init__(self):
+        self._metrics = []  # type: List
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, labels=()):
+        u"""
+        Create and register a counter.
+
+        :rtype: Counter
+        """
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=DEFAULT_BUCKETS):
+        u"""
+        Create and register a histogram.
+
+        :rtype: Histogram
+        """
+        return self._register(Histogram(name, documentation, labels,
+                                        buckets))
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        u"""
+        Render all metrics in the Prometheus text exposition format.
+
+        :rtype: str
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(u"# HELP %s %s" % (metric.name,
+                                            metric.documentation))
+            lines.append(u"# TYPE %s %s" % (metric.name, metric.TYPE))
+            for suffix, labels, extra, value in metric.samples():
+                lines.append(u"%s%s%s %s" % (
+                    metric.name, suffix,
+                    _format_labels(metric.labels, labels, extra),
+                    _format_value(value)))
+        return u"\n".join(lines) + u"\n"
+
+
+REGISTRY = MetricsRegistry()
+
+QUERIES = REGISTRY.counter(
+    u"tplink_queries_total", u"Queries sent to devices.",
+    (u"host", u"target", u"cmd"))
+QUERY_SECONDS = REGISTRY.histogram(
+    u"tplink_query_seconds", u"Duration of successful queries.",
+    (u"host", u"target", u"cmd"))
+PHASE_SECONDS = REGISTRY.histogram(
+    u"tplink_query_phase_seconds",
+    u"Duration of the phases of successful queries.",
+    (u"host", u"phase"))
+FAILURES = REGISTRY.counter(
+    u"tplink_query_failures_total",
+    u"Queries which failed, by kind of failure.",
+    (u"host", u"target", u"cmd", u"kind"))
+BYTES_SENT = REGISTRY.counter(
+    u"tplink_sent_bytes_total", u"Bytes sent to devices.", (u"host",))
+BYTES_RECEIVED = REGISTRY.counter(
+    u"tplink_received_bytes_total", u"Bytes received from devices.",
+    (u"host",))
+COALESCED = REGISTRY.counter(
+    u"tplink_coalesced_queries_total",
+    u"Reads answered by an identical read already in flight.", (u"host",))
+DEVICE_ERRORS = REGISTRY.counter(
+    u"tplink_device_errors_total",
+    u"SmartDeviceExceptions raised by device commands.",
+    (u"host", u"target", u"cmd"))
+
+
+def enable():
+    u"""
+    Start recording metrics.
+    """
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    u"""
+    Stop recording metrics. Recorded values are kept.
+    """
+    global ENABLED
+    ENABLED = False
+
+
+def request_labels(request):
+    u"""
+    Return the (target, cmd) labels of a request; requests with several
+    commands are labelled with the joined names.
+
+    :param dict request: decoded request
+    :rtype: tuple
+    """
+    if not isinstance(request, dict):
+        return u"unknown", u"unknown"
+    targets = sorted(request)
+    commands = sorted(set(command for target in targets
+                          for command in (request[target] or {})))
+    return u",".join(targets), u",".join(commands)
+
+
+def failure_kind(exception):
+    u"""
+    Classify the exception a query failed with.
+
+    :return: "timeout", "refused", "network" or "protocol"
+    :rtype: str
+    """
+    if isinstance(exception, socket.timeout):
+        return u"timeout"
+    if isinstance(exception, (IOError, OSError)):
+        if getattr(exception, u"errno", None) == errno.ECONNREFUSED:
+            return u"refused"
+        return u"network"
+    return u"protocol"
+
+
+def record_query(host, request, phases, sent, received):
+    u"""
+    Record a successful query.
+
+    :param str host: ip address of the device
+    :param dict request: decoded request
+    :param list phases: (phase, seconds) pairs
+    :param int sent: bytes sent
+    :param int received: bytes received
+    """
+    target, cmd = request_labels(request)
+    QUERIES.inc((host, target, cmd))
+    QUERY_SECONDS.observe((host, target, cmd),
+                          sum(seconds for _, seconds in phases))
+    for phase, seconds in phases:
+        PHASE_SECONDS.observe((host, phase), seconds)
+    BYTES_SENT.inc((host,), sent)
+    BYTES_RECEIVED.inc((host,), received)
+
+
+def record_failure(host, request, exception, sent=0, received=0):
+    u"""
+    Record a failed query.
+
+    :param str host: ip address of the device
+    :param dict request: decoded request
+    :param exception: the exception the query failed with
+    :param int sent: bytes sent before the failure
+    :param int received: bytes received before the failure
+    """
+    target, cmd = request_labels(request)
+    QUERIES.inc((host, target, cmd))
+    FAILURES.inc((host, target, cmd, failure_kind(exception)))
+    if sent:
+        BYTES_SENT.inc((host,), sent)
+    if received:
+        BYTES_RECEIVED.inc((host,), received)
+
+
+def record_device_error(host, target, cmd):
+    u"""
+    Record a SmartDeviceException raised for a device command.
+    """
+    DEVICE_ERRORS.inc((host, target, cmd))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        body = self.registry.render().encode(u"utf-8")
+        self.send_response(200)
+        self.send_header(u"Content-Type",
+                         u"text/plain; version=0.0.4; charset=utf-8")
+        self.send_header(u"Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, address=u"", registry=REGISTRY):
+    u"""
+    Serve the metrics for scraping from a background thread.
+
+    :param int port: port to listen on
+    :param str address: address to listen on (default: all)
+    :param MetricsRegistry registry: metrics to serve
+    :return: the server, call shutdown() on it to stop serving
+    :rtype: HTTPServer
+    """
+    class Handler(_MetricsHandler):
+        pass
+    Handler.registry = registry
+
+    server = HTTPServer((address, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,449 @@
+u"""
+Single-threaded engine running many queries at once over non-blocking
+sockets.
+
+    protocol = MultiplexedTPLinkSmartHomeProtocol()
+    for host in addresses:
+        protocol.submit(host, {"system": {"get_sysinfo": None}})
+    for result in protocol.collect():
+        ...
+
+Connecting, sending the encrypted request and reading the framed response
+happen for all queries concurrently in the calling thread, driven by epoll
+(or poll/select where epoll is not available). Encryption and framing are
+shared with TPLinkSmartHomeProtocol.
+
+The engine can also be passed as `protocol` to the device classes, in which
+case every query runs on its own.
+"""
+from __future__ import absolute_import
+import errno
+import json
+import logging
+import select
+import socket
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from .protocol import TPLinkSmartHomeProtocol, ResponseFrame, _Measurement
+
+_LOGGER = logging.getLogger(__name__)
+
+_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+class Poller(object):
+    u"""
+    Minimal readiness notification on top of epoll, poll or select.
+    """
+    READ = 1
+    WRITE = 2
+
+    def __init__(self):
+        if hasattr(select, u"epoll"):
+            self._impl = _EpollPoller()
+        elif hasattr(select, u"poll"):
+            self._impl = _PollPoller()
+        else:
+            self._impl = _SelectPoller()
+
+    def register(self, fd, events):
+        self._impl.register(fd, events)
+
+    def modify(self, fd, events):
+        self._impl.modify(fd, events)
+
+    def unregister(self, fd):
+        self._impl.unregister(fd)
+
+    def poll(self, timeout):
+        u"""
+        Wait for events.
+
+        :param float timeout: seconds to wait at most
+        :return: list of (fd, events); errors and hang-ups are reported as
+                 both readable and writable, so that the next operation on
+                 the socket reports them
+        """
+        try:
+            return self._impl.poll(max(timeout, 0))
+        except (IOError, OSError, select.error), ex:
+            if ex.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        self._impl.close()
+
+
+class _EpollPoller(object):
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    @staticmethod
+    def _mask(events):
+        mask = 0
+        if events & Poller.READ:
+            mask |= select.EPOLLIN
+        if events & Poller.WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self._epoll.register(fd, self._mask(events))
+
+    def modify(self, fd, events):
+        self._epoll.modify(fd, self._mask(events))
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout):
+        ready = []
+        for fd, mask in self._epoll.poll(timeout):
+            events = 0
+            if mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                events |= Poller.READ
+            if mask & (select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP):
+                events |= Poller.WRITE
+            ready.append((fd, events))
+        return ready
+
+    def close(self):
+        self._epoll.close()
+
+
+class _PollPoller(object):
+    def __init__(self):
+        self._poll = select.poll()
+
+    @staticmethod
+    def _mask(events):
+        mask = 0
+        if events & Poller.READ:
+            mask |= select.POLLIN
+        if events & Poller.WRITE:
+            mask |= select.POLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self._poll.register(fd, self._mask(events))
+
+    def modify(self, fd, events):
+        self._poll.modify(fd, self._mask(events))
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        ready = []
+        error = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        for fd, mask in self._poll.poll(timeout * 1000):
+            events = 0
+            if mask & (select.POLLIN | error):
+                events |= Poller.READ
+            if mask & (select.POLLOUT | error):
+                events |= Poller.WRITE
+            ready.append((fd, events))
+        return ready
+
+    def close(self):
+        pass
+
+
+class _SelectPoller(object):
+    def __init__(self):
+        self._fds = {}  # type: Dict[int, int]
+
+    def register(self, fd, events):
+        self._fds[fd] = events
+
+    def modify(self, fd, events):
+        self._fds[fd] = events
+
+    def unregister(self, fd):
+        del self._fds[fd]
+
+    def poll(self, timeout):
+        readers = [fd for fd, ev in self._fds.items() if ev & Poller.READ]
+        writers = [fd for fd, ev in self._fds.items() if ev & Poller.WRITE]
+        if not readers and not writers:
+            time.sleep(timeout)
+            return []
+        readable, writable, failed = select.select(readers, writers,
+                                                   readers + writers,
+                                                   timeout)
+        ready = {}  # type: Dict[int, int]
+        for fd in readable:
+            ready[fd] = ready.get(fd, 0) | Poller.READ
+        for fd in writable:
+            ready[fd] = ready.get(fd, 0) | Poller.WRITE
+        for fd in failed:
+            ready[fd] = Poller.READ | Poller.WRITE
+        return list(ready.items())
+
+    def close(self):
+        pass
+
+
+class _Query(object):
+    u"""
+    State of a single query running on the engine.
+    """
+
+    def __init__(self, host, port, request, measurement):
+        self.host = host
+        self.port = port
+        self.request = request
+        self.measurement = measurement
+        self.sock = None  # type: Optional[socket.socket]
+        self.outgoing = None  # type: Optional[memoryview]
+        self.frame = None  # type: Optional[ResponseFrame]
+        self.deadline = None  # type: Optional[float]
+        self.result = None  # type: Any
+        self.done = False
+
+
+class MultiplexedTPLinkSmartHomeProtocol(TPLinkSmartHomeProtocol):
+    u"""
+    TP-Link Smart Home Protocol running many queries at once in one thread.
+    """
+    DEFAULT_MAX_CONNECTIONS = 512
+
+    def __init__(self,
+                 timeout=TPLinkSmartHomeProtocol.DEFAULT_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        u"""
+        Create a new engine.
+
+        :param float timeout: seconds a single query may take, from
+                              connecting to reading the last byte
+        :param int max_connections: maximum number of open connections,
+                                    further queries wait for a free slot
+        """
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._pending = []  # type: List[_Query]
+        self._lock = threading.Lock()
+
+    def submit(self,
+               host,
+               request,
+               port=TPLinkSmartHomeProtocol.DEFAULT_PORT):
+        u"""
+        Queue a query to be run by the next call to collect().
+
+        :param str host: ip address of the device
+        :param request: command to send to the device (can be either dict or
+        json string)
+        :param int port: port on the device (default: 9999)
+        :return: position of the query's result in the list returned by
+                 collect()
+        :rtype: int
+        """
+        with self._lock:
+            self._pending.append(self._make_query(host, request, port))
+            return len(self._pending) - 1
+
+    def collect(self):
+        u"""
+        Run all submitted queries and return their results.
+
+        :return: list with the parsed response or the exception for each
+                 submitted query, in order of submission
+        :rtype: list
+        """
+        with self._lock:
+            queries, self._pending = self._pending, []
+        self._run(queries)
+        return [query.result for query in queries]
+
+    def query_many(self,
+                   requests,
+                   port=TPLinkSmartHomeProtocol.DEFAULT_PORT):
+        u"""
+        Run many queries at once.
+
+        :param requests: list of (host, request) pairs
+        :param int port: port on the devices (default: 9999)
+        :return: list with the parsed response or the exception for each
+                 query, in the same order
+        :rtype: list
+        """
+        queries = [self._make_query(host, request, port)
+                   for host, request in requests]
+        self._run(queries)
+        return [query.result for query in queries]
+
+    def query(self,
+              host,
+              request,
+              port=TPLinkSmartHomeProtocol.DEFAULT_PORT,
+              deadline=None):
+        u"""
+        Request information from a TP-Link SmartHome Device and return the
+        response.
+
+        :param str host: ip address of the device
+        :param int port: port on the device (default: 9999)
+        :param request: command to send to the device (can be either dict or
+        json string)
+        :param float deadline: time.time() by which the query must be
+                               complete, if earlier than the timeout
+        :return: parsed json response
+        """
+        query = self._make_query(host, request, port)
+        query.deadline = deadline
+        self._run([query])
+        if isinstance(query.result, Exception):
+            raise query.result
+        return query.result
+
+    @staticmethod
+    def _make_query(host, request, port):
+        if isinstance(request, dict):
+            request = json.dumps(request)
+        _LOGGER.debug(u"> (%i) %s", len(request), request)
+        return _Query(host, port, bytes(TPLinkSmartHomeProtocol.encrypt(
+            request)), _Measurement.begin(host, request))
+
+    def _run(self, queries):
+        u"""
+        Drive the given queries until all of them are done.
+        """
+        waiting = deque(queries)
+        active = {}  # type: Dict[int, _Query]
+        poller = Poller()
+        try:
+            while waiting or active:
+                while waiting and len(active) < self.max_connections:
+                    query = waiting.popleft()
+                    self._start(query, poller)
+                    if not query.done:
+                        active[query.sock.fileno()] = query
+
+                if not active:
+                    continue
+
+                now = time.time()
+                timeout = min(query.deadline for query in active.values())
+                for fd, events in poller.poll(timeout - now):
+                    query = active.get(fd)
+                    if query is None:
+                        continue
+                    if events & Poller.WRITE and query.frame is None:
+                        self._on_writable(query, poller)
+                    elif events & Poller.READ and query.frame is not None:
+                        self._on_readable(query)
+                    if query.done:
+                        self._finish(query, poller, active)
+
+                now = time.time()
+                for query in [q for q in active.values()
+                              if q.deadline <= now]:
+                    query.result = socket.timeout(u"timed out")
+                    query.done = True
+                    self._finish(query, poller, active)
+        finally:
+            for query in active.values():
+                self._close(query.sock)
+            poller.close()
+
+    def _start(self, query, poller):
+        u"""
+        Start connecting a query to its device.
+        """
+        deadline = time.time() + self.timeout
+        if query.deadline is None or deadline < query.deadline:
+            query.deadline = deadline
+        query.measurement.restart()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        query.sock = sock
+        try:
+            result = sock.connect_ex((query.host, query.port))
+        except socket.error, ex:
+            result = ex.args[0]
+        if result and result not in _IN_PROGRESS:
+            query.result = socket.error(result, errno.errorcode.get(
+                result, u"connect failed"))
+            query.done = True
+            query.measurement.failed(query.result)
+            sock.close()
+            return
+        query.outgoing = memoryview(query.request)
+        poller.register(sock.fileno(), Poller.WRITE)
+
+    def _on_writable(self, query, poller):
+        u"""
+        Complete the connection and send as much of the request as possible.
+        """
+        try:
+            if query.outgoing is not None and \
+                    len(query.outgoing) == len(query.request):
+                error = query.sock.getsockopt(socket.SOL_SOCKET,
+                                              socket.SO_ERROR)
+                if error:
+                    raise socket.error(error, errno.errorcode.get(
+                        error, u"connect failed"))
+                query.measurement.mark(u"connect")
+            sent = query.sock.send(query.outgoing)
+            query.outgoing = query.outgoing[sent:]
+            query.measurement.sent += sent
+            if not len(query.outgoing):
+                query.outgoing = None
+                query.measurement.mark(u"send")
+                query.frame = ResponseFrame()
+                poller.modify(query.sock.fileno(), Poller.READ)
+        except socket.error, ex:
+            if ex.args[0] in _IN_PROGRESS:
+                return
+            query.result = ex
+            query.done = True
+
+    def _on_readable(self, query):
+        u"""
+        Read the next chunk of the response.
+        """
+        measurement = query.measurement
+        try:
+            complete = query.frame.read_from(query.sock)
+        except socket.error, ex:
+            if ex.args[0] in _IN_PROGRESS:
+                return
+            query.result = ex
+            query.done = True
+            return
+        except Exception, ex:
+            query.result = ex
+            query.done = True
+            return
+        if not measurement.marked(u"first_byte"):
+            measurement.mark(u"first_byte")
+        if not complete:
+            return
+        measurement.mark(u"receive")
+        measurement.received = len(query.frame.payload) + 4
+
+        try:
+            query.result = self._decode(query.frame.payload, measurement)
+        except Exception, ex:
+            query.result = ex
+        query.done = True
+
+    def _finish(self, query, poller, active):
+        u"""
+        Remove a completed query from the engine and close its socket.
+        """
+        fd = query.sock.fileno()
+        poller.unregister(fd)
+        del active[fd]
+        self._close(query.sock)
+        if isinstance(query.result, Exception):
+            query.measurement.failed(query.result)
+        else:
+            query.measurement.succeeded()
+        query.frame = None
+        query.outgoing = None
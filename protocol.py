@@ -1,13 +1,168 @@
 from __future__ import absolute_import
+import binascii
 import json
+import select
 import socket
 import struct
 import logging
-from typing import Any, Dict, Union
+import threading
+import time
+import types
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Union
+
+from . import metrics, tracing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 _LOGGER = logging.getLogger(__name__)
 
 
+def _is_read(request):
+    u"""
+    Whether all commands of a request only read from the device, so that
+    sending it again is harmless.
+
+    :param dict request: decoded request
+    :rtype: bool
+    """
+    return all(cmd.startswith(u"get_")
+               for commands in request.values()
+               for cmd in (commands or {}))
+
+
+class _hybridmethod(object):
+    u"""
+    Method which can be called on the class as well as on an instance,
+    receiving whichever it was called on as its first argument.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        return types.MethodType(self.func,
+                                owner if instance is None else instance)
+
+
+class _Measurement(object):
+    u"""
+    Duration of every phase and bytes transferred of a single round trip,
+    reported to the metrics registry and the current round trip span.
+
+    Phases are marked as they end; a phase marked again, e.g. connecting
+    anew after a stale pooled connection, is timed until its last mark.
+    """
+
+    def __init__(self, host, request):
+        self.host = host
+        if isinstance(request, dict):
+            self.request = request
+        else:
+            try:
+                self.request = json.loads(request)
+            except ValueError:
+                self.request = None
+        span = tracing.current_span()
+        self.span = span if span is not None and \
+            span.kind == tracing.ROUND_TRIP else None
+        self.sent = 0
+        self.received = 0
+        self.start = time.time()
+        self._marks = {}  # type: Dict[str, float]
+
+    @staticmethod
+    def begin(host, request):
+        u"""
+        Start measuring a round trip.
+
+        :return: a measurement, or one ignoring everything if neither
+                 metrics nor tracing are enabled
+        """
+        if metrics.ENABLED or tracing.ENABLED:
+            return _Measurement(host, request)
+        return _NO_MEASUREMENT
+
+    def restart(self):
+        u"""
+        Start timing again, e.g. once a queued query is finally sent.
+        """
+        self.start = time.time()
+        self._marks.clear()
+
+    def mark(self, phase):
+        u"""
+        Record the end of a phase.
+
+        :param str phase: one of metrics.PHASES
+        """
+        self._marks[phase] = time.time()
+
+    def marked(self, phase):
+        return phase in self._marks
+
+    def succeeded(self):
+        u"""
+        Report the completed round trip.
+        """
+        phases = []
+        previous = self.start
+        for phase in metrics.PHASES:
+            end = self._marks.get(phase, previous)
+            phases.append((phase, end - previous))
+            previous = end
+        if metrics.ENABLED:
+            metrics.record_query(self.host, self.request, phases, self.sent,
+                                 self.received)
+        if self.span is not None:
+            self.span.attributes.update({
+                u"request_bytes": self.sent,
+                u"response_bytes": self.received,
+                u"phases": dict(phases),
+            })
+
+    def failed(self, exception):
+        u"""
+        Report a round trip which failed with the given exception.
+        """
+        if metrics.ENABLED:
+            metrics.record_failure(self.host, self.request, exception,
+                                   self.sent, self.received)
+
+
+class _NoMeasurement(object):
+    u"""
+    Stand-in for _Measurement while metrics and tracing are disabled.
+    """
+    sent = 0
+    received = 0
+
+    def restart(self):
+        pass
+
+    def mark(self, phase):
+        pass
+
+    def marked(self, phase):
+        return True
+
+    def succeeded(self):
+        pass
+
+    def failed(self, exception):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NO_MEASUREMENT = _NoMeasurement()
+
+
 class TPLinkSmartHomeProtocol(object):
     u"""
     Implementation of the TP-Link Smart Home Protocol
@@ -20,15 +175,38 @@ class TPLinkSmartHomeProtocol(object):
 
     which are licensed under the Apache License, Version 2.0
     http://www.apache.org/licenses/LICENSE-2.0
+
+    query() can be called on the class, using the default timeouts, or on
+    an instance created with its own timeouts.
     """
     INITIALIZATION_VECTOR = 171
     DEFAULT_PORT = 9999
     DEFAULT_TIMEOUT = 5
+    # Devices on the local network accept connections within milliseconds,
+    # so an unreachable device is given up on long before a slow answer.
+    DEFAULT_CONNECT_TIMEOUT = 2
+    DEFAULT_READ_TIMEOUT = DEFAULT_TIMEOUT
 
-    @staticmethod
-    def query(host,
+    connect_timeout = DEFAULT_CONNECT_TIMEOUT
+    read_timeout = DEFAULT_READ_TIMEOUT
+
+    def __init__(self,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT):
+        u"""
+        :param float connect_timeout: seconds to wait for the connection
+        :param float read_timeout: seconds to wait for each part of the
+                                   response
+        """
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    @_hybridmethod
+    def query(self,
+              host,
               request,
-              port=DEFAULT_PORT):
+              port=DEFAULT_PORT,
+              deadline=None):
         u"""
         Request information from a TP-Link SmartHome Device and return the
         response.
@@ -37,47 +215,173 @@ class TPLinkSmartHomeProtocol(object):
         :param int port: port on the device (default: 9999)
         :param request: command to send to the device (can be either dict or
         json string)
+        :param float deadline: time.time() by which the query must be
+                               complete, raising socket.timeout otherwise
         :return:
         """
         if isinstance(request, dict):
             request = json.dumps(request)
 
+        measurement = _Measurement.begin(host, request)
+        try:
+            sock = TPLinkSmartHomeProtocol._connect(host, port,
+                                                    self.connect_timeout,
+                                                    self.read_timeout,
+                                                    deadline)
+            measurement.mark(u"connect")
+            try:
+                frame = TPLinkSmartHomeProtocol._round_trip(
+                    sock, request, self.read_timeout, deadline, measurement)
+            finally:
+                TPLinkSmartHomeProtocol._close(sock)
+            response = TPLinkSmartHomeProtocol._decode(frame.payload,
+                                                       measurement)
+        except Exception, ex:
+            measurement.failed(ex)
+            raise
+
+        measurement.succeeded()
+        return response
+
+    @staticmethod
+    def _round_trip(sock, request, read_timeout=DEFAULT_READ_TIMEOUT,
+                    deadline=None, measurement=_NO_MEASUREMENT):
+        u"""
+        Send a request over a connected socket and receive the complete
+        response, the part of a query shared by all protocols.
+
+        :param sock: connected socket
+        :param str request: json string to send
+        :param float read_timeout: seconds to wait for each part
+        :param float deadline: time.time() by which to give up
+        :param measurement: measurement to mark the send, first_byte and
+                            receive phases in
+        :return: the completely received frame
+        :rtype: ResponseFrame
+        """
+        measurement.sent += TPLinkSmartHomeProtocol._send(
+            sock, request, read_timeout, deadline)
+        measurement.mark(u"send")
+        frame = ResponseFrame()
+        complete = TPLinkSmartHomeProtocol._read(frame, sock, read_timeout,
+                                                 deadline)
+        measurement.mark(u"first_byte")
+        while not complete:
+            complete = TPLinkSmartHomeProtocol._read(frame, sock,
+                                                     read_timeout, deadline)
+        measurement.mark(u"receive")
+        measurement.received = len(frame.payload) + 4
+        return frame
+
+    @staticmethod
+    def _remaining(timeout, deadline):
+        u"""
+        Limit a timeout to the time left until the deadline.
+
+        :raises socket.timeout: if the deadline has passed
+        """
+        if deadline is None:
+            return timeout
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout(u"Deadline exceeded")
+        return min(timeout, remaining)
+
+    @staticmethod
+    def _connect(host,
+                 port,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 deadline=None):
+        u"""
+        Open a TCP connection to the device.
+
+        :param str host: ip address of the device
+        :param int port: port on the device
+        :param float connect_timeout: seconds to wait for the connection
+        :param float read_timeout: timeout of the connected socket
+        :param float deadline: time.time() by which to give up
+        :return: connected socket
+        """
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(TPLinkSmartHomeProtocol.DEFAULT_TIMEOUT)
         try:
+            sock.settimeout(TPLinkSmartHomeProtocol._remaining(
+                connect_timeout, deadline))
             sock.connect((host, port))
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(read_timeout)
+        return sock
+
+    @staticmethod
+    def _send(sock, request, read_timeout=DEFAULT_READ_TIMEOUT,
+              deadline=None):
+        u"""
+        Encrypt and send a single request over a connected socket.
+
+        The socket timeout is set for every request, so that a timeout
+        narrowed by the deadline of an earlier request on a reused
+        connection does not apply to this one.
+
+        :param sock: connected socket
+        :param str request: json string to send
+        :param float read_timeout: timeout of the socket
+        :param float deadline: time.time() by which to give up
+        :return: number of bytes sent
+        :rtype: int
+        """
+        _LOGGER.debug(u"> (%i) %s", len(request), request)
+        data = TPLinkSmartHomeProtocol.encrypt(request)
+        sock.settimeout(TPLinkSmartHomeProtocol._remaining(read_timeout,
+                                                           deadline))
+        sock.sendall(data)
+        return len(data)
 
-            _LOGGER.debug(u"> (%i) %s", len(request), request)
-            sock.send(TPLinkSmartHomeProtocol.encrypt(request))
-
-            buffer = str()
-            # Some devices send responses with a length header of 0 and
-            # terminate with a zero size chunk. Others send the length and
-            # will hang if we attempt to read more data.
-            length = -1
-            while True:
-                chunk = sock.recv(4096)
-                if length == -1:
-                    length = struct.unpack(u">I", chunk[0:4])[0]
-                buffer += chunk
-                if (length > 0 and len(buffer) >= length + 4) or not chunk:
-                    break
+    @staticmethod
+    def _read(frame, sock, read_timeout, deadline):
+        u"""
+        Receive the next part of a frame, within the deadline if any.
+        """
+        if deadline is not None:
+            sock.settimeout(TPLinkSmartHomeProtocol._remaining(read_timeout,
+                                                               deadline))
+        return frame.read_from(sock)
 
+    @staticmethod
+    def _close(sock):
+        u"""
+        Shut down and close a socket, ignoring errors from the shutdown.
+
+        :param sock: socket to close
+        """
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            # OSX raises OSError when shutdown() gets called on a closed
+            # socket. We ignore it here as the data has already been read
+            # into the buffer at this point.
+            pass
         finally:
-            try:
-                sock.shutdown(socket.SHUT_RDWR)
-            except OSError:
-                # OSX raises OSError when shutdown() gets called on a closed
-                # socket. We ignore it here as the data has already been read
-                # into the buffer at this point.
-                pass
-            finally:
-                sock.close()
+            sock.close()
 
-        response = TPLinkSmartHomeProtocol.decrypt(buffer[4:])
+    @staticmethod
+    def _decode(payload, measurement=_NO_MEASUREMENT):
+        u"""
+        Decrypt and parse a raw response.
+
+        :param payload: encrypted response data without the length header
+        :param measurement: measurement to mark the decrypt and decode
+                            phases in
+        :return: parsed json response
+        """
+        response = TPLinkSmartHomeProtocol.decrypt_bytes(payload)
+        measurement.mark(u"decrypt")
         _LOGGER.debug(u"< (%i) %s", len(response), response)
 
-        return json.loads(response)
+        response = json.loads(response)
+        measurement.mark(u"decode")
+        return response
 
     @staticmethod
     def encrypt(request):
@@ -87,13 +391,10 @@ class TPLinkSmartHomeProtocol(object):
         :param request: plaintext request data
         :return: ciphertext request
         """
-        key = TPLinkSmartHomeProtocol.INITIALIZATION_VECTOR
+        if isinstance(request, unicode):
+            request = request.encode(u"utf-8")
         buffer = bytearray(struct.pack(u">I", len(request)))
-
-        for char in request:
-            cipher = key ^ ord(char)
-            key = cipher
-            buffer.append(cipher)
+        buffer += TPLinkSmartHomeProtocol.encrypt_bytes(request)
 
         return buffer
 
@@ -105,16 +406,469 @@ class TPLinkSmartHomeProtocol(object):
         :param ciphertext: encrypted response data
         :return: plaintext response
         """
-        key = TPLinkSmartHomeProtocol.INITIALIZATION_VECTOR
-        buffer = []
+        plaintext = TPLinkSmartHomeProtocol.decrypt_bytes(ciphertext)
+
+        return plaintext.decode(u'latin-1')
+
+    @staticmethod
+    def encrypt_bytes(plaintext):
+        u"""
+        Encrypt raw bytes, without adding the length header.
+
+        Uses NumPy for larger payloads when it is available.
+
+        :param plaintext: plaintext bytes (str, bytearray or memoryview)
+        :return: ciphertext
+        :rtype: bytes
+        """
+        if numpy is not None and len(plaintext) >= _NUMPY_THRESHOLD:
+            return _encrypt_numpy(plaintext)
+        return _encrypt_python(plaintext)
 
-        ciphertext_str = ciphertext.decode(u'latin-1')
+    @staticmethod
+    def decrypt_bytes(ciphertext):
+        u"""
+        Decrypt raw bytes, without a length header.
 
-        for char in ciphertext_str:
-            plain = key ^ ord(char)
-            key = ord(char)
-            buffer.append(unichr(plain))
+        Uses NumPy for larger payloads when it is available.
 
-        plaintext = u''.join(buffer)
+        :param ciphertext: ciphertext bytes (str, bytearray or memoryview)
+        :return: plaintext
+        :rtype: bytes
+        """
+        if numpy is not None and len(ciphertext) >= _NUMPY_THRESHOLD:
+            return _decrypt_numpy(ciphertext)
+        return _decrypt_python(ciphertext)
+
+
+class ResponseFrame(object):
+    u"""
+    Incremental reader for a single length-framed response.
 
-        return plaintext
+    Responses start with a 4 byte big-endian length header. Once the header
+    has been read, a buffer of exactly that size is allocated and filled in
+    place using recv_into(), so the payload is never copied or resized.
+
+    Some devices send a length header of 0 and terminate the response by
+    closing the connection instead. Such responses are read until EOF.
+
+    read_from() performs a single receive, which makes the reader usable
+    with non-blocking sockets, too.
+
+    Responses longer than MAX_LENGTH are rejected before anything is
+    allocated for them, so that a corrupt or hostile length header cannot
+    exhaust the memory.
+    """
+    CHUNK_SIZE = 4096
+    # far beyond the few kilobytes devices answer with
+    MAX_LENGTH = 1 << 20
+
+    def __init__(self):
+        self._header = bytearray(4)
+        self._view = memoryview(self._header)
+        self._received = 0
+        self.length = None  # type: Optional[int]
+        self.payload = None  # type: Optional[bytearray]
+        self.complete = False
+
+    def read_from(self, sock):
+        u"""
+        Receive the next chunk of the response from the socket.
+
+        :param sock: connected socket
+        :return: True when the response has been completely received
+        :rtype: bool
+        :raises socket.error: when the connection is closed prematurely
+        :raises SmartDeviceException: when the response exceeds MAX_LENGTH
+        """
+        if self.length is None:
+            received = sock.recv_into(self._view[self._received:])
+            if not received:
+                raise socket.error(u"Connection closed before response")
+            self._received += received
+            if self._received == 4:
+                self._start_payload(struct.unpack(u">I",
+                                                  bytes(self._header))[0])
+        elif self.length:
+            received = sock.recv_into(self._view[self._received:])
+            if not received:
+                raise socket.error(u"Connection closed after %i of %i bytes"
+                                   % (self._received, self.length))
+            self._received += received
+            self.complete = self._received == self.length
+        else:
+            chunk = sock.recv(self.CHUNK_SIZE)
+            if chunk:
+                self.payload.extend(chunk)
+                ResponseFrame.check_length(len(self.payload))
+            else:
+                self.complete = True
+        return self.complete
+
+    @staticmethod
+    def check_length(length):
+        u"""
+        Reject responses longer than MAX_LENGTH.
+
+        :param int length: length from the header, or received so far
+        :raises SmartDeviceException: if the length exceeds MAX_LENGTH
+        """
+        if length > ResponseFrame.MAX_LENGTH:
+            # smartdevice imports this module
+            from .smartdevice import SmartDeviceException
+            raise SmartDeviceException(
+                u"Response of %i bytes exceeds the maximum of %i bytes"
+                % (length, ResponseFrame.MAX_LENGTH))
+
+    def _start_payload(self, length):
+        ResponseFrame.check_length(length)
+        self.length = length
+        self._received = 0
+        self.payload = bytearray(length)
+        # A length of 0 means the response is read until EOF, growing the
+        # payload as it comes in, so it must not be locked by a view.
+        self._view = memoryview(self.payload) if length else None
+
+
+# Below this size the setup cost of NumPy outweighs its speed.
+_NUMPY_THRESHOLD = 512
+
+
+def _encrypt_python(plaintext):
+    u"""
+    Encrypt using arbitrary precision integers.
+
+    Every ciphertext byte is the XOR of the initialization vector and all
+    plaintext bytes up to and including its position. Treating the data as
+    one big-endian integer, this prefix XOR is computed with log2(n)
+    shift-and-XOR steps, each running over the whole buffer in C.
+    """
+    length = len(plaintext)
+    if not length:
+        return b""
+    bits = 8 * length
+    value = (TPLinkSmartHomeProtocol.INITIALIZATION_VECTOR << bits) | \
+        int(binascii.hexlify(plaintext), 16)
+    shift = 8
+    while shift <= bits:
+        value ^= value >> shift
+        shift <<= 1
+    value &= (1 << bits) - 1
+    return binascii.unhexlify(b"%0*x" % (2 * length, value))
+
+
+def _decrypt_python(ciphertext):
+    u"""
+    Decrypt using arbitrary precision integers.
+
+    Every plaintext byte is the XOR of a ciphertext byte and its
+    predecessor, which is a single XOR of the data with itself shifted by
+    one byte, with the initialization vector shifted in at the top.
+    """
+    length = len(ciphertext)
+    if not length:
+        return b""
+    value = int(binascii.hexlify(ciphertext), 16)
+    keys = (TPLinkSmartHomeProtocol.INITIALIZATION_VECTOR <<
+            (8 * (length - 1))) | (value >> 8)
+    return binascii.unhexlify(b"%0*x" % (2 * length, value ^ keys))
+
+
+def _as_uint8_array(data):
+    u"""
+    Wrap a buffer into a uint8 NumPy array without copying it.
+    """
+    if isinstance(data, memoryview):
+        # frombuffer() only supports the old buffer protocol on Python 2
+        return numpy.asarray(data).view(numpy.uint8).reshape(-1)
+    return numpy.frombuffer(data, dtype=numpy.uint8)
+
+
+def _encrypt_numpy(plaintext):
+    u"""
+    Encrypt using a cumulative XOR over a NumPy view of the data.
+    """
+    plain = _as_uint8_array(plaintext)
+    cipher = numpy.bitwise_xor.accumulate(plain, dtype=numpy.uint8)
+    cipher ^= TPLinkSmartHomeProtocol.INITIALIZATION_VECTOR
+    return cipher.tobytes()
+
+
+def _decrypt_numpy(ciphertext):
+    u"""
+    Decrypt by XORing a NumPy view of the data with itself shifted by one.
+    """
+    cipher = _as_uint8_array(ciphertext)
+    plain = numpy.empty_like(cipher)
+    if len(cipher):
+        plain[0] = cipher[0] ^ TPLinkSmartHomeProtocol.INITIALIZATION_VECTOR
+        numpy.bitwise_xor(cipher[1:], cipher[:-1], out=plain[1:])
+    return plain.tobytes()
+
+
+class PooledTPLinkSmartHomeProtocol(TPLinkSmartHomeProtocol):
+    u"""
+    TP-Link Smart Home Protocol keeping connections open between queries.
+
+    One idle connection per (host, port) is kept around after a query has
+    been answered and reused for the next query to the same device, saving
+    the TCP handshake. Connections idle for longer than `idle_timeout`
+    seconds are closed, and at most `max_idle` idle connections are kept,
+    closing the least recently used ones first.
+
+    At most `max_connections` queries, to any device, use a connection at
+    the same time; further queries wait for one of them to finish, within
+    their deadline. Concurrent queries to the same device each use a
+    connection of their own, and only one of them is kept afterwards.
+
+    Devices closing the connection after each response are handled
+    transparently: a stale connection is detected before it is reused and
+    replaced by a new one. Should a reused connection break while a read
+    is exchanged over it, the read is sent again over a new connection.
+    Requests changing the device are never sent twice, since the device
+    may have carried them out before the connection broke.
+
+    A single instance can be shared between devices::
+
+        protocol = PooledTPLinkSmartHomeProtocol()
+        plugs = [SmartPlug(ip, protocol=protocol) for ip in addresses]
+    """
+    DEFAULT_IDLE_TIMEOUT = 30
+    DEFAULT_MAX_IDLE = 256
+    DEFAULT_MAX_CONNECTIONS = 256
+
+    def __init__(self,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_idle=DEFAULT_MAX_IDLE,
+                 connect_timeout=TPLinkSmartHomeProtocol.
+                 DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=TPLinkSmartHomeProtocol.DEFAULT_READ_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        u"""
+        Create a new connection pool.
+
+        :param float idle_timeout: seconds after which an unused connection
+                                   is closed
+        :param int max_idle: maximum number of idle connections kept
+        :param float connect_timeout: seconds to wait for a new connection
+        :param float read_timeout: seconds to wait for each part of the
+                                   response
+        :param int max_connections: maximum number of connections in use
+                                    at once, None for no limit
+        """
+        super(PooledTPLinkSmartHomeProtocol, self).__init__(connect_timeout,
+                                                            read_timeout)
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.max_connections = max_connections
+        self._idle = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._released = threading.Condition(self._lock)
+
+    def query(self,
+              host,
+              request,
+              port=TPLinkSmartHomeProtocol.DEFAULT_PORT,
+              deadline=None):
+        u"""
+        Request information from a TP-Link SmartHome Device over a pooled
+        connection and return the response.
+
+        If a reused connection turns out to be broken, a read is sent once
+        more over a freshly opened connection.
+
+        :param str host: ip address of the device
+        :param int port: port on the device (default: 9999)
+        :param request: command to send to the device (can be either dict or
+        json string)
+        :param float deadline: time.time() by which the query must be
+                               complete, raising socket.timeout otherwise
+        :return:
+        """
+        if isinstance(request, dict):
+            request = json.dumps(request)
+
+        measurement = _Measurement.begin(host, request)
+        try:
+            self._enter(deadline)
+            try:
+                response = self._pooled_query(host, port, request, deadline,
+                                              measurement)
+            finally:
+                self._leave()
+        except Exception, ex:
+            measurement.failed(ex)
+            raise
+        measurement.succeeded()
+        return response
+
+    def _enter(self, deadline):
+        u"""
+        Wait until fewer than `max_connections` connections are in use.
+
+        :param float deadline: time.time() by which to give up
+        :raises socket.timeout: if the deadline passes while waiting
+        """
+        with self._released:
+            while self.max_connections is not None and \
+                    self._in_use >= self.max_connections:
+                if deadline is None:
+                    self._released.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout(u"Deadline exceeded")
+                self._released.wait(remaining)
+            self._in_use += 1
+
+    def _leave(self):
+        with self._released:
+            self._in_use -= 1
+            self._released.notify()
+
+    def _pooled_query(self, host, port, request, deadline, measurement):
+        key = (host, port)
+        sock = self._acquire(key)
+        if sock is not None:
+            measurement.mark(u"connect")
+            try:
+                frame = self._round_trip(sock, request, self.read_timeout,
+                                         deadline, measurement)
+            except socket.timeout:
+                self._close(sock)
+                raise
+            except socket.error:
+                self._close(sock)
+                if not self._resendable(request):
+                    raise
+                _LOGGER.debug(u"Stale connection to %s:%s, reconnecting",
+                              host, port)
+                sock = None
+            except Exception:
+                self._close(sock)
+                raise
+
+        if sock is None:
+            sock = self._connect(host, port, self.connect_timeout,
+                                 self.read_timeout, deadline)
+            measurement.mark(u"connect")
+            try:
+                frame = self._round_trip(sock, request, self.read_timeout,
+                                         deadline, measurement)
+            except Exception:
+                self._close(sock)
+                raise
+
+        if frame.length:
+            self._release(key, sock)
+        else:
+            # Responses without a length are terminated by the device
+            # closing the connection, so it cannot be reused.
+            self._close(sock)
+
+        return self._decode(frame.payload, measurement)
+
+    @staticmethod
+    def _resendable(request):
+        u"""
+        Whether a request may be sent again after a connection broke, which
+        is only harmless for reads.
+
+        :param str request: json string sent
+        :rtype: bool
+        """
+        try:
+            return _is_read(json.loads(request))
+        except (ValueError, AttributeError):
+            return False
+
+    def close(self):
+        u"""
+        Close all idle connections.
+        """
+        with self._lock:
+            socks = [sock for sock, _ in self._idle.values()]
+            self._idle.clear()
+        for sock in socks:
+            self._close(sock)
+
+    @property
+    def active_connections(self):
+        u"""
+        Number of connections currently in use.
+
+        :rtype: int
+        """
+        return self._in_use
+
+    @property
+    def idle_connections(self):
+        u"""
+        Number of currently idle connections.
+
+        :rtype: int
+        """
+        return len(self._idle)
+
+    def _acquire(self, key):
+        u"""
+        Take an idle connection for the given key out of the pool.
+
+        :return: socket or None if there is no usable idle connection
+        """
+        with self._lock:
+            expired = self._evict_expired()
+            entry = self._idle.pop(key, None)
+        for sock in expired:
+            self._close(sock)
+
+        if entry is None:
+            return None
+
+        sock = entry[0]
+        # An idle connection must not have anything to read. If it does,
+        # the device has closed it (or sent garbage) and it is discarded.
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (socket.error, select.error, ValueError):
+            readable = [sock]
+        if readable:
+            self._close(sock)
+            return None
+        return sock
+
+    def _release(self, key, sock):
+        u"""
+        Put a connection back into the pool after a successful query.
+        """
+        discard = []
+        with self._lock:
+            if key in self._idle:
+                # Another thread has returned a connection for this device
+                # in the meantime, keep only one of them.
+                discard.append(sock)
+            else:
+                self._idle[key] = (sock, time.time())
+            while len(self._idle) > self.max_idle:
+                _, (oldest, _) = self._idle.popitem(last=False)
+                discard.append(oldest)
+        for old in discard:
+            self._close(old)
+
+    def _evict_expired(self):
+        u"""
+        Remove connections idle for longer than `idle_timeout` from the pool.
+        Must be called with the lock held.
+
+        :return: list of sockets to be closed
+        """
+        deadline = time.time() - self.idle_timeout
+        expired = []
+        for key, (sock, last_used) in list(self._idle.items()):
+            if last_used >= deadline:
+                # entries are ordered by the time they were released
+                break
+            del self._idle[key]
+            expired.append(sock)
+        return expired
@@ -0,0 +1,333 @@
+u"""
+Periodic sampling of realtime energy readings into fixed-size buffers.
+
+    sampler = EmeterSampler([SmartPlug(ip) for ip in addresses],
+                            interval=1.0, capacity=3600)
+    sampler.start()
+    ...
+    window = sampler.window(plug, seconds=60)
+    print(window.power.mean())
+
+All metered devices are polled concurrently once per interval. Ticks are
+aligned to multiples of the interval on the wall clock, so samples taken
+from different devices in the same cycle share a timestamp. Every tick
+reads the current values from the devices, regardless of their cache_ttl.
+
+Readings are normalized to W, V, A and kWh regardless of whether a device
+reports them in the `emeter` units (plugs) or the milli-units used by
+`smartlife.iot.common.emeter` (bulbs), and stored in preallocated ring
+buffers of doubles, one per device. Memory use therefore only depends on
+the capacity, not on how long the sampler has been running.
+
+When numpy is available, windows are read-only views into the ring buffer
+and no data is copied. They are only valid until the sampler overwrites
+the samples, so copy them if they need to be kept around for longer than
+capacity * interval seconds. Without numpy, windows are array copies.
+"""
+from __future__ import absolute_import
+import array
+import logging
+import math
+import threading
+import time
+from collections import namedtuple
+from typing import Dict, Iterable, Optional
+
+from .fleet import DeviceFleet
+from .smartdevice import SmartDevice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_LOGGER = logging.getLogger(__name__)
+
+FIELDS = (u"timestamp", u"power", u"voltage", u"current", u"total")
+
+Window = namedtuple(u"Window", FIELDS)
+
+# Keys of the realtime response for each field and the factor converting
+# them to W, V, A and kWh, for devices without and with emeter_units.
+_REALTIME_KEYS = {
+    False: ((u"power", 1.0), (u"voltage", 1.0), (u"current", 1.0),
+            (u"total", 1.0)),
+    True: ((u"power_mw", 1e-3), (u"voltage_mv", 1e-3), (u"current_ma", 1e-3),
+           (u"total_wh", 1e-3)),
+}
+
+
+def read_realtime(device):
+    u"""
+    Query the current energy readings of a device, bypassing any reading
+    cached or seeded on the device.
+
+    :param SmartDevice device: device to read
+    :return: readings as returned by the device, None if the device has no
+             energy meter
+    :rtype: dict
+    """
+    if not device.has_emeter:
+        return None
+    return device._query_helper(device.emeter_type, u"get_realtime")
+
+
+def normalize_realtime(realtime, emeter_units):
+    u"""
+    Convert a realtime emeter response to (power, voltage, current, total).
+
+    Values missing from the response are returned as NaN.
+
+    :param dict realtime: response of get_emeter_realtime
+    :param bool emeter_units: whether the device reports milli-units
+    :return: power in W, voltage in V, current in A and total in kWh
+    :rtype: tuple
+    """
+    values = []
+    for key, factor in _REALTIME_KEYS[bool(emeter_units)]:
+        value = realtime.get(key)
+        values.append(float(value) * factor if value is not None
+                      else float(u"nan"))
+    return tuple(values)
+
+
+class RingBuffer(object):
+    u"""
+    Fixed-size buffer of samples, overwriting the oldest when full.
+
+    Every sample is stored twice, at its slot and at the same slot in a
+    mirrored second half, so that the last n samples are always contiguous
+    in memory and windows can be handed out without copying.
+    """
+
+    def __init__(self, capacity):
+        u"""
+        :param int capacity: number of samples kept
+        """
+        if capacity <= 0:
+            raise ValueError(u"capacity must be positive")
+        self.capacity = capacity
+        self._columns = [self._allocate(2 * capacity) for _ in FIELDS]
+        self._next = 0
+        self._count = 0
+
+    @staticmethod
+    def _allocate(size):
+        if numpy is not None:
+            return numpy.zeros(size, dtype=numpy.float64)
+        return array.array('d', [0.0]) * size
+
+    def __len__(self):
+        return self._count
+
+    def append(self, sample):
+        u"""
+        Store a sample, dropping the oldest one if the buffer is full.
+
+        :param tuple sample: (timestamp, power, voltage, current, total)
+        """
+        index = self._next
+        mirror = index + self.capacity
+        for column, value in zip(self._columns, sample):
+            column[index] = value
+            column[mirror] = value
+        self._next = (index + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def last(self, count=None):
+        u"""
+        Return the most recent samples, oldest first.
+
+        :param int count: number of samples (default: all stored)
+        :rtype: Window
+        """
+        if count is None or count > self._count:
+            count = self._count
+        end = self._next + self.capacity
+        start = end - count
+        if numpy is not None:
+            columns = []
+            for column in self._columns:
+                view = column[start:end]
+                view.flags.writeable = False
+                columns.append(view)
+            return Window(*columns)
+        return Window(*[column[start:end] for column in self._columns])
+
+    def since(self, timestamp):
+        u"""
+        Return the samples taken at or after a point in time, oldest first.
+
+        :param float timestamp: earliest sample time to include
+        :rtype: Window
+        """
+        window = self.last()
+        times = window.timestamp
+        low, high = 0, len(times)
+        while low < high:
+            middle = (low + high) // 2
+            if times[middle] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return self.last(len(times) - low)
+
+
+class EmeterSampler(object):
+    u"""
+    Poll the realtime energy readings of many devices on a fixed schedule.
+    """
+    DEFAULT_INTERVAL = 1.0
+    DEFAULT_CAPACITY = 3600
+
+    def __init__(self,
+                 devices=None,
+                 interval=DEFAULT_INTERVAL,
+                 capacity=DEFAULT_CAPACITY,
+                 max_workers=DeviceFleet.DEFAULT_MAX_WORKERS,
+                 writer=None):
+        u"""
+        Create a new sampler.
+
+        :param devices: SmartDevice instances or a DeviceFleet to sample;
+                        devices without an energy meter are skipped
+        :param float interval: seconds between samples
+        :param int capacity: number of samples kept per device
+        :param int max_workers: maximum number of devices polled at once
+        :param writer: SegmentWriter every sample is also appended to,
+                       under the ip address of the device
+        """
+        if isinstance(devices, DeviceFleet):
+            self.fleet = devices
+        else:
+            self.fleet = DeviceFleet(devices, max_workers=max_workers)
+        self.interval = interval
+        self.capacity = capacity
+        self.writer = writer
+        self._buffers = {}  # type: Dict[SmartDevice, RingBuffer]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def next_tick(self, now=None):
+        u"""
+        Return the time of the next aligned sampling tick.
+
+        :param float now: reference time (default: current time)
+        :rtype: float
+        """
+        if now is None:
+            now = time.time()
+        return (math.floor(now / self.interval) + 1) * self.interval
+
+    def sample(self, timestamp=None):
+        u"""
+        Poll all devices once and store their readings.
+
+        Devices that fail to answer within the interval are skipped for
+        this tick.
+
+        :param float timestamp: time the samples are recorded at
+                                (default: current time)
+        :return: number of devices sampled
+        :rtype: int
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        sampled = 0
+        for result in self.fleet.run(read_realtime, timeout=self.interval):
+            if result.exception is not None:
+                _LOGGER.debug(u"Sampling %s failed: %s",
+                              result.device, result.exception)
+                continue
+            if result.result is None:
+                continue
+            sample = normalize_realtime(result.result,
+                                        result.device.emeter_units)
+            self._buffer(result.device).append((timestamp,) + sample)
+            if self.writer is not None:
+                self.writer.append(timestamp, result.device.ip_address,
+                                   *sample)
+            sampled += 1
+        return sampled
+
+    def _buffer(self, device):
+        with self._lock:
+            buffer = self._buffers.get(device)
+            if buffer is None:
+                buffer = RingBuffer(self.capacity)
+                self._buffers[device] = buffer
+            return buffer
+
+    def start(self):
+        u"""
+        Start sampling in a background thread.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        u"""
+        Stop the background sampling thread and wait for it to finish.
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            tick = self.next_tick()
+            if self._stop.wait(max(tick - time.time(), 0)):
+                return
+            try:
+                self.sample(tick)
+            except Exception, ex:
+                _LOGGER.exception(u"Sampling failed: %s", ex)
+
+    @property
+    def devices(self):
+        u"""
+        Devices for which samples have been recorded.
+
+        :rtype: list
+        """
+        with self._lock:
+            return list(self._buffers)
+
+    def window(self, device, seconds=None, count=None):
+        u"""
+        Return recent samples of a device, oldest first.
+
+        :param SmartDevice device: sampled device
+        :param float seconds: only include samples of the last seconds
+        :param int count: only include the last count samples
+        :return: Window of timestamp, power (W), voltage (V), current (A)
+                 and total (kWh) columns, empty if nothing was sampled
+        :rtype: Window
+        """
+        with self._lock:
+            buffer = self._buffers.get(device)
+        if buffer is None:
+            return RingBuffer(1).last(0)
+        if seconds is not None:
+            return buffer.since(time.time() - seconds)
+        return buffer.last(count)
+
+    def latest(self, device):
+        u"""
+        Return the most recent sample of a device.
+
+        :param SmartDevice device: sampled device
+        :return: (timestamp, power, voltage, current, total) or None
+        :rtype: tuple
+        """
+        window = self.window(device, count=1)
+        if not len(window.timestamp):
+            return None
+        return tuple(column[0] for column in window)
@@ -0,0 +1,405 @@
+u"""
+Compact append-only storage of realtime energy samples.
+
+    writer = SegmentWriter("samples")
+    sampler = EmeterSampler(devices, writer=writer)
+    sampler.start()
+    ...
+    with SegmentReader("samples") as reader:
+        records = reader.read(start=time.time() - 3600)
+
+Samples are stored in a directory of segment files. Every segment starts
+with a small header followed by fixed-width little-endian records of
+
+    timestamp (double), device index (uint32), power (double, W),
+    voltage (double, V), current (double, A), total (double, kWh)
+
+in order of their timestamps. The names of the devices, indexed by the
+device index, are kept in devices.json next to the segments.
+
+Segment file names carry the timestamp of their first record, and the
+records inside a segment are sorted, so a time range is located from the
+names and the last record of each segment, followed by a binary search
+over the memory mapped records; only the records inside the range are
+ever read.
+
+With numpy, read() returns structured arrays, which are views of the
+mapped file when the range is inside a single segment. Without numpy it
+returns lists of tuples.
+"""
+from __future__ import absolute_import
+import bisect
+import io
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from Queue import Queue, Full
+from typing import Dict, List, Optional
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_LOGGER = logging.getLogger(__name__)
+
+MAGIC = b"TPEM"
+VERSION = 1
+HEADER = struct.Struct("<4sHH8x")
+RECORD = struct.Struct("<dIdddd")
+FIELDS = (u"timestamp", u"device", u"power", u"voltage", u"current",
+          u"total")
+
+if numpy is not None:
+    RECORD_DTYPE = numpy.dtype([
+        (str(u"timestamp"), u"<f8"), (str(u"device"), u"<u4"),
+        (str(u"power"), u"<f8"), (str(u"voltage"), u"<f8"),
+        (str(u"current"), u"<f8"), (str(u"total"), u"<f8")])
+else:
+    RECORD_DTYPE = None
+
+_SUFFIX = u".seg"
+_DEVICES = u"devices.json"
+
+
+def _segment_name(timestamp):
+    # microseconds, zero padded so names sort by time
+    return u"%016d%s" % (int(timestamp * 1000000), _SUFFIX)
+
+
+def _segment_start(name):
+    return int(name[:-len(_SUFFIX)]) / 1000000.0
+
+
+def _segments(directory):
+    return sorted(name for name in os.listdir(directory)
+                  if name.endswith(_SUFFIX))
+
+
+class SegmentWriter(object):
+    u"""
+    Append samples to segment files from a background thread.
+
+    append() only puts the sample on a bounded queue, so it never blocks
+    the polling loop calling it. If the disk cannot keep up and the queue
+    fills up, new samples are dropped and counted in `dropped`, as are the
+    samples which could not be written.
+    """
+    DEFAULT_SEGMENT_RECORDS = 1 << 20
+    DEFAULT_QUEUE_SIZE = 1 << 16
+
+    def __init__(self,
+                 directory,
+                 segment_records=DEFAULT_SEGMENT_RECORDS,
+                 queue_size=DEFAULT_QUEUE_SIZE):
+        u"""
+        Open a segment directory for appending, creating it if necessary.
+
+        :param str directory: directory of the segment files
+        :param int segment_records: number of records after which a new
+                                    segment is started
+        :param int queue_size: maximum number of samples waiting to be
+                               written
+        """
+        self.directory = directory
+        self.segment_records = segment_records
+        self.dropped = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._devices = _load_devices(directory)
+        # whether devices.json lacks some of self._devices
+        self._devices_changed = False
+        self._indexes = dict((name, index) for index, name
+                             in enumerate(self._devices))
+        self._queue = Queue(maxsize=queue_size)
+        self._file = None  # type: Optional[io.BufferedWriter]
+        self._records = 0
+        self._last_timestamp = None  # type: Optional[float]
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, timestamp, device, power, voltage, current, total):
+        u"""
+        Queue a sample for writing. Missing values (None) are stored as
+        NaN.
+
+        :param float timestamp: time of the sample
+        :param str device: name of the device, e.g. its ip address
+        :param float power: power in W
+        :param float voltage: voltage in V
+        :param float current: current in A
+        :param float total: total energy in kWh
+        :return: False if the sample was dropped
+        :rtype: bool
+        :raises ValueError: if a value is not a number
+        """
+        try:
+            sample = (float(timestamp), device) + tuple(
+                float(u"nan") if value is None else float(value)
+                for value in (power, voltage, current, total))
+        except (TypeError, ValueError):
+            raise ValueError(u"Invalid sample of %s: %r" % (
+                device, (timestamp, power, voltage, current, total)))
+        try:
+            self._queue.put_nowait(sample)
+        except Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def close(self):
+        u"""
+        Write all queued samples and close the current segment.
+        """
+        if self._thread is None:
+            return
+        if self._thread.is_alive():
+            self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self):
+        try:
+            while True:
+                batch = [self._queue.get()]
+                while not self._queue.empty() and len(batch) < 4096:
+                    batch.append(self._queue.get_nowait())
+                if None in batch:
+                    self._write(batch[:batch.index(None)])
+                    return
+                self._write(batch)
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _write(self, samples):
+        if not samples:
+            return
+        # records within a segment must be sorted by time
+        samples.sort(key=lambda sample: sample[0])
+        for sample in samples:
+            if sample[1] not in self._indexes:
+                self._indexes[sample[1]] = len(self._devices)
+                self._devices.append(sample[1])
+                self._devices_changed = True
+
+        written = 0
+        try:
+            if self._devices_changed:
+                _store_devices(self.directory, self._devices)
+                self._devices_changed = False
+            for sample in samples:
+                timestamp = sample[0]
+                if self._file is None or \
+                        self._records >= self.segment_records or \
+                        timestamp < self._last_timestamp:
+                    self._open_segment(timestamp)
+                self._file.write(RECORD.pack(timestamp,
+                                             self._indexes[sample[1]],
+                                             *sample[2:]))
+                self._records += 1
+                self._last_timestamp = timestamp
+                written += 1
+            self._file.flush()
+        except Exception, ex:
+            # the thread must survive, or close() would wait for it forever
+            _LOGGER.error(u"Unable to write samples to %s: %s",
+                          self.directory, ex)
+            self.dropped += len(samples) - written
+
+    def _open_segment(self, timestamp):
+        if self._file is not None:
+            self._file.close()
+        path = os.path.join(self.directory, _segment_name(timestamp))
+        while os.path.exists(path):
+            # never append to a segment which may be out of order
+            timestamp += 0.000001
+            path = os.path.join(self.directory, _segment_name(timestamp))
+        self._file = io.open(path, u"wb")
+        self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self._records = 0
+
+
+class SegmentReader(object):
+    u"""
+    Read samples from segment files through memory maps.
+    """
+
+    def __init__(self, directory):
+        u"""
+        :param str directory: directory of the segment files
+        """
+        self.directory = directory
+        self._maps = {}  # type: Dict[str, mmap.mmap]
+
+    def close(self):
+        u"""
+        Release all memory maps. Arrays returned by read() must not be
+        used afterwards.
+        """
+        for mapped in self._maps.values():
+            mapped.close()
+        self._maps.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def devices(self):
+        u"""
+        Device names, indexed by the device field of the records.
+
+        :rtype: list
+        """
+        return _load_devices(self.directory)
+
+    def segments(self, start=None, end=None):
+        u"""
+        Return the names of the segments holding records in a time range.
+
+        :param float start: earliest timestamp
+        :param float end: timestamp after the latest one
+        :rtype: list
+        """
+        names = _segments(self.directory)
+        if end is not None:
+            starts = [_segment_start(name) for name in names]
+            names = names[:bisect.bisect_left(starts, end)]
+        if start is None:
+            return names
+        selected = []
+        for name in names:
+            mapped = self._map(name)
+            if mapped is None:
+                continue
+            count = (len(mapped) - HEADER.size) // RECORD.size
+            if count and self._timestamp(mapped, count - 1) >= start:
+                selected.append(name)
+        return selected
+
+    def read(self, start=None, end=None, device=None):
+        u"""
+        Return the records in a time range.
+
+        :param float start: earliest timestamp to include
+        :param float end: timestamp after the latest one to include
+        :param str device: only include records of this device
+        :return: structured array with the fields of FIELDS, or a list of
+                 tuples without numpy
+        """
+        parts = []
+        for name in self.segments(start, end):
+            mapped = self._map(name)
+            if mapped is None:
+                continue
+            count = (len(mapped) - HEADER.size) // RECORD.size
+            low = self._search(mapped, count, start) \
+                if start is not None else 0
+            high = self._search(mapped, count, end) \
+                if end is not None else count
+            if low < high:
+                parts.append(self._records(mapped, low, high))
+
+        index = None
+        if device is not None:
+            devices = self.devices
+            if device not in devices:
+                parts = []
+            else:
+                index = devices.index(device)
+
+        if numpy is not None:
+            if not parts:
+                records = numpy.zeros(0, dtype=RECORD_DTYPE)
+            elif len(parts) == 1:
+                records = parts[0]
+            else:
+                records = numpy.concatenate(parts)
+            if index is not None:
+                records = records[records[u"device"] == index]
+            return records
+
+        records = [record for part in parts for record in part]
+        if index is not None:
+            records = [record for record in records if record[1] == index]
+        return records
+
+    def _map(self, name):
+        path = os.path.join(self.directory, name)
+        mapped = self._maps.get(name)
+        if mapped is not None:
+            # the newest segment grows while the writer appends to it, and
+            # a map only covers the size of the file when it was created
+            if os.stat(path).st_size <= len(mapped):
+                return mapped
+            # arrays returned earlier keep the old map alive
+            del self._maps[name]
+        with io.open(path, u"rb") as segment:
+            header = segment.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return None
+            magic, version, record_size = HEADER.unpack(header)
+            if magic != MAGIC or record_size != RECORD.size:
+                _LOGGER.warning(u"Skipping %s, not a segment of version %s",
+                                name, VERSION)
+                return None
+            mapped = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[name] = mapped
+        return mapped
+
+    @staticmethod
+    def _timestamp(mapped, position):
+        return struct.unpack_from(
+            "<d", mapped, HEADER.size + position * RECORD.size)[0]
+
+    @classmethod
+    def _search(cls, mapped, count, timestamp):
+        u"""
+        Return the position of the first record at or after timestamp.
+        """
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if cls._timestamp(mapped, middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    @staticmethod
+    def _records(mapped, low, high):
+        offset = HEADER.size + low * RECORD.size
+        if numpy is not None:
+            return numpy.frombuffer(mapped, dtype=RECORD_DTYPE,
+                                    count=high - low, offset=offset)
+        return [RECORD.unpack_from(mapped, offset + position * RECORD.size)
+                for position in range(high - low)]
+
+
+def _load_devices(directory):
+    try:
+        with io.open(os.path.join(directory, _DEVICES), u"rb") as devices:
+            return json.loads(devices.read().decode(u"utf-8"))
+    except (IOError, OSError):
+        return []
+
+
+def _store_devices(directory, devices):
+    path = os.path.join(directory, _DEVICES)
+    with io.open(path + u".tmp", u"wb") as stored:
+        stored.write(json.dumps(devices).encode(u"utf-8"))
+    os.rename(path + u".tmp", path)
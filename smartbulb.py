@@ -1,9 +1,12 @@
 from __future__ import division
 from __future__ import absolute_import
-from tplink import SmartDevice
+from tplink import SmartDevice, SmartDeviceException
+from tplink.smartdevice import capability
+from tplink import tracing
 from typing import Any, Dict, Optional, Tuple
 
 
+@tracing.traced
 class SmartBulb(SmartDevice):
     u"""Representation of a TP-Link Smart Bulb.
 
@@ -43,35 +46,43 @@ class SmartBulb(SmartDevice):
     BULB_STATE_ON = u'ON'
     BULB_STATE_OFF = u'OFF'
 
+    LIGHT_SERVICE = u"smartlife.iot.smartbulb.lightingservice"
+
     def __init__(self,
                  ip_address,
-                 protocol=None):
-        SmartDevice.__init__(self, ip_address, protocol)
+                 protocol=None,
+                 cache_ttl=0,
+                 timeout=None,
+                 retries=0,
+                 hedge_after=None,
+                 health=None):
+        SmartDevice.__init__(self, ip_address, protocol, cache_ttl, timeout,
+                             retries, hedge_after, health)
         self.emeter_type = u"smartlife.iot.common.emeter"
         self.emeter_units = True
 
-    @property
-    def is_color(self):
+    @capability
+    def is_color(self, sysinfo):
         u"""
         Whether the bulb supports color changes
 
         :return: True if the bulb supports color changes, False otherwise
         :rtype: bool
         """
-        return bool(self.sys_info[u'is_color'])
+        return bool(sysinfo[u'is_color'])
 
-    @property
-    def is_dimmable(self):
+    @capability
+    def is_dimmable(self, sysinfo):
         u"""
         Whether the bulb supports brightness changes
 
         :return: True if the bulb supports brightness changes, False otherwise
         :rtype: bool
         """
-        return bool(self.sys_info[u'is_dimmable'])
+        return bool(sysinfo[u'is_dimmable'])
 
-    @property
-    def is_variable_color_temp(self):
+    @capability
+    def is_variable_color_temp(self, sysinfo):
         u"""
         Whether the bulb supports color temperature changes
 
@@ -79,16 +90,56 @@ class SmartBulb(SmartDevice):
         otherwise
         :rtype: bool
         """
-        return bool(self.sys_info[u'is_variable_color_temp'])
+        return bool(sysinfo[u'is_variable_color_temp'])
 
     def get_light_state(self):
-        return self._query_helper(u"smartlife.iot.smartbulb.lightingservice",
-                                  u"get_light_state")
+        return self._query_helper(self.LIGHT_SERVICE, u"get_light_state")
 
     def set_light_state(self, state):
-        return self._query_helper(u"smartlife.iot.smartbulb.lightingservice",
+        return self._query_helper(self.LIGHT_SERVICE,
                                   u"transition_light_state", state)
 
+    def _light_state_if(self, capability=None):
+        u"""
+        Retrieve the light state if the bulb has the given capability.
+
+        If the capabilities of the bulb are not known yet, they are
+        determined in the same round trip.
+
+        :param str capability: name of the required capability, if any
+        :return: light state, None if the bulb lacks the capability
+        :rtype: dict
+        :raises SmartDeviceException: on error
+        """
+        if self._capability_source is None:
+            results = self.query_batch([
+                (u"system", u"get_sysinfo", None),
+                (self.LIGHT_SERVICE, u"get_light_state", None),
+            ])
+            for result in results:
+                if isinstance(result, SmartDeviceException):
+                    raise result
+            sysinfo, light_state = results
+            self._set_sys_info(sysinfo)
+        elif capability is None or getattr(self, capability):
+            light_state = self.get_light_state()
+        else:
+            return None
+
+        if capability is not None and not getattr(self, capability):
+            return None
+        return light_state
+
+    @staticmethod
+    def _active_light_state(light_state):
+        u"""
+        Light state in effect when the bulb is on: the current one if the
+        bulb is on, or the one it will turn on with otherwise.
+        """
+        if not light_state[u'on_off']:
+            return light_state[u'dft_on_state']
+        return light_state
+
     @property
     def hsv(self):
         u"""
@@ -97,20 +148,17 @@ class SmartBulb(SmartDevice):
         :return: hue, saturation and value (degrees, %, %)
         :rtype: tuple
         """
-
-        if not self.is_color:
+        light_state = self._light_state_if(u"is_color")
+        if light_state is None:
             return None
 
-        light_state = self.get_light_state()
-        if not self.is_on:
-            hue = light_state[u'dft_on_state'][u'hue']
-            saturation = light_state[u'dft_on_state'][u'saturation']
-            value = int(light_state[u'dft_on_state']
-                        [u'brightness'] * 255 / 100)
-        else:
-            hue = light_state[u'hue']
-            saturation = light_state[u'saturation']
-            value = int(light_state[u'brightness'] * 255 / 100)
+        return self._hsv(light_state)
+
+    def _hsv(self, light_state):
+        light_state = self._active_light_state(light_state)
+        hue = light_state[u'hue']
+        saturation = light_state[u'saturation']
+        value = int(light_state[u'brightness'] * 255 / 100)
 
         return hue, saturation, value
 
@@ -140,14 +188,14 @@ class SmartBulb(SmartDevice):
         :return: Color temperature in Kelvin
         :rtype: int
         """
-        if not self.is_variable_color_temp:
+        light_state = self._light_state_if(u"is_variable_color_temp")
+        if light_state is None:
             return None
 
-        light_state = self.get_light_state()
-        if not self.is_on:
-            return int(light_state[u'dft_on_state'][u'color_temp'])
-        else:
-            return int(light_state[u'color_temp'])
+        return self._color_temp(light_state)
+
+    def _color_temp(self, light_state):
+        return int(self._active_light_state(light_state)[u'color_temp'])
 
     @color_temp.setter
     def color_temp(self, temp):
@@ -172,14 +220,14 @@ class SmartBulb(SmartDevice):
         :return: brightness in percent
         :rtype: int
         """
-        if not self.is_dimmable:
+        light_state = self._light_state_if(u"is_dimmable")
+        if light_state is None:
             return None
 
-        light_state = self.get_light_state()
-        if not self.is_on:
-            return int(light_state[u'dft_on_state'][u'brightness'])
-        else:
-            return int(light_state[u'brightness'])
+        return self._brightness(light_state)
+
+    def _brightness(self, light_state):
+        return int(self._active_light_state(light_state)[u'brightness'])
 
     @brightness.setter
     def brightness(self, brightness):
@@ -239,14 +287,17 @@ class SmartBulb(SmartDevice):
         :return: Bulb information dict, keys in user-presentable form.
         :rtype: dict
         """
+        light_state = self._light_state_if()
         info = {
-            u'Brightness': self.brightness,
+            u'Brightness': None,
             u'Is dimmable': self.is_dimmable,
         }  # type: Dict[str, Any]
+        if self.is_dimmable:
+            info[u'Brightness'] = self._brightness(light_state)
         if self.is_variable_color_temp:
-            info[u"Color temperature"] = self.color_temp
+            info[u"Color temperature"] = self._color_temp(light_state)
         if self.is_color:
-            info[u"HSV"] = self.hsv
+            info[u"HSV"] = self._hsv(light_state)
 
         return info
 
@@ -16,15 +16,26 @@ http://www.apache.org/licenses/LICENSE-2.0
 from __future__ import absolute_import
 import datetime
 import logging
+import random
 import socket
+import sys
+import threading
+import time
 import warnings
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from Queue import Queue, Empty
 from typing import Any, Dict, List, Tuple, Optional
 
-from .protocol import TPLinkSmartHomeProtocol
+from . import metrics, tracing
+from .health import DeviceHealth
+from .protocol import TPLinkSmartHomeProtocol, _is_read
 
 _LOGGER = logging.getLogger(__name__)
 
+CacheInfo = namedtuple(u"CacheInfo", [u"hits", u"misses", u"age"])
+
+_local = threading.local()
+
 
 class SmartDeviceException(Exception):
     u"""
@@ -33,6 +44,146 @@ class SmartDeviceException(Exception):
     pass
 
 
+class CommunicationError(SmartDeviceException):
+    u"""
+    Raised when the device could not be reached or its answer could not be
+    read. The underlying exception is available as `cause`.
+    """
+
+    def __init__(self, message=u'Communication error', cause=None):
+        super(CommunicationError, self).__init__(message)
+        self.cause = cause
+
+
+class DeviceTimeoutError(CommunicationError):
+    u"""
+    Raised when connecting to the device or waiting for its answer timed out.
+    """
+
+
+class DeadlineExceeded(DeviceTimeoutError):
+    u"""
+    Raised when the overall deadline of a call has passed.
+    """
+
+
+class ConnectionRefused(CommunicationError):
+    u"""
+    Raised when the device refused the connection.
+    """
+
+
+class CircuitOpen(CommunicationError):
+    u"""
+    Raised without contacting the device while its circuit breaker is open
+    after repeated failures to reach it.
+    """
+
+
+class DeviceError(SmartDeviceException):
+    u"""
+    Raised when the device answered with an error code.
+    """
+
+    def __init__(self, message, err_code=None):
+        super(DeviceError, self).__init__(message)
+        self.err_code = err_code
+
+
+class within_deadline(object):
+    u"""
+    Context manager limiting all device queries made by its block in this
+    thread to a deadline, on top of the timeouts of the devices. Queries
+    which would start or run past it fail with DeadlineExceeded, so a
+    request is never sent once the deadline has passed.
+
+        with within_deadline(time.time() + 2):
+            plug.turn_on()
+    """
+
+    def __init__(self, deadline):
+        u"""
+        :param float deadline: time.time() by which the queries must be
+                               complete, None for no limit
+        """
+        self.deadline = deadline
+        self._outer = None
+
+    def __enter__(self):
+        self._outer = getattr(_local, u"deadline", None)
+        if self._outer is not None and (self.deadline is None or
+                                        self._outer < self.deadline):
+            return self
+        _local.deadline = self.deadline
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.deadline = self._outer
+
+
+# seconds before the deadline at which a timeout counts as its passing
+_DEADLINE_SLACK = 0.01
+
+
+def _communication_error(exception, deadline=None):
+    u"""
+    Wrap an exception raised by a protocol in the matching
+    CommunicationError.
+
+    :param exception: exception raised while querying the device
+    :param float deadline: deadline of the call, if any
+    :rtype: CommunicationError
+    """
+    if isinstance(exception, CommunicationError):
+        return exception
+    kind = metrics.failure_kind(exception)
+    # socket timeouts narrowed to the deadline may fire a little early
+    if deadline is not None and time.time() >= deadline - (
+            _DEADLINE_SLACK if kind == u"timeout" else 0):
+        return DeadlineExceeded(u'Communication error: deadline exceeded',
+                                exception)
+    message = u'Communication error: %s' % (
+        unicode(exception) or type(exception).__name__)
+    if kind == u"timeout":
+        return DeviceTimeoutError(message, exception)
+    if kind == u"refused":
+        return ConnectionRefused(message, exception)
+    return CommunicationError(message, exception)
+
+
+class capability(object):
+    u"""
+    Property-like descriptor for a capability of a device, derived from its
+    system information.
+
+    Capabilities do not change for a given device, so each one is computed
+    only once per device and then served from memory. All capabilities are
+    computed again once the device reports a different firmware.
+
+    The decorated function receives the system information to derive the
+    capability from::
+
+        @capability
+        def is_color(self, sysinfo):
+            return bool(sysinfo['is_color'])
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        capabilities = instance._capabilities
+        if self.name not in capabilities:
+            capabilities[self.name] = self.func(
+                instance, instance._capability_sys_info())
+        return capabilities[self.name]
+
+
+@tracing.traced
 class SmartDevice(object):
     # possible device features
     FEATURE_ENERGY_METER = u'ENE'
@@ -40,13 +191,51 @@ class SmartDevice(object):
 
     ALL_FEATURES = (FEATURE_ENERGY_METER, FEATURE_TIMER)
 
+    # sysinfo keys identifying the firmware, capabilities are determined
+    # again when one of them changes
+    FIRMWARE_KEYS = (u'sw_ver', u'hw_ver')
+
+    # delay before the first retry, doubled for every further one
+    RETRY_BACKOFF = 0.1
+    RETRY_BACKOFF_MAX = 2.0
+
     def __init__(self,
                  ip_address,
-                 protocol=None):
+                 protocol=None,
+                 cache_ttl=0,
+                 timeout=None,
+                 retries=0,
+                 hedge_after=None,
+                 health=None):
         u"""
         Create a new SmartDevice instance, identified through its IP address.
 
+        System information is cached for `cache_ttl` seconds, so that
+        reading several properties at once does not query the device for
+        each of them. Energy readings are always read from the device. The
+        cache is emptied whenever a command changing the device is sent
+        through this instance.
+
         :param str ip_address: ip address on which the device listens
+        :param protocol: protocol implementation to use, e.g. a
+                         PooledTPLinkSmartHomeProtocol shared between devices
+                         (default: TPLinkSmartHomeProtocol)
+        :param float cache_ttl: seconds to cache device data for,
+                                0 to disable caching (default), None to
+                                cache until update() or invalidate()
+        :param float timeout: seconds a query may take in total, including
+                              retries; the connect and read timeouts are
+                              set on the protocol (default: no deadline)
+        :param int retries: times a failed read is sent again, after an
+                            exponentially growing delay; commands changing
+                            the device are never retried (default: 0)
+        :param float hedge_after: seconds after which a duplicate of an
+                                  unanswered read is sent, using whichever
+                                  answer arrives first (default: never);
+                                  ignored with a GatedProtocol, which
+                                  shares identical reads in flight
+        :param DeviceHealth health: health tracking and circuit breaker of
+                                    the device (default: DeviceHealth())
         """
         socket.inet_pton(socket.AF_INET, ip_address)
         self.ip_address = ip_address
@@ -55,6 +244,22 @@ class SmartDevice(object):
         self.protocol = protocol
         self.emeter_type = u"emeter"  # type: str
         self.emeter_units = False
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout
+        self.retries = retries
+        self.hedge_after = hedge_after
+        if health is None:
+            health = DeviceHealth()
+        self.health = health
+        self._sys_info_cache = None  # type: Optional[Tuple[Dict, float]]
+        self._emeter_realtime_cache = None  # type: Optional[Tuple]
+        # whether the cached system information was seeded and not used yet
+        self._sys_info_seeded = False
+        self.discovered_at = None  # type: Optional[float]
+        self._capabilities = {}  # type: Dict[str, Any]
+        self._capability_source = None  # type: Optional[Dict]
+        self._cache_hits = 0
+        self._cache_misses = 0
 
     def _query_helper(self,
                       target,
@@ -68,32 +273,254 @@ class SmartDevice(object):
         :param arg: JSON object passed as parameter to the command
         :return: Unwrapped result for the call.
         :rtype: dict
+        :raises CommunicationError: if the device could not be queried
         :raises SmartDeviceException: if command was not executed correctly
         """
         if arg is None:
             arg = {}
+        self._invalidate_for(cmd)
         try:
-            response = self.protocol.query(
-                host=self.ip_address,
-                request={target: {cmd: arg}}
-            )
+            response = self._round_trip({target: {cmd: arg}})
+        except CommunicationError:
+            if metrics.ENABLED:
+                metrics.record_device_error(self.ip_address, target, cmd)
+            raise
+
+        try:
+            return self._process_response(target, cmd, response)
+        except SmartDeviceException:
+            if metrics.ENABLED:
+                metrics.record_device_error(self.ip_address, target, cmd)
+            raise
+
+    def _round_trip(self, request):
+        u"""
+        Send a request to the device within the deadline of the call,
+        retrying and hedging reads as configured. The health of the device
+        records one failure per call, once the retries are used up.
+
+        :param dict request: request to send
+        :return: parsed response
+        :raises CircuitOpen: if the circuit breaker of the device is open
+        :raises CommunicationError: if the device could not be queried
+        """
+        deadline = getattr(_local, u"deadline", None)
+        if deadline is not None and time.time() >= deadline:
+            # not the device's fault, its health is left alone
+            raise DeadlineExceeded(u"Communication error: deadline exceeded")
+        if self.timeout is not None:
+            own = time.time() + self.timeout
+            if deadline is None or own < deadline:
+                deadline = own
+        if not self.health.acquire():
+            raise CircuitOpen(u"Communication error: circuit breaker open, "
+                              u"retrying in %.1f s"
+                              % self.health.retry_after())
+        retries = 0
+        hedge = False
+        if (self.retries or self.hedge_after is not None) and \
+                _is_read(request):
+            retries = self.retries
+            # a duplicate read would join the flight of the first one
+            hedge = self.hedge_after is not None and \
+                not getattr(self.protocol, u"COALESCES_READS", False)
+
+        attempt = 0
+        while True:
+            try:
+                return self._attempt(request, deadline, hedge)
+            except CommunicationError, ex:
+                delay = None
+                if attempt < retries and not isinstance(
+                        ex, (ConnectionRefused, DeadlineExceeded)):
+                    delay = min(self.RETRY_BACKOFF * 2 ** attempt,
+                                self.RETRY_BACKOFF_MAX) * \
+                        random.uniform(0.5, 1)
+                    if deadline is not None and \
+                            time.time() + delay >= deadline:
+                        delay = None
+                if delay is None:
+                    if self.health.record_failure():
+                        _LOGGER.warning(u"Circuit breaker of %s opened after "
+                                        u"%i failures: %s", self.ip_address,
+                                        self.health.consecutive_failures, ex)
+                    raise
+                attempt += 1
+                _LOGGER.debug(u"Retrying %s on %s in %.3f s (%i/%i): %s",
+                              tracing.request_name(request), self.ip_address,
+                              delay, attempt, retries, ex)
+                time.sleep(delay)
+
+    def _attempt(self, request, deadline, hedge):
+        u"""
+        Send a request to the device once, traced as a round trip span.
+
+        :raises CommunicationError: if the device could not be queried
+        """
+        query = self._hedged_query if hedge else self._query
+        start = time.time()
+        try:
+            if not tracing.ENABLED:
+                response = query(request, deadline)
+            else:
+                with tracing.span(tracing.request_name(request),
+                                  kind=tracing.ROUND_TRIP,
+                                  host=self.ip_address, request=request):
+                    response = query(request, deadline)
         except Exception, ex:
-            raise SmartDeviceException(u'Communication error')
+            raise _communication_error(ex, deadline), None, sys.exc_info()[2]
+
+        if self.health.record_success(time.time() - start):
+            _LOGGER.info(u"Circuit breaker of %s closed", self.ip_address)
+        return response
+
+    def _query(self, request, deadline):
+        if deadline is None:
+            return self.protocol.query(host=self.ip_address, request=request)
+        return self.protocol.query(host=self.ip_address, request=request,
+                                   deadline=deadline)
 
+    def _hedged_query(self, request, deadline):
+        u"""
+        Query the device from a background thread, sending a duplicate
+        request from a second one if there is no answer after `hedge_after`
+        seconds, or as soon as the first request failed. The first answer
+        wins; an error is raised only when both requests failed. Not used
+        with protocols coalescing identical reads (GatedProtocol), where the
+        duplicate would never be sent.
+        """
+        results = Queue()
+        # the round trip span, for the protocol to annotate from the threads
+        parent = tracing.current_span()
+
+        def query():
+            try:
+                with tracing.resume(parent):
+                    response = self._query(request, deadline)
+                results.put((None, None, response))
+            except Exception:
+                results.put(sys.exc_info()[1:] + (None,))
+
+        def start():
+            thread = threading.Thread(target=query)
+            thread.daemon = True
+            thread.start()
+
+        start()
+        try:
+            outcome = results.get(timeout=self.hedge_after)
+        except Empty:
+            outcome = None
+        if outcome is not None and outcome[0] is None:
+            return outcome[2]
+
+        _LOGGER.debug(u"Hedging %s on %s", tracing.request_name(request),
+                      self.ip_address)
+        if parent is not None and parent.kind == tracing.ROUND_TRIP:
+            parent.attributes[u"hedged"] = True
+        start()
+        if outcome is None:
+            outcome = results.get()
+        if outcome[0] is not None:
+            outcome = results.get()
+        error, traceback, response = outcome
+        if error is not None:
+            raise error, None, traceback
+        return response
+
+    @staticmethod
+    def _process_response(target, cmd, response):
+        u"""
+        Unwrap the result of a single command from a device response.
+
+        :param target: Target system {system, time, emeter, ..}
+        :param cmd: Executed command
+        :param response: Parsed response of the device
+        :return: Unwrapped result for the call.
+        :rtype: dict
+        :raises SmartDeviceException: if command was not executed correctly
+        """
         if target not in response:
             raise SmartDeviceException(u"No required {} in response: {}"
                                        .format(target, response))
 
         result = response[target]
         if u"err_code" in result and result[u"err_code"] != 0:
-            raise SmartDeviceException(u"Error on {}.{}: {}"
-                                       .format(target, cmd, result))
+            raise DeviceError(u"Error on {}.{}: {}"
+                              .format(target, cmd, result),
+                              result[u"err_code"])
+
+        if cmd not in result:
+            raise SmartDeviceException(u"No required {}.{} in response: {}"
+                                       .format(target, cmd, response))
 
         result = result[cmd]
-        del result[u"err_code"]
+        if result.get(u"err_code", 0) != 0:
+            raise DeviceError(u"Error on {}.{}: {}"
+                              .format(target, cmd, result),
+                              result[u"err_code"])
+        result.pop(u"err_code", None)
 
         return result
 
+    def query_batch(self, commands):
+        u"""
+        Execute several commands with as few round trips as possible.
+
+        All commands are sent to the device in a single request, unless the
+        same command is given more than once with different arguments, which
+        requires an additional request per repetition.
+
+        :param commands: list of (target, cmd, arg) tuples
+        :return: list with one entry per command, in the same order: either
+                 the unwrapped result or the SmartDeviceException for it
+        :rtype: list
+        """
+        requests = []  # type: List[Dict[str, Dict[str, Any]]]
+        slots = []  # type: List[int]
+        for target, cmd, arg in commands:
+            if arg is None:
+                arg = {}
+            self._invalidate_for(cmd)
+            for index, request in enumerate(requests):
+                cmds = request.setdefault(target, {})
+                if cmd not in cmds:
+                    cmds[cmd] = arg
+                    break
+                if cmds[cmd] == arg:
+                    break
+            else:
+                index = len(requests)
+                requests.append({target: {cmd: arg}})
+            slots.append(index)
+
+        responses = []
+        for request in requests:
+            try:
+                responses.append(self._round_trip(request))
+            except CommunicationError, ex:
+                responses.append(ex)
+
+        results = []
+        unwrapped = {}  # type: Dict[Tuple[int, str, str], Any]
+        for (target, cmd, _), index in zip(commands, slots):
+            key = (index, target, cmd)
+            if key not in unwrapped:
+                response = responses[index]
+                if not isinstance(response, SmartDeviceException):
+                    try:
+                        response = self._process_response(target, cmd,
+                                                          response)
+                    except SmartDeviceException, ex:
+                        response = ex
+                if metrics.ENABLED and \
+                        isinstance(response, SmartDeviceException):
+                    metrics.record_device_error(self.ip_address, target, cmd)
+                unwrapped[key] = response
+            results.append(unwrapped[key])
+
+        return results
+
     @property
     def features(self):
         u"""
@@ -110,15 +537,19 @@ class SmartDevice(object):
             stacklevel=2
         )
         warnings.simplefilter(u'default', DeprecationWarning)
-        if u"feature" not in self.sys_info:
-            return []
+        return list(self._features)
+
+    @capability
+    def _features(self, sysinfo):
+        if u"feature" not in sysinfo:
+            return ()
 
-        features = self.sys_info[u'feature'].split(u':')
+        features = tuple(sysinfo[u'feature'].split(u':'))
 
         for feature in features:
             if feature not in SmartDevice.ALL_FEATURES:
                 _LOGGER.warning(u"Unknown feature %s on device %s.",
-                                feature, self.model)
+                                feature, sysinfo[u'model'])
 
         return features
 
@@ -138,10 +569,22 @@ class SmartDevice(object):
         u"""
         Returns the complete system information from the device.
 
+        Served from the cache while it is younger than `cache_ttl`, and
+        from seeded system information the first time, see seed_cache().
+
         :return: System information dict.
         :rtype: dict
         """
-        return defaultdict(lambda: None, self.get_sysinfo())
+        sys_info = self._cached_sys_info()
+        if sys_info is None and self._sys_info_seeded:
+            sys_info = self._sys_info_cache[0]
+        self._sys_info_seeded = False
+        if sys_info is not None:
+            self._cache_hits += 1
+            return sys_info
+
+        self._cache_misses += 1
+        return self.update()
 
     def get_sysinfo(self):
         u"""
@@ -151,7 +594,150 @@ class SmartDevice(object):
         :rtype dict
         :raises SmartDeviceException: on error
         """
-        return self._query_helper(u"system", u"get_sysinfo")
+        sysinfo = self._query_helper(u"system", u"get_sysinfo")
+        self._set_sys_info(sysinfo)
+        return sysinfo
+
+    def update(self):
+        u"""
+        Refresh the cached system information from the device.
+
+        :return: System information dict.
+        :rtype: dict
+        :raises SmartDeviceException: on error
+        """
+        self._emeter_realtime_cache = None
+        return self._set_sys_info(self._query_helper(u"system",
+                                                     u"get_sysinfo"))
+
+    def invalidate(self):
+        u"""
+        Drop the cached system information and energy readings, the next
+        access to them will query the device.
+        """
+        self._sys_info_cache = None
+        self._sys_info_seeded = False
+        self._emeter_realtime_cache = None
+
+    def seed_cache(self,
+                   sysinfo,
+                   emeter_realtime=None,
+                   timestamp=None):
+        u"""
+        Fill the cache with data received by other means, e.g. the answer to
+        a discovery broadcast, so that it is not fetched again.
+
+        The system information is served by the next access to it even if
+        caching is disabled, and afterwards for as long as it is younger
+        than `cache_ttl`, counting from the given timestamp. Energy readings
+        change all the time, so the seeded readings are returned by the next
+        call to get_emeter_realtime() only.
+
+        :param dict sysinfo: system information as returned by the device
+        :param dict emeter_realtime: current energy readings, if known
+        :param float timestamp: time the data was received at (default: now)
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self._set_sys_info(sysinfo, timestamp)
+        self._sys_info_seeded = True
+        if emeter_realtime is not None:
+            self._emeter_realtime_cache = (emeter_realtime, timestamp)
+
+    def cache_info(self):
+        u"""
+        Returns statistics of the cache.
+
+        :return: number of cache hits and misses, and the age of the cached
+                 system information in seconds (None if nothing is cached)
+        :rtype: CacheInfo
+        """
+        cache = self._sys_info_cache
+        age = time.time() - cache[1] if cache is not None else None
+        return CacheInfo(self._cache_hits, self._cache_misses, age)
+
+    def _cached_sys_info(self):
+        u"""
+        Returns the cached system information if it is still valid.
+
+        :return: System information dict or None
+        """
+        return self._fresh(self._sys_info_cache)
+
+    def _fresh(self, cache):
+        u"""
+        Returns the value of a (value, timestamp) cache entry if it is
+        younger than `cache_ttl`.
+
+        :return: cached value or None
+        """
+        if cache is None:
+            return None
+        value, timestamp = cache
+        if self.cache_ttl is None or time.time() - timestamp < self.cache_ttl:
+            return value
+        return None
+
+    def _set_sys_info(self, sysinfo, timestamp=None):
+        u"""
+        Store freshly received system information in the cache.
+
+        :param dict sysinfo: system information as returned by the device
+        :param float timestamp: time the data was received at (default: now)
+        :return: System information dict.
+        :rtype: dict
+        """
+        sys_info = defaultdict(lambda: None, sysinfo)
+        if timestamp is None:
+            timestamp = time.time()
+        self._sys_info_cache = (sys_info, timestamp)
+        self._sys_info_seeded = False
+        self.load_capabilities(sys_info)
+        return sys_info
+
+    def load_capabilities(self, sysinfo):
+        u"""
+        Provide system information to derive the capabilities of the device
+        from, e.g. from an inventory, so that they are not fetched from the
+        device.
+
+        Capabilities already known are kept, unless the firmware reported
+        in sysinfo differs from the one they were derived from.
+
+        :param dict sysinfo: system information of the device
+        """
+        source = self._capability_source
+        if source is not None and all(
+                source.get(key) == sysinfo.get(key)
+                for key in self.FIRMWARE_KEYS):
+            return
+        if source is not None:
+            _LOGGER.info(u"Firmware of %s changed, determining capabilities "
+                         u"again", self.ip_address)
+        self._capabilities = {}
+        self._capability_source = defaultdict(lambda: None, sysinfo)
+
+    def _capability_sys_info(self):
+        u"""
+        System information to derive capabilities from, fetched from the
+        device only if there is none yet.
+
+        :return: System information dict.
+        :rtype: dict
+        """
+        if self._capability_source is None:
+            self.sys_info
+        return self._capability_source
+
+    def _invalidate_for(self, cmd):
+        u"""
+        Drop the cached system information before executing a command that
+        may change it. Only get_* commands leave the device unchanged.
+
+        :param str cmd: command about to be executed
+        """
+        if not cmd.startswith(u"get_"):
+            self.invalidate()
 
     def identify(self):
         u"""
@@ -382,6 +968,14 @@ class SmartDevice(object):
         if not self.has_emeter:
             return None
 
+        # readings seeded from a discovery answer are used once, later
+        # calls always read the current values
+        cache = self._emeter_realtime_cache
+        self._emeter_realtime_cache = None
+        if cache is not None:
+            self._cache_hits += 1
+            return cache[0]
+
         return self._query_helper(self.emeter_type, u"get_realtime")
 
     def get_emeter_daily(self,
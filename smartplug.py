@@ -4,10 +4,13 @@ import logging
 from typing import Any, Dict
 
 from tplink import SmartDevice
+from tplink.smartdevice import capability
+from tplink import tracing
 
 _LOGGER = logging.getLogger(__name__)
 
 
+@tracing.traced
 class SmartPlug(SmartDevice):
     u"""Representation of a TP-Link Smart Switch.
 
@@ -34,8 +37,14 @@ class SmartPlug(SmartDevice):
 
     def __init__(self,
                  ip_address,
-                 protocol=None):
-        SmartDevice.__init__(self, ip_address, protocol)
+                 protocol=None,
+                 cache_ttl=0,
+                 timeout=None,
+                 retries=0,
+                 hedge_after=None,
+                 health=None):
+        SmartDevice.__init__(self, ip_address, protocol, cache_ttl, timeout,
+                             retries, hedge_after, health)
         self.emeter_type = u"emeter"
         self.emeter_units = False
 
@@ -81,14 +90,14 @@ class SmartPlug(SmartDevice):
         else:
             raise ValueError(u"State %s is not valid.", value)
 
-    @property
-    def has_emeter(self):
+    @capability
+    def has_emeter(self, sysinfo):
         u"""
         Returns whether device has an energy meter.
         :return: True if energy meter is available
                  False otherwise
         """
-        features = self.sys_info[u'feature'].split(u':')
+        features = sysinfo[u'feature'].split(u':')
         return SmartDevice.FEATURE_ENERGY_METER in features
 
     @property
@@ -124,7 +133,7 @@ class SmartPlug(SmartDevice):
         :return: True if led is on, False otherwise
         :rtype: bool
         """
-        return bool(1 - self.sys_info[u"led_off"])
+        return self._led(self.sys_info)
 
     @led.setter
     def led(self, state):
@@ -136,6 +145,10 @@ class SmartPlug(SmartDevice):
         """
         self._query_helper(u"system", u"set_led_off", {u"off": int(not state)})
 
+    @staticmethod
+    def _led(sysinfo):
+        return bool(1 - sysinfo[u"led_off"])
+
     @property
     def on_since(self):
         u"""
@@ -144,12 +157,17 @@ class SmartPlug(SmartDevice):
         :return: datetime for on since
         :rtype: datetime
         """
+        return self._on_since(self.sys_info)
+
+    @staticmethod
+    def _on_since(sysinfo):
         return datetime.datetime.now() - \
-            datetime.timedelta(seconds=self.sys_info[u"on_time"])
+            datetime.timedelta(seconds=sysinfo[u"on_time"])
 
     @property
     def state_information(self):
+        sysinfo = self.sys_info
         return {
-            u'LED state': self.led,
-            u'On since': self.on_since
+            u'LED state': self._led(sysinfo),
+            u'On since': self._on_since(sysinfo)
         }
@@ -0,0 +1,5 @@
+u"""
+Tests of the library, run against emulated devices on the local machine::
+
+    python -m unittest discover -s tplink/tests -t .
+"""
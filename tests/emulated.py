@@ -0,0 +1,44 @@
+u"""
+Test case base class running emulated devices.
+"""
+from __future__ import absolute_import
+import unittest
+
+from ..emulator import Emulator, make_devices
+from ..protocol import TPLinkSmartHomeProtocol
+
+
+def port_protocol(protocol_class, port, **kwargs):
+    u"""
+    Create a protocol of the given class sending every query to the port
+    of the emulator instead of the default port.
+    """
+    class PortProtocol(protocol_class):
+        def query(self, host, request, port=None, deadline=None):
+            return super(PortProtocol, self).query(host, request,
+                                                   self.emulator_port,
+                                                   deadline=deadline)
+
+    protocol = PortProtocol(**kwargs)
+    protocol.emulator_port = port
+    return protocol
+
+
+class EmulatedTestCase(unittest.TestCase):
+    u"""
+    Test case with emulated devices, reachable through self.protocol().
+    """
+    PLUGS = 2
+    BULBS = 1
+    # whether the emulator answers discovery messages
+    UDP = False
+
+    def setUp(self):
+        self.virtual = make_devices(plugs=self.PLUGS, bulbs=self.BULBS,
+                                    seed=0)
+        self.emulator = Emulator(self.virtual, port=0, udp=self.UDP)
+        self.emulator.start()
+        self.addCleanup(self.emulator.stop)
+
+    def protocol(self, protocol_class=TPLinkSmartHomeProtocol, **kwargs):
+        return port_protocol(protocol_class, self.emulator.port, **kwargs)
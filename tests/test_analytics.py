@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+import datetime
+import unittest
+import warnings
+
+try:
+    import numpy
+    from ..analytics import EnergyMatrix
+except ImportError:
+    numpy = None
+
+nan = float(u"nan")
+
+
+@unittest.skipIf(numpy is None, u"numpy is not installed")
+class TestEnergyMatrix(unittest.TestCase):
+    def setUp(self):
+        # devices of both models interleaved, so grouping has to reorder them
+        infos = [
+            {u"model": u"HS110(EU)", u"alias": u"kitchen kettle",
+             u"latitude": 52.371, u"longitude": 4.894},
+            {u"model": u"LB130(EU)", u"alias": u"hall lamp",
+             u"latitude_i": 523712, u"longitude_i": 48938},
+            {u"model": u"HS110(EU)", u"alias": u"kitchen fridge",
+             u"latitude": 52.09, u"longitude": 5.12},
+            {u"model": u"LB130(EU)", u"alias": u"porch"},
+        ]
+        self.matrix = EnergyMatrix.daily([u"a", u"b", u"c", u"d"],
+                                         datetime.date(2017, 1, 30),
+                                         datetime.date(2017, 2, 1), infos)
+        self.matrix.values[:] = [[1.0, 2.0, 3.0],
+                                 [10.0, nan, 30.0],
+                                 [4.0, 5.0, nan],
+                                 [20.0, nan, nan]]
+
+    def assertArrayEqual(self, actual, expected):
+        numpy.testing.assert_array_equal(actual, expected)
+
+    def test_labels(self):
+        self.assertEqual(self.matrix.by_model(),
+                         [u"HS110(EU)", u"LB130(EU)", u"HS110(EU)",
+                          u"LB130(EU)"])
+        self.assertEqual(self.matrix.by_alias_prefix(),
+                         [u"kitchen", u"hall", u"kitchen", u"porch"])
+        self.assertEqual(self.matrix.by_alias_prefix(length=2),
+                         [u"ki", u"ha", u"ki", u"po"])
+        # bulbs report integer coordinates
+        self.assertEqual(self.matrix.by_location(),
+                         [(52.37, 4.89), (52.37, 4.89), (52.09, 5.12), None])
+
+    def test_sum(self):
+        labels, values = self.matrix.sum(self.matrix.by_model())
+        self.assertEqual(labels, [u"HS110(EU)", u"LB130(EU)"])
+        self.assertArrayEqual(values, [[5.0, 7.0, 3.0], [30.0, 0.0, 30.0]])
+
+        labels, values = self.matrix.sum()
+        self.assertEqual(labels, [None])
+        self.assertArrayEqual(values, [[35.0, 7.0, 33.0]])
+        self.assertArrayEqual(self.matrix.total(), [35.0, 7.0, 33.0])
+
+    def test_mean(self):
+        labels, values = self.matrix.mean(self.matrix.by_location())
+        self.assertEqual(labels, [None, (52.09, 5.12), (52.37, 4.89)])
+        # NaN where no device of the group reported
+        self.assertArrayEqual(values, [[20.0, nan, nan],
+                                       [4.0, 5.0, nan],
+                                       [5.5, 2.0, 16.5]])
+
+    def test_quantile(self):
+        labels = [u"x", u"y", u"x", u"x"]
+        _, values = self.matrix.quantile(labels, 0.5)
+        self.assertArrayEqual(values, [[4.0, 3.5, 3.0], [10.0, nan, 30.0]])
+
+        _, values = self.matrix.quantile(labels, [0.0, 1.0])
+        self.assertEqual(values.shape, (2, 2, 3))
+        self.assertArrayEqual(values[0], [[1.0, 2.0, 3.0],
+                                          [20.0, 5.0, 3.0]])
+
+    def test_quantile_matches_nanpercentile(self):
+        random = numpy.random.RandomState(0)
+        matrix = EnergyMatrix.daily(range(200), datetime.date(2017, 1, 1),
+                                    datetime.date(2017, 1, 31))
+        matrix.values[:] = random.exponential(2.0, matrix.values.shape)
+        matrix.values[random.rand(*matrix.values.shape) < 0.3] = nan
+        # a group with a single device and one which never reported
+        labels = list(random.randint(0, 5, 200))
+        labels[0] = 5
+        labels[1] = 6
+        matrix.values[1] = nan
+        quantiles = [0.0, 0.1, 0.5, 0.95, 1.0]
+
+        unique, values = matrix.quantile(labels, quantiles)
+        for group, label in enumerate(unique):
+            rows = matrix.values[[row for row, other in enumerate(labels)
+                                  if other == label]]
+            if label == 6:
+                self.assertTrue(numpy.isnan(values[group]).all())
+                continue
+            with warnings.catch_warnings():
+                # periods none of the devices of a group reported
+                warnings.simplefilter(u"ignore", RuntimeWarning)
+                expected = numpy.nanpercentile(
+                    rows, numpy.multiply(quantiles, 100), axis=0)
+            numpy.testing.assert_allclose(values[group], expected)
+
+    def test_one_label_per_device(self):
+        for aggregation in (self.matrix.sum, self.matrix.mean,
+                            self.matrix.quantile):
+            self.assertRaises(ValueError, aggregation, [u"x", u"y"])
+
+    def test_empty(self):
+        matrix = EnergyMatrix.daily([], datetime.date(2017, 1, 1),
+                                    datetime.date(2017, 1, 3))
+        self.assertEqual(matrix.sum([]).values.shape, (0, 3))
+        self.assertEqual(matrix.mean([]).values.shape, (0, 3))
+        self.assertEqual(matrix.quantile([], [0.5, 0.9]).values.shape,
+                         (0, 2, 3))
+
+    def test_fill(self):
+        matrix = EnergyMatrix.daily([u"plug", u"bulb"],
+                                    datetime.date(2017, 1, 30),
+                                    datetime.date(2017, 2, 1))
+        matrix.fill(u"plug", {29: 9.0, 30: 1.5, 31: 2.5}, 2017, 1)
+        matrix.fill(u"bulb", {1: 750, 2: 9000}, 2017, 2, emeter_units=True)
+        self.assertArrayEqual(matrix.values, [[1.5, 2.5, nan],
+                                              [nan, nan, 0.75]])
+
+    def test_to_monthly(self):
+        monthly = self.matrix.to_monthly()
+        self.assertEqual(monthly.resolution, u"M")
+        self.assertArrayEqual(
+            monthly.periods,
+            numpy.array([u"2017-01", u"2017-02"], dtype=u"datetime64[M]"))
+        # months without a single reported day stay NaN
+        self.assertArrayEqual(monthly.values, [[3.0, 3.0],
+                                               [10.0, 30.0],
+                                               [9.0, nan],
+                                               [20.0, nan]])
+        _, values = monthly.sum(monthly.by_model())
+        self.assertArrayEqual(values, [[12.0, 3.0], [30.0, 30.0]])
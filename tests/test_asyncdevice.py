@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+import unittest
+
+try:
+    import trollius as asyncio
+except ImportError:
+    asyncio = None
+
+from .emulated import EmulatedTestCase
+from ..emulator import Profile
+from ..smartdevice import DeviceTimeoutError
+
+
+@unittest.skipIf(asyncio is None, u"trollius is not installed")
+class TestAsyncSmartPlug(EmulatedTestCase):
+    PLUGS = 1
+    BULBS = 0
+
+    def setUp(self):
+        super(TestAsyncSmartPlug, self).setUp()
+        from ..asyncdevice import AsyncSmartPlug
+        from ..asyncprotocol import AsyncTPLinkSmartHomeProtocol
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        port = self.emulator.port
+
+        class PortProtocol(AsyncTPLinkSmartHomeProtocol):
+            def query(self, host, request, port=None):
+                return super(PortProtocol, self).query(host, request,
+                                                       emulator_port)
+        emulator_port = port
+        self.plug = AsyncSmartPlug(
+            self.virtual[0].ip_address,
+            PortProtocol(timeout=0.1, loop=self.loop))
+
+    def test_sysinfo(self):
+        sysinfo = self.loop.run_until_complete(self.plug.get_sysinfo())
+        self.assertEqual(sysinfo[u"alias"], u"plug 0")
+
+    def test_realtime_reads_sysinfo_once(self):
+        self.virtual[0].sysinfo[u"feature"] = u"TIM:ENE"
+        for requests in (2, 1, 1):
+            before = self.virtual[0].requests
+            realtime = self.loop.run_until_complete(
+                self.plug.get_emeter_realtime())
+            self.assertIn(u"power", realtime)
+            self.assertEqual(self.virtual[0].requests - before, requests)
+
+    def test_timeout_is_typed(self):
+        self.virtual[0].profile = Profile(latency=0.5)
+        with self.assertRaises(DeviceTimeoutError) as context:
+            self.loop.run_until_complete(self.plug.get_sysinfo())
+        self.assertIn(u"timed out", unicode(context.exception))
+
+
+@unittest.skipIf(asyncio is None, u"trollius is not installed")
+class TestAsyncDiscover(EmulatedTestCase):
+    PLUGS = 2
+    BULBS = 1
+    UDP = True
+
+    def setUp(self):
+        super(TestAsyncDiscover, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_stream(self):
+        from ..asyncdevice import AsyncSmartBulb, AsyncSmartPlug
+        from ..asyncdiscover import AsyncDiscover
+        addresses = [device.ip_address for device in self.virtual]
+        # every device answers each of the retransmits
+        stream = AsyncDiscover.discover_iter(port=self.emulator.port,
+                                             timeout=0.3, targets=addresses,
+                                             retries=2, loop=self.loop)
+        devices = []
+        while True:
+            device = self.loop.run_until_complete(stream.next())
+            if device is None:
+                break
+            devices.append(device)
+
+        self.assertEqual(sorted(device.ip_address for device in devices),
+                         sorted(addresses))
+        self.assertEqual([isinstance(device, AsyncSmartBulb)
+                          for device in devices].count(True), 1)
+        self.assertEqual([isinstance(device, AsyncSmartPlug)
+                          for device in devices].count(True), 2)
+        self.assertEqual(set(device.protocol for device in devices),
+                         set([stream.protocol]))
+        self.assertIs(stream.protocol.loop, self.loop)
+        # capabilities are taken from the answers
+        before = sum(device.requests for device in self.virtual)
+        for device in devices:
+            self.loop.run_until_complete(device.has_emeter())
+        self.assertEqual(sum(device.requests for device in self.virtual),
+                         before)
@@ -0,0 +1,69 @@
+from __future__ import absolute_import
+import json
+import unittest
+
+from .emulated import EmulatedTestCase
+from ..benchmarks import suite
+
+
+class TestPercentiles(unittest.TestCase):
+    def test_nearest_rank(self):
+        summary = suite.percentiles(range(1, 101))
+        self.assertEqual(summary, {u"min": 1, u"max": 100, u"count": 100,
+                                   u"p50": 50, u"p90": 90, u"p99": 99})
+        self.assertEqual(suite.percentiles([3])[u"p50"], 3)
+
+
+class TestRoundTrips(EmulatedTestCase):
+    PLUGS = 1
+    BULBS = 1
+
+    def test_round_trips(self):
+        results = suite.bench_round_trips(self.emulator.port,
+                                          self.virtual[0], self.virtual[1])
+        self.assertEqual(sorted(results), [u"SmartBulb", u"SmartPlug"])
+        plug = results[u"SmartPlug"]
+        self.assertEqual(len(plug), 2 * len(suite.PROPERTIES[u"SmartPlug"]))
+        self.assertEqual(plug[u"state"], 1)
+        # with caching, every property needs one get_sysinfo at most, plus
+        # the readings which are never cached
+        self.assertEqual(plug[u"state (cached)"], 1)
+        self.assertLessEqual(plug[u"state_information (cached)"],
+                             plug[u"state_information"])
+        # the results are serializable
+        json.dumps(results)
+
+
+class TestCompare(unittest.TestCase):
+    def results(self, round_trips=1, qps=100.0, mb_per_s=10.0):
+        return {
+            u"round_trips": {u"SmartPlug": {u"state": round_trips}},
+            u"throughput": {u"serial": {u"qps": qps}},
+            u"cipher": [{u"size": 1024, u"implementation": u"numpy",
+                         u"operation": u"encrypt", u"mb_per_s": mb_per_s}],
+        }
+
+    def test_no_regressions(self):
+        self.assertEqual(suite.compare(self.results(), self.results()), [])
+        # within the tolerance, or faster
+        self.assertEqual(suite.compare(self.results(),
+                                       self.results(qps=90, mb_per_s=50)),
+                         [])
+
+    def test_regressions(self):
+        regressions = suite.compare(
+            self.results(),
+            self.results(round_trips=2, qps=50, mb_per_s=5))
+        self.assertEqual(len(regressions), 3)
+        self.assertIn(u"SmartPlug.state: 2 round trips, was 1", regressions)
+
+    def test_tolerance(self):
+        self.assertEqual(
+            len(suite.compare(self.results(), self.results(qps=70),
+                              tolerance=0.5)), 0)
+        self.assertEqual(
+            len(suite.compare(self.results(), self.results(qps=70),
+                              tolerance=0.2)), 1)
+
+    def test_baseline_without_entries(self):
+        self.assertEqual(suite.compare({}, self.results(round_trips=5)), [])
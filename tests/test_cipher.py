@@ -0,0 +1,77 @@
+from __future__ import absolute_import
+import os
+import struct
+import unittest
+
+from .. import protocol
+from ..protocol import TPLinkSmartHomeProtocol
+
+# sizes around the switch to numpy
+SIZES = (0, 1, 2, protocol._NUMPY_THRESHOLD - 1, protocol._NUMPY_THRESHOLD,
+         protocol._NUMPY_THRESHOLD + 1, 4096)
+
+
+def _reference_encrypt(plaintext):
+    key = TPLinkSmartHomeProtocol.INITIALIZATION_VECTOR
+    result = bytearray()
+    for char in bytearray(plaintext):
+        key ^= char
+        result.append(key)
+    return bytes(result)
+
+
+def _reference_decrypt(ciphertext):
+    key = TPLinkSmartHomeProtocol.INITIALIZATION_VECTOR
+    result = bytearray()
+    for char in bytearray(ciphertext):
+        result.append(key ^ char)
+        key = char
+    return bytes(result)
+
+
+class TestCipher(unittest.TestCase):
+
+    def samples(self):
+        for size in SIZES:
+            yield os.urandom(size)
+        yield b"\x00" * 600
+        yield b"\xff" * 600
+
+    def test_encrypt_bytes(self):
+        for plaintext in self.samples():
+            expected = _reference_encrypt(plaintext)
+            for data in (plaintext, bytearray(plaintext),
+                         memoryview(plaintext)):
+                self.assertEqual(
+                    bytes(TPLinkSmartHomeProtocol.encrypt_bytes(data)),
+                    expected)
+
+    def test_decrypt_bytes(self):
+        for ciphertext in self.samples():
+            expected = _reference_decrypt(ciphertext)
+            for data in (ciphertext, bytearray(ciphertext),
+                         memoryview(ciphertext)):
+                self.assertEqual(
+                    bytes(TPLinkSmartHomeProtocol.decrypt_bytes(data)),
+                    expected)
+
+    def test_python_implementation(self):
+        for plaintext in self.samples():
+            ciphertext = protocol._encrypt_python(plaintext)
+            self.assertEqual(ciphertext, _reference_encrypt(plaintext))
+            self.assertEqual(protocol._decrypt_python(ciphertext), plaintext)
+
+    @unittest.skipIf(protocol.numpy is None, u"numpy is not installed")
+    def test_numpy_implementation(self):
+        for plaintext in self.samples():
+            ciphertext = protocol._encrypt_numpy(plaintext)
+            self.assertEqual(ciphertext, _reference_encrypt(plaintext))
+            self.assertEqual(protocol._decrypt_numpy(ciphertext), plaintext)
+
+    def test_encrypt_adds_length_header(self):
+        request = u'{"system":{"get_sysinfo":{}}}'
+        encrypted = TPLinkSmartHomeProtocol.encrypt(request)
+        self.assertEqual(struct.unpack(b">I", bytes(encrypted[:4]))[0],
+                         len(request))
+        self.assertEqual(TPLinkSmartHomeProtocol.decrypt(encrypted[4:]),
+                         request)
@@ -0,0 +1,198 @@
+from __future__ import absolute_import
+import errno
+import json
+import socket
+import threading
+import time
+import unittest
+
+from .emulated import EmulatedTestCase
+from .. import discover
+from ..discover import Discover
+from ..emulator import make_devices
+from ..multiplex import MultiplexedTPLinkSmartHomeProtocol
+from ..protocol import TPLinkSmartHomeProtocol
+from ..smartdevice import SmartDeviceException
+from ..smartplug import SmartPlug
+
+
+class _FullSendBuffer(object):
+    u"""
+    Socket refusing to send for a while, as when its buffer is full.
+    """
+
+    def __init__(self, sock, busy_for):
+        self._sock = sock
+        self._busy_until = time.time() + busy_for
+        self.attempts = 0
+
+    def sendto(self, data, address):
+        self.attempts += 1
+        if time.time() < self._busy_until:
+            raise socket.error(errno.ENOBUFS, u"No buffer space available")
+        return self._sock.sendto(data, address)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        open_socket = Discover._open_socket
+        self.sockets = []
+
+        def full_send_buffer():
+            sock = _FullSendBuffer(open_socket(), busy_for=0.1)
+            self.sockets.append(sock)
+            return sock
+
+        Discover._open_socket = staticmethod(full_send_buffer)
+        self.addCleanup(setattr, Discover, u"_open_socket",
+                        staticmethod(open_socket))
+
+    def test_full_send_buffer_backs_off(self):
+        # nothing listens on the discard port
+        found = list(Discover.sweep_iter([u"127.0.0.1"], port=9,
+                                         timeout=0.05, tcp_fallback=False))
+        self.assertEqual(found, [])
+        sock, = self.sockets
+        # one attempt per backoff instead of spinning on select
+        self.assertLess(sock.attempts,
+                        0.1 / Discover.SWEEP_BACKOFF * 2 + 2)
+        self.assertGreater(sock.attempts, 1)
+
+
+class TestBroadcastAddresses(unittest.TestCase):
+
+    def test_addresses_are_unicode(self):
+        for address in Discover.broadcast_addresses():
+            self.assertIsInstance(address, unicode)
+
+    def test_addresses_of_both_sources_are_merged(self):
+        found = Discover._interface_broadcast_addresses
+        # netifaces and the ioctl() fallback return different string types
+        Discover._interface_broadcast_addresses = staticmethod(
+            lambda: [u"192.168.1.255", b"192.168.1.255", b"10.0.0.255",
+                     b"127.255.255.255"])
+        self.addCleanup(setattr, Discover, u"_interface_broadcast_addresses",
+                        staticmethod(found))
+        addresses = Discover.broadcast_addresses()
+        self.assertEqual(addresses, [u"192.168.1.255", u"10.0.0.255",
+                                     u"255.255.255.255"])
+        for address in addresses:
+            self.assertIsInstance(address, unicode)
+
+
+class _Responder(object):
+    u"""
+    UDP server answering every discovery message with the given replies.
+    """
+
+    def __init__(self, replies, address=u"127.0.2.1"):
+        self.replies = [TPLinkSmartHomeProtocol.encrypt(reply)[4:]
+                        for reply in replies]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, 0))
+        self.address, self.port = self.sock.getsockname()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                _, client = self.sock.recvfrom(4096)
+                for reply in self.replies:
+                    self.sock.sendto(bytes(reply), client)
+            except socket.error:
+                return
+
+    def close(self):
+        self.sock.close()
+
+
+class TestMalformedAnswers(unittest.TestCase):
+
+    def test_malformed_answers_are_skipped(self):
+        sysinfo = make_devices(plugs=1, bulbs=0)[0].get_sysinfo({})
+        responder = _Responder([
+            json.dumps({u"system": {u"get_sysinfo": {
+                u"type": u"IOT.SMARTPLUGSWITCH", u"err_code": -1,
+                u"err_msg": u"module not support"}}}),
+            json.dumps(u"system"),
+            json.dumps(42),
+            json.dumps({u"system": {u"get_sysinfo": sysinfo}}),
+        ])
+        self.addCleanup(responder.close)
+        devices = Discover.discover(port=responder.port, timeout=0.3,
+                                    targets=[responder.address], retries=0)
+        self.assertEqual(list(devices), [responder.address])
+        self.assertIsInstance(devices[responder.address], SmartPlug)
+
+    def test_device_from_data(self):
+        for reply in ({u"system": {u"get_sysinfo": {
+                          u"type": u"IOT.SMARTPLUGSWITCH",
+                          u"err_code": -1}}},
+                      u"system", 42, [u"system"]):
+            data = TPLinkSmartHomeProtocol.encrypt(json.dumps(reply))[4:]
+            self.assertEqual(
+                Discover._device_from_data(u"127.0.2.1", bytes(data),
+                                           TPLinkSmartHomeProtocol, 0,
+                                           set()),
+                (None, None))
+
+
+class TestSeededCache(unittest.TestCase):
+
+    def setUp(self):
+        self.sysinfo = make_devices(plugs=1, bulbs=0)[0].get_sysinfo({})
+        self.responder = _Responder([
+            json.dumps({u"system": {u"get_sysinfo": self.sysinfo}})])
+        self.addCleanup(self.responder.close)
+
+    def discover(self, **kwargs):
+        devices = Discover.discover(port=self.responder.port, timeout=0.3,
+                                    targets=[self.responder.address],
+                                    retries=0, **kwargs)
+        return devices[self.responder.address]
+
+    def test_not_cached_by_default(self):
+        device = self.discover()
+        self.assertEqual(device.cache_ttl, 0)
+        self.assertIsNone(device._cached_sys_info())
+        # the answer serves the first use and the capabilities nonetheless;
+        # nothing answers queries at the address of the responder
+        self.assertEqual(device.alias, self.sysinfo[u"alias"])
+        self.assertEqual(device.has_emeter, u"ENE" in self.sysinfo[u"feature"])
+        with self.assertRaises(SmartDeviceException):
+            device.alias
+
+    def test_cached_on_request(self):
+        device = self.discover(cache_ttl=5)
+        self.assertEqual(device.alias, self.sysinfo[u"alias"])
+        self.assertEqual(device.cache_info().hits, 1)
+
+
+class TestSweepFallback(EmulatedTestCase):
+    PLUGS = 3
+    BULBS = 0
+
+    def test_connections_are_limited(self):
+        engines = []
+
+        class Recording(MultiplexedTPLinkSmartHomeProtocol):
+            def __init__(self, **kwargs):
+                super(Recording, self).__init__(**kwargs)
+                engines.append(self)
+
+        self.addCleanup(setattr, discover,
+                        u"MultiplexedTPLinkSmartHomeProtocol",
+                        discover.MultiplexedTPLinkSmartHomeProtocol)
+        discover.MultiplexedTPLinkSmartHomeProtocol = Recording
+        addresses = [device.ip_address for device in self.virtual]
+        devices = Discover.sweep(addresses, port=self.emulator.port,
+                                 timeout=0.2, max_connections=2)
+        self.assertEqual(sorted(devices), sorted(addresses))
+        engine, = engines
+        self.assertEqual(engine.max_connections, 2)
@@ -0,0 +1,57 @@
+from __future__ import absolute_import
+import datetime
+
+from .emulated import EmulatedTestCase
+from ..emeterhistory import EmeterHistory
+from ..smartdevice import SmartDeviceException
+from ..smartplug import SmartPlug
+
+
+class TestEmeterHistory(EmulatedTestCase):
+    PLUGS = 2
+
+    def setUp(self):
+        super(TestEmeterHistory, self).setUp()
+        self.history = EmeterHistory(u":memory:")
+        self.addCleanup(self.history.close)
+        self.last_year = datetime.date.today().year - 1
+
+    def plug(self, number=0):
+        return SmartPlug(self.virtual[number].ip_address, self.protocol())
+
+    def test_backfill_returns_consumed_results(self):
+        plugs = [self.plug(0), self.plug(1)]
+        results = self.history.backfill(plugs, first_year=self.last_year)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertTrue(result.exception is None)
+            self.assertTrue(result.result > 12)
+
+        # everything is stored, backfilling again only asks for the
+        # current month and year
+        before = [virtual.requests for virtual in self.virtual]
+        self.history.backfill(plugs, first_year=self.last_year)
+        for virtual, requests in zip(self.virtual, before):
+            self.assertLessEqual(virtual.requests - requests, 2)
+
+    def test_stored_statistics_without_device(self):
+        plug = self.plug()
+        expected = self.history.daily(plug, self.last_year, 1)
+        mac = self.virtual[0].sysinfo[u"mac"]
+        self.emulator.stop()
+
+        # mac passed in
+        offline = self.plug()
+        self.assertEqual(
+            self.history.daily(offline, self.last_year, 1, mac=mac),
+            expected)
+
+        # mac taken from seeded system information
+        seeded = self.plug()
+        seeded.seed_cache(dict(self.virtual[0].sysinfo), timestamp=0)
+        self.assertEqual(self.history.daily(seeded, self.last_year, 1),
+                         expected)
+
+        # missing statistics still need the device
+        with self.assertRaises(SmartDeviceException):
+            self.history.daily(seeded, self.last_year, 2)
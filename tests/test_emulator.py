@@ -0,0 +1,52 @@
+from __future__ import absolute_import
+import json
+import socket
+import time
+
+from .emulated import EmulatedTestCase
+from ..emulator import Profile
+
+SYSINFO = {u"system": {u"get_sysinfo": None}}
+
+
+class TestEmulator(EmulatedTestCase):
+    PLUGS = 1
+    BULBS = 0
+
+    def query(self, request, **kwargs):
+        return self.protocol(**kwargs).query(self.virtual[0].ip_address,
+                                             request)
+
+    def test_malformed_requests(self):
+        self.assertEqual(self.query(json.dumps([u"system"]))[u"err_code"],
+                         -1)
+        self.assertEqual(
+            self.query({u"system": 42})[u"system"][u"err_code"], -1)
+        response = self.query({u"system": {u"set_relay_state": {},
+                                           u"get_sysinfo": None}})
+        self.assertEqual(response[u"system"][u"set_relay_state"],
+                         {u"err_code": -3, u"err_msg": u"invalid argument"})
+        # the other commands of the request are still carried out
+        self.assertEqual(response[u"system"][u"get_sysinfo"][u"err_code"], 0)
+        # and the emulator keeps serving
+        self.assertIn(u"system", self.query(SYSINFO))
+
+    def test_latency(self):
+        self.virtual[0].profile = Profile(latency=0.2)
+        start = time.time()
+        self.query(SYSINFO)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_bandwidth(self):
+        # answers are sent in 50 ms slices of bandwidth / 20 bytes
+        self.virtual[0].profile = Profile(bandwidth=2000)
+        size = len(json.dumps(self.virtual[0].handle(SYSINFO)))
+        start = time.time()
+        self.query(SYSINFO)
+        self.assertGreaterEqual(time.time() - start,
+                                (size // 100 - 1) * 0.05)
+
+    def test_loss(self):
+        self.virtual[0].profile = Profile(loss=1.0)
+        with self.assertRaises(socket.timeout):
+            self.query(SYSINFO, read_timeout=0.1)
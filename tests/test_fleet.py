@@ -0,0 +1,82 @@
+from __future__ import absolute_import
+import threading
+import time
+
+from .emulated import EmulatedTestCase
+from ..fleet import DeviceFleet
+from ..smartdevice import DeadlineExceeded
+from ..smartplug import SmartPlug
+from ..emulator import Profile
+
+
+class TestDeviceFleet(EmulatedTestCase):
+    PLUGS = 3
+    BULBS = 0
+
+    def fleet(self):
+        return DeviceFleet([SmartPlug(device.ip_address, self.protocol())
+                            for device in self.virtual])
+
+    def test_write_helpers_run_eagerly(self):
+        fleet = self.fleet()
+        fleet.turn_off()
+        self.assertEqual([device.sysinfo[u"relay_state"]
+                          for device in self.virtual], [0, 0, 0])
+        fleet.turn_on()
+        self.assertEqual([device.sysinfo[u"relay_state"]
+                          for device in self.virtual], [1, 1, 1])
+
+    def test_run_returns_all_results(self):
+        results = self.fleet().get_sysinfo()
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(result.exception is None for result in results))
+        self.assertEqual(sorted(result.result[u"alias"] for result in results),
+                         [u"plug 0", u"plug 1", u"plug 2"])
+
+    def test_empty(self):
+        self.assertEqual(DeviceFleet().get_sysinfo(), [])
+        self.assertEqual(list(DeviceFleet().iter_run(u"get_sysinfo")), [])
+
+    def test_iter_run_starts_without_consuming(self):
+        before = sum(device.requests for device in self.virtual)
+        results = self.fleet().iter_run(u"turn_off")
+        time.sleep(0.5)
+        self.assertEqual(sum(device.requests for device in self.virtual),
+                         before + 3)
+        self.assertEqual(len(list(results)), 3)
+
+    def test_deadline(self):
+        self.virtual[0].profile = Profile(latency=1.0)
+        results = self.fleet().get_sysinfo(timeout=0.3)
+        self.assertEqual(len(results), 3)
+        late = [result for result in results if result.exception is not None]
+        self.assertEqual(len(late), 1)
+        self.assertIsInstance(late[0].exception, DeadlineExceeded)
+        self.assertEqual(late[0].device.ip_address,
+                         self.virtual[0].ip_address)
+
+    def test_deadline_reaches_the_queries(self):
+        self.virtual[0].profile = Profile(latency=1.0)
+        before = threading.active_count()
+        self.fleet().get_sysinfo(timeout=0.2)
+        # the late query is given up on at the deadline, with its worker
+        time.sleep(0.3)
+        self.assertEqual(threading.active_count(), before)
+
+    def test_no_write_after_deadline(self):
+        fleet = self.fleet()
+        fleet.turn_off()
+        before = [device.requests for device in self.virtual]
+
+        def slow_turn_on(device):
+            time.sleep(0.3)
+            device.turn_on()
+
+        results = fleet.run(slow_turn_on, timeout=0.1)
+        time.sleep(0.4)
+        self.assertTrue(all(isinstance(result.exception, DeadlineExceeded)
+                            for result in results))
+        self.assertEqual([device.requests for device in self.virtual],
+                         before)
+        self.assertTrue(all(device.health.consecutive_failures == 0
+                            for device in fleet))
@@ -0,0 +1,178 @@
+from __future__ import absolute_import
+import json
+import socket
+import threading
+import time
+
+from .emulated import EmulatedTestCase
+from ..emulator import Profile
+from ..gate import GatedProtocol
+from ..smartdevice import CommunicationError
+from ..smartplug import SmartPlug
+
+
+class _Recorder(object):
+    u"""
+    Protocol wrapper recording the requests sent and the number of queries
+    running at once.
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def query(self, host, request, **kwargs):
+        with self._lock:
+            self.requests.append(json.loads(request))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            return self.protocol.query(host, request, **kwargs)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def _run_threads(targets):
+    threads = []
+    for target in targets:
+        thread = threading.Thread(target=target)
+        thread.start()
+        threads.append(thread)
+        # keep the order in which the threads reach the gate
+        time.sleep(0.005)
+    for thread in threads:
+        thread.join()
+
+
+class TestGatedProtocol(EmulatedTestCase):
+    PLUGS = 1
+    BULBS = 0
+
+    def setUp(self):
+        super(TestGatedProtocol, self).setUp()
+        self.virtual[0].profile = Profile(latency=0.05)
+        self.recorder = _Recorder(self.protocol())
+
+    def plug(self, max_connections=1, **kwargs):
+        return SmartPlug(self.virtual[0].ip_address,
+                         GatedProtocol(self.recorder, max_connections),
+                         **kwargs)
+
+    def test_identical_reads_share_a_round_trip(self):
+        plug = self.plug()
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(plug.get_sysinfo()))
+            for _ in range(10)]
+        before = self.virtual[0].requests
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.virtual[0].requests - before, 1)
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(result[u"alias"] == u"plug 0"
+                            for result in results))
+        # every caller receives its own copy
+        self.assertEqual(len(set(id(result) for result in results)), 10)
+
+    def test_different_reads_are_not_shared(self):
+        plug = self.plug()
+        _run_threads([lambda: plug.get_sysinfo(),
+                      lambda: plug.get_emeter_realtime()])
+        self.assertEqual(len(self.recorder.requests), 2)
+
+    def test_connection_limit(self):
+        plug = self.plug(max_connections=2)
+        _run_threads([
+            lambda number=number: plug._query_helper(
+                u"system", u"get_sysinfo", {u"n": number})
+            for number in range(6)])
+        self.assertEqual(len(self.recorder.requests), 6)
+        self.assertEqual(self.recorder.max_active, 2)
+
+    def test_writes_are_ordered_and_alone(self):
+        plug = self.plug(max_connections=3)
+        targets = []
+        for number in range(8):
+            targets.append(plug.turn_on if number % 2 else plug.turn_off)
+            targets.append(plug.get_sysinfo)
+        _run_threads(targets)
+        states = [request[u"system"][u"set_relay_state"][u"state"]
+                  for request in self.recorder.requests
+                  if u"set_relay_state" in request[u"system"]]
+        self.assertEqual(states, [0, 1] * 4)
+        self.assertEqual(self.virtual[0].sysinfo[u"relay_state"], 1)
+
+    def test_read_after_write_is_not_shared(self):
+        plug = self.plug()
+        plug.turn_off()
+        results = {}
+
+        def read(name):
+            results[name] = plug.get_sysinfo()[u"relay_state"]
+
+        # the first read holds the gate while the others queue up
+        _run_threads([plug.get_emeter_realtime,
+                      lambda: read(u"before"),
+                      plug.turn_on,
+                      lambda: read(u"after")])
+        self.assertEqual(results, {u"before": 0, u"after": 1})
+
+    def test_deadline_while_waiting(self):
+        self.virtual[0].profile = Profile(latency=0.2)
+        protocol = GatedProtocol(self.recorder)
+        address = self.virtual[0].ip_address
+        holder = SmartPlug(address, protocol, timeout=2)
+        waiting = SmartPlug(address, protocol, timeout=0.05)
+        errors = []
+
+        def query(plug, number):
+            try:
+                plug._query_helper(u"system", u"get_sysinfo", {u"n": number})
+            except CommunicationError:
+                errors.append(number)
+
+        # the first query holds the gate far beyond the deadlines of the
+        # others, which give up while waiting and never reach the device
+        _run_threads([lambda: query(holder, 0)] +
+                     [lambda number=number: query(waiting, number)
+                      for number in range(1, 4)])
+        self.assertEqual(sorted(errors), [1, 2, 3])
+        self.assertEqual(len(self.recorder.requests), 1)
+
+    def test_leader_deadline_is_not_passed_on(self):
+        self.virtual[0].profile = Profile(latency=0.3)
+        protocol = GatedProtocol(self.recorder)
+        address = self.virtual[0].ip_address
+        request = {u"system": {u"get_sysinfo": {}}}
+        results = {}
+
+        def query(name, deadline):
+            try:
+                results[name] = protocol.query(address, request,
+                                               deadline=deadline)
+            except socket.timeout:
+                results[name] = None
+
+        # the first read gives up while being sent, the second one while
+        # waiting behind a write; both are sent again for the reads with
+        # more time left
+        _run_threads([lambda: query(u"sending", time.time() + 0.1),
+                      lambda: query(u"patient", None),
+                      lambda: protocol.query(
+                          address, {u"system": {u"set_relay_state":
+                                                {u"state": 1}}}),
+                      lambda: query(u"waiting", time.time() + 0.1),
+                      lambda: query(u"later", time.time() + 5)])
+        self.assertIsNone(results[u"sending"])
+        self.assertIsNone(results[u"waiting"])
+        self.assertEqual(
+            results[u"patient"][u"system"][u"get_sysinfo"][u"alias"],
+            u"plug 0")
+        self.assertEqual(
+            results[u"later"][u"system"][u"get_sysinfo"][u"relay_state"], 1)
@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+import time
+
+from .emulated import EmulatedTestCase
+from ..emulator import Profile
+from ..fleet import DeviceFleet
+from ..health import DeviceHealth
+from ..smartdevice import CircuitOpen, CommunicationError, DeviceTimeoutError
+from ..smartplug import SmartPlug
+
+
+class TestCircuitBreaker(EmulatedTestCase):
+    PLUGS = 1
+    BULBS = 0
+
+    def plug(self, **kwargs):
+        return SmartPlug(self.virtual[0].ip_address,
+                         self.protocol(read_timeout=0.05), **kwargs)
+
+    def test_no_circuit_breaking_by_default(self):
+        self.virtual[0].profile = Profile(loss=1.0)
+        plug = self.plug()
+        before = self.virtual[0].requests
+        for _ in range(5):
+            with self.assertRaises(DeviceTimeoutError):
+                plug.get_sysinfo()
+        self.assertEqual(self.virtual[0].requests - before, 5)
+        self.assertEqual(plug.health.consecutive_failures, 5)
+        self.assertEqual(plug.health.state, DeviceHealth.CLOSED)
+
+    def test_fleet_opts_in(self):
+        self.virtual[0].profile = Profile(loss=1.0)
+        plug = self.plug()
+        fleet = DeviceFleet([plug], failure_threshold=2)
+        for _ in range(3):
+            fleet.get_sysinfo()
+        self.assertEqual(plug.health.state, DeviceHealth.OPEN)
+        result, = fleet.get_sysinfo()
+        self.assertIsInstance(result.exception, CircuitOpen)
+
+    def test_retries_count_as_one_failure(self):
+        self.virtual[0].profile = Profile(loss=1.0)
+        plug = self.plug(retries=2)
+        before = self.virtual[0].requests
+        with self.assertRaises(DeviceTimeoutError):
+            plug.get_sysinfo()
+        self.assertEqual(self.virtual[0].requests - before, 3)
+        self.assertEqual(plug.health.consecutive_failures, 1)
+        self.assertEqual(plug.health.state, DeviceHealth.CLOSED)
+
+    def test_opens_after_threshold_and_fails_fast(self):
+        self.virtual[0].profile = Profile(loss=1.0)
+        plug = self.plug(health=DeviceHealth(failure_threshold=2,
+                                             reset_timeout=60))
+        for _ in range(2):
+            with self.assertRaises(DeviceTimeoutError):
+                plug.get_sysinfo()
+        self.assertEqual(plug.health.state, DeviceHealth.OPEN)
+
+        before = self.virtual[0].requests
+        start = time.time()
+        with self.assertRaises(CircuitOpen):
+            plug.get_sysinfo()
+        self.assertLess(time.time() - start, 0.05)
+        self.assertEqual(self.virtual[0].requests, before)
+
+    def test_half_open_probe(self):
+        self.virtual[0].profile = Profile(loss=1.0)
+        plug = self.plug(health=DeviceHealth(failure_threshold=1,
+                                             reset_timeout=0.2))
+        with self.assertRaises(CommunicationError):
+            plug.get_sysinfo()
+        time.sleep(0.2)
+        self.assertEqual(plug.health.state, DeviceHealth.HALF_OPEN)
+        with self.assertRaises(DeviceTimeoutError):
+            plug.get_sysinfo()
+        self.assertEqual(plug.health.state, DeviceHealth.OPEN)
+
+        time.sleep(0.2)
+        self.virtual[0].profile = Profile()
+        self.assertEqual(plug.get_sysinfo()[u"alias"], u"plug 0")
+        self.assertEqual(plug.health.state, DeviceHealth.CLOSED)
+        self.assertIsNotNone(plug.health.latency)
+        self.assertIsNotNone(plug.health.last_success)
+
+    def test_device_errors_do_not_count(self):
+        plug = self.plug(health=DeviceHealth(failure_threshold=1))
+        with self.assertRaises(Exception):
+            plug._query_helper(u"system", u"unknown")
+        self.assertEqual(plug.health.state, DeviceHealth.CLOSED)
+        self.assertEqual(plug.health.consecutive_failures, 0)
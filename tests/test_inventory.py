@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+
+from .emulated import EmulatedTestCase
+from ..inventory import DeviceInventory
+from ..smartbulb import SmartBulb
+from ..smartplug import SmartPlug
+
+
+class TestInventory(EmulatedTestCase):
+    PLUGS = 2
+    BULBS = 1
+
+    def setUp(self):
+        super(TestInventory, self).setUp()
+        self.inventory = DeviceInventory(u":memory:",
+                                         protocol=self.protocol())
+        self.addCleanup(self.inventory.close)
+        self.devices = [
+            SmartPlug(self.virtual[0].ip_address, self.protocol()),
+            SmartPlug(self.virtual[1].ip_address, self.protocol()),
+            SmartBulb(self.virtual[2].ip_address, self.protocol()),
+        ]
+
+    def test_record_all(self):
+        macs = self.inventory.record_all(self.devices)
+        self.assertEqual(macs, [virtual.mac(u"")
+                                for virtual in self.virtual])
+        self.assertEqual(len(self.inventory), 3)
+
+    def test_record_updates_the_entry(self):
+        plug = self.devices[0]
+        mac = self.inventory.record(plug)
+        sysinfo = dict(self.virtual[0].get_sysinfo({}), alias=u"Kitchen")
+        moved = SmartPlug(u"127.0.1.200", self.protocol())
+        self.assertEqual(self.inventory.record(moved, sysinfo), mac)
+
+        self.assertEqual(len(self.inventory), 1)
+        entry = self.inventory.get(mac)
+        self.assertEqual(entry[u"ip_address"], u"127.0.1.200")
+        self.assertEqual(entry[u"alias"], u"Kitchen")
+        self.assertEqual(entry[u"sysinfo"][u"alias"], u"Kitchen")
+
+    def test_lookup_by_mac(self):
+        self.inventory.record_all(self.devices)
+        bulb = self.virtual[2]
+        # plugs report the mac with colons, bulbs without
+        for mac in (bulb.mac(), bulb.mac(u""), bulb.mac(u"-").lower()):
+            entry = self.inventory.get(mac)
+            self.assertEqual(entry[u"mac"], bulb.mac(u""))
+            self.assertEqual(entry[u"ip_address"], bulb.ip_address)
+            self.assertEqual(entry[u"device_class"], u"SmartBulb")
+        self.assertIsNone(self.inventory.get(u"00:00:00:00:00:00"))
+        self.assertIsNone(self.inventory.device(u"00:00:00:00:00:00"))
+
+    def test_device_is_created_without_a_query(self):
+        self.inventory.record_all(self.devices)
+        before = [virtual.requests for virtual in self.virtual]
+        device = self.inventory.device(self.virtual[1].mac())
+        self.assertIsInstance(device, SmartPlug)
+        self.assertEqual(device.ip_address, self.virtual[1].ip_address)
+        self.assertEqual([virtual.requests for virtual in self.virtual],
+                         before)
+
+    def test_load(self):
+        self.inventory.record_all(self.devices)
+        devices = self.inventory.load()
+        self.assertEqual(
+            dict((mac, (type(device), device.ip_address))
+                 for mac, device in devices.items()),
+            dict((virtual.mac(u""),
+                  (SmartBulb if virtual is self.virtual[2] else SmartPlug,
+                   virtual.ip_address))
+                 for virtual in self.virtual))
+
+    def test_remove(self):
+        self.inventory.record_all(self.devices)
+        self.inventory.remove(self.virtual[0].mac())
+        self.assertEqual(len(self.inventory), 2)
+        self.assertIsNone(self.inventory.get(self.virtual[0].mac()))
@@ -0,0 +1,90 @@
+from __future__ import absolute_import
+import errno
+import socket
+import unittest
+
+from .. import metrics
+from ..metrics import MetricsRegistry
+
+
+class TestRender(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        counter = self.registry.counter(u"tplink_test_total", u"Test count.",
+                                        (u"host", u"cmd"))
+        counter.inc((u"127.0.0.2", u"get_sysinfo"))
+        counter.inc((u"127.0.0.1", u"get_sysinfo"), 2)
+        counter.inc((u"127.0.0.2", u"get_sysinfo"))
+        counter.inc((u"127.0.0.1", u"set_relay_state"), 0.5)
+        self.assertEqual(self.registry.render(), u"\n".join([
+            u"# HELP tplink_test_total Test count.",
+            u"# TYPE tplink_test_total counter",
+            u"tplink_test_total{host=\"127.0.0.1\",cmd=\"get_sysinfo\"} 2",
+            u"tplink_test_total{host=\"127.0.0.1\",cmd=\"set_relay_state\"}"
+            u" 0.5",
+            u"tplink_test_total{host=\"127.0.0.2\",cmd=\"get_sysinfo\"} 2",
+        ]) + u"\n")
+        self.assertEqual(counter.value((u"127.0.0.2", u"get_sysinfo")), 2)
+        self.assertEqual(counter.value((u"127.0.0.3", u"get_sysinfo")), 0)
+
+    def test_histogram(self):
+        histogram = self.registry.histogram(
+            u"tplink_test_seconds", u"Test duration.", (u"host",),
+            buckets=(1.0, 0.1))
+        for value in (0.25, 0.5, 0.1, 3.0):
+            histogram.observe((u"127.0.0.1",), value)
+        self.assertEqual(self.registry.render(), u"\n".join([
+            u"# HELP tplink_test_seconds Test duration.",
+            u"# TYPE tplink_test_seconds histogram",
+            u"tplink_test_seconds_bucket{host=\"127.0.0.1\",le=\"0.1\"} 1",
+            u"tplink_test_seconds_bucket{host=\"127.0.0.1\",le=\"1.0\"} 3",
+            u"tplink_test_seconds_bucket{host=\"127.0.0.1\",le=\"+Inf\"} 4",
+            u"tplink_test_seconds_sum{host=\"127.0.0.1\"} 3.85",
+            u"tplink_test_seconds_count{host=\"127.0.0.1\"} 4",
+        ]) + u"\n")
+        self.assertEqual(histogram.count((u"127.0.0.1",)), 4)
+
+    def test_metrics_in_registration_order(self):
+        self.registry.counter(u"tplink_b_total", u"B.")
+        self.registry.histogram(u"tplink_a_seconds", u"A.")
+        counter = self.registry.counter(u"tplink_c_total", u"C.")
+        counter.inc()
+        self.assertEqual(self.registry.render(), u"\n".join([
+            u"# HELP tplink_b_total B.",
+            u"# TYPE tplink_b_total counter",
+            u"# HELP tplink_a_seconds A.",
+            u"# TYPE tplink_a_seconds histogram",
+            u"# HELP tplink_c_total C.",
+            u"# TYPE tplink_c_total counter",
+            u"tplink_c_total 1",
+        ]) + u"\n")
+
+    def test_label_values_are_escaped(self):
+        counter = self.registry.counter(u"tplink_test_total", u"Test count.",
+                                        (u"alias",))
+        counter.inc((u"say \"hi\"\\\nbye",))
+        self.assertEqual(
+            self.registry.render().splitlines()[-1],
+            u"tplink_test_total{alias=\"say \\\"hi\\\"\\\\\\nbye\"} 1")
+
+
+class TestLabels(unittest.TestCase):
+    def test_request_labels(self):
+        self.assertEqual(
+            metrics.request_labels({u"system": {u"get_sysinfo": None}}),
+            (u"system", u"get_sysinfo"))
+        self.assertEqual(
+            metrics.request_labels({u"time": {u"get_time": None},
+                                    u"emeter": {u"get_realtime": {}}}),
+            (u"emeter,time", u"get_realtime,get_time"))
+        self.assertEqual(metrics.request_labels(u"garbage"),
+                         (u"unknown", u"unknown"))
+
+    def test_failure_kind(self):
+        refused = socket.error(errno.ECONNREFUSED, u"Connection refused")
+        self.assertEqual(metrics.failure_kind(socket.timeout()), u"timeout")
+        self.assertEqual(metrics.failure_kind(refused), u"refused")
+        self.assertEqual(metrics.failure_kind(socket.error()), u"network")
+        self.assertEqual(metrics.failure_kind(ValueError()), u"protocol")
@@ -0,0 +1,83 @@
+from __future__ import absolute_import
+import socket
+import time
+
+from .emulated import EmulatedTestCase
+from ..emulator import Profile
+from ..multiplex import MultiplexedTPLinkSmartHomeProtocol
+
+SYSINFO = {u"system": {u"get_sysinfo": None}}
+
+
+def _alias(result):
+    return result[u"system"][u"get_sysinfo"][u"alias"]
+
+
+class TestMultiplexedProtocol(EmulatedTestCase):
+    PLUGS = 3
+    BULBS = 0
+
+    def test_interleaved_responses(self):
+        # the answers arrive in the reverse order of the queries
+        for device, latency in zip(self.virtual, (0.2, 0.1, 0.0)):
+            device.profile = Profile(latency=latency)
+        engine = MultiplexedTPLinkSmartHomeProtocol()
+        positions = [engine.submit(device.ip_address, SYSINFO,
+                                   self.emulator.port)
+                     for device in self.virtual]
+        self.assertEqual(positions, [0, 1, 2])
+        start = time.time()
+        results = engine.collect()
+        # run at once, not one after the other
+        self.assertLess(time.time() - start, 0.28)
+        self.assertEqual([_alias(result) for result in results],
+                         [u"plug 0", u"plug 1", u"plug 2"])
+        # collect() runs only what was submitted since the last call
+        self.assertEqual(engine.collect(), [])
+
+    def test_slow_and_unreachable_hosts(self):
+        self.virtual[0].profile = Profile(latency=2.0)
+        engine = MultiplexedTPLinkSmartHomeProtocol(timeout=0.2)
+        start = time.time()
+        results = engine.query_many(
+            [(device.ip_address, SYSINFO) for device in self.virtual] +
+            # nothing listens on this address
+            [(u"127.0.2.1", SYSINFO)],
+            port=self.emulator.port)
+        self.assertLess(time.time() - start, 1.0)
+        self.assertIsInstance(results[0], socket.timeout)
+        self.assertEqual([_alias(result) for result in results[1:3]],
+                         [u"plug 1", u"plug 2"])
+        self.assertIsInstance(results[3], socket.error)
+
+    def test_query_deadline(self):
+        self.virtual[0].profile = Profile(latency=2.0)
+        engine = MultiplexedTPLinkSmartHomeProtocol(timeout=5)
+        start = time.time()
+        with self.assertRaises(socket.timeout):
+            engine.query(self.virtual[0].ip_address, SYSINFO,
+                         self.emulator.port, deadline=time.time() + 0.1)
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_connection_limit(self):
+        counts = {u"open": 0, u"max": 0}
+
+        class Counting(MultiplexedTPLinkSmartHomeProtocol):
+            def _start(self, query, poller):
+                counts[u"open"] += 1
+                counts[u"max"] = max(counts[u"max"], counts[u"open"])
+                super(Counting, self)._start(query, poller)
+
+            def _finish(self, query, poller, active):
+                counts[u"open"] -= 1
+                super(Counting, self)._finish(query, poller, active)
+
+        for device in self.virtual:
+            device.profile = Profile(latency=0.05)
+        engine = Counting(max_connections=2)
+        results = engine.query_many(
+            [(device.ip_address, SYSINFO) for device in self.virtual] * 3,
+            port=self.emulator.port)
+        self.assertEqual([_alias(result) for result in results],
+                         [u"plug 0", u"plug 1", u"plug 2"] * 3)
+        self.assertEqual(counts, {u"open": 0, u"max": 2})
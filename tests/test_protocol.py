@@ -0,0 +1,324 @@
+from __future__ import absolute_import
+import json
+import socket
+import struct
+import threading
+import time
+import unittest
+
+try:
+    import trollius as asyncio
+except ImportError:
+    asyncio = None
+
+from .emulated import EmulatedTestCase
+from .. import metrics
+from ..emulator import Profile
+from ..multiplex import MultiplexedTPLinkSmartHomeProtocol
+from ..protocol import (PooledTPLinkSmartHomeProtocol, ResponseFrame,
+                        TPLinkSmartHomeProtocol)
+from ..smartdevice import SmartDeviceException
+
+SYSINFO = {u"system": {u"get_sysinfo": None}}
+
+
+class TestPooledProtocol(EmulatedTestCase):
+    PLUGS = 1
+    BULBS = 0
+
+    def test_deadline_does_not_stick_to_pooled_socket(self):
+        protocol = self.protocol(PooledTPLinkSmartHomeProtocol,
+                                 read_timeout=2)
+        self.addCleanup(protocol.close)
+        host = self.virtual[0].ip_address
+        protocol.query(host, SYSINFO, deadline=time.time() + 0.05)
+        self.assertEqual(protocol.idle_connections, 1)
+
+        self.virtual[0].profile = Profile(latency=0.2)
+        response = protocol.query(host, SYSINFO)
+        self.assertIn(u"system", response)
+
+    def test_deadline(self):
+        protocol = self.protocol(PooledTPLinkSmartHomeProtocol)
+        self.addCleanup(protocol.close)
+        self.virtual[0].profile = Profile(latency=0.5)
+        start = time.time()
+        with self.assertRaises(socket.timeout):
+            protocol.query(self.virtual[0].ip_address, SYSINFO,
+                           deadline=time.time() + 0.1)
+        self.assertLess(time.time() - start, 0.4)
+
+
+    def test_connection_limit(self):
+        active = []
+
+        class Counting(PooledTPLinkSmartHomeProtocol):
+            def _pooled_query(self, *args):
+                active.append(self.active_connections)
+                return super(Counting, self)._pooled_query(*args)
+
+        protocol = self.protocol(Counting, max_connections=2)
+        self.addCleanup(protocol.close)
+        self.virtual[0].profile = Profile(latency=0.05)
+        threads = [threading.Thread(target=protocol.query,
+                                    args=(self.virtual[0].ip_address,
+                                          SYSINFO))
+                   for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(active), 6)
+        self.assertEqual(max(active), 2)
+        self.assertEqual(protocol.active_connections, 0)
+        # the idle connections are limited separately
+        self.assertEqual(protocol.idle_connections, 1)
+
+    def test_deadline_while_waiting_for_connection(self):
+        protocol = self.protocol(PooledTPLinkSmartHomeProtocol,
+                                 max_connections=1)
+        self.addCleanup(protocol.close)
+        self.virtual[0].profile = Profile(latency=0.3)
+        host = self.virtual[0].ip_address
+        holder = threading.Thread(target=protocol.query,
+                                  args=(host, SYSINFO))
+        holder.start()
+        self.addCleanup(holder.join)
+        time.sleep(0.05)
+        requests = self.virtual[0].requests
+        with self.assertRaises(socket.timeout):
+            protocol.query(host, SYSINFO, deadline=time.time() + 0.05)
+        self.assertEqual(self.virtual[0].requests, requests)
+
+
+class TestMeasurement(EmulatedTestCase):
+    PLUGS = 1
+    BULBS = 0
+
+    def setUp(self):
+        super(TestMeasurement, self).setUp()
+        metrics.enable()
+        self.addCleanup(metrics.disable)
+
+    def assertMeasured(self, protocol, queries=2):
+        host = self.virtual[0].ip_address
+        labels = (host, u"system", u"get_sysinfo")
+        before = metrics.QUERIES.value(labels)
+        phases = [metrics.PHASE_SECONDS.count((host, phase))
+                  for phase in metrics.PHASES]
+        received = metrics.BYTES_RECEIVED.value((host,))
+        for _ in range(queries):
+            protocol.query(host, SYSINFO)
+        self.assertEqual(metrics.QUERIES.value(labels) - before, queries)
+        for phase, count in zip(metrics.PHASES, phases):
+            self.assertEqual(
+                metrics.PHASE_SECONDS.count((host, phase)) - count, queries)
+        self.assertGreater(metrics.BYTES_RECEIVED.value((host,)), received)
+
+    def test_query(self):
+        self.assertMeasured(self.protocol(TPLinkSmartHomeProtocol))
+
+    def test_pooled_query(self):
+        protocol = self.protocol(PooledTPLinkSmartHomeProtocol)
+        self.addCleanup(protocol.close)
+        self.assertMeasured(protocol)
+        self.assertEqual(protocol.idle_connections, 1)
+
+    def test_multiplexed_query(self):
+        self.assertMeasured(self.protocol(MultiplexedTPLinkSmartHomeProtocol))
+
+    def test_failure(self):
+        protocol = self.protocol(PooledTPLinkSmartHomeProtocol)
+        self.addCleanup(protocol.close)
+        host = self.virtual[0].ip_address
+        labels = (host, u"system", u"get_sysinfo", u"timeout")
+        before = metrics.FAILURES.value(labels)
+        self.virtual[0].profile = Profile(latency=0.5)
+        with self.assertRaises(socket.timeout):
+            protocol.query(host, SYSINFO, deadline=time.time() + 0.1)
+        self.assertEqual(metrics.FAILURES.value(labels) - before, 1)
+
+
+class _OversizedServer(object):
+    u"""
+    Server answering every request with the given length header, followed
+    by the given body.
+    """
+
+    def __init__(self, length, body=b""):
+        self.header = struct.pack(b">I", length)
+        self.body = body
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind((u"127.0.0.1", 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            try:
+                conn.recv(4096)
+                conn.sendall(self.header + self.body)
+            except socket.error:
+                # the client gave up on the response
+                pass
+            finally:
+                conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
+class _Chunks(object):
+    u"""
+    Socket handing out the given chunks, then EOF.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, buffer):
+        chunk = self.chunks.pop(0)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def recv(self, size):
+        return self.chunks.pop(0) if self.chunks else b""
+
+
+class TestMaxLength(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _OversizedServer(ResponseFrame.MAX_LENGTH + 1)
+        self.addCleanup(self.server.close)
+
+    def assertRejected(self, protocol):
+        with self.assertRaises(SmartDeviceException):
+            protocol.query(u"127.0.0.1", SYSINFO, port=self.server.port)
+
+    def test_query(self):
+        self.assertRejected(TPLinkSmartHomeProtocol())
+
+    def test_pooled_query(self):
+        protocol = PooledTPLinkSmartHomeProtocol()
+        self.addCleanup(protocol.close)
+        self.assertRejected(protocol)
+        self.assertEqual(protocol.idle_connections, 0)
+
+    def test_multiplexed_query(self):
+        self.assertRejected(MultiplexedTPLinkSmartHomeProtocol())
+
+    def test_largest_length_is_accepted(self):
+        frame = ResponseFrame()
+        header = struct.pack(b">I", ResponseFrame.MAX_LENGTH)
+        frame.read_from(_Chunks([header]))
+        self.assertEqual(len(frame.payload), ResponseFrame.MAX_LENGTH)
+
+    def test_response_read_until_eof(self):
+        frame = ResponseFrame()
+        chunk = b"x" * ResponseFrame.CHUNK_SIZE
+        count = ResponseFrame.MAX_LENGTH // len(chunk) + 1
+        sock = _Chunks([struct.pack(b">I", 0)] + [chunk] * count)
+        with self.assertRaises(SmartDeviceException):
+            while not frame.read_from(sock):
+                pass
+
+
+@unittest.skipIf(asyncio is None, u"trollius is not installed")
+class TestAsyncMaxLength(unittest.TestCase):
+
+    def setUp(self):
+        from ..asyncprotocol import AsyncTPLinkSmartHomeProtocol
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.protocol = AsyncTPLinkSmartHomeProtocol(loop=self.loop)
+
+    def assertRejected(self, server):
+        self.addCleanup(server.close)
+        with self.assertRaises(SmartDeviceException):
+            self.loop.run_until_complete(self.protocol.query(
+                u"127.0.0.1", SYSINFO, port=server.port))
+
+    def test_length_header(self):
+        self.assertRejected(_OversizedServer(ResponseFrame.MAX_LENGTH + 1))
+
+    def test_response_read_until_eof(self):
+        self.assertRejected(_OversizedServer(
+            0, b"x" * (ResponseFrame.MAX_LENGTH + ResponseFrame.CHUNK_SIZE)))
+
+
+class _OneShotServer(object):
+    u"""
+    Server answering the first request on every connection, and closing
+    the connection without an answer on the second one.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind((u"127.0.0.1", 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        try:
+            for answered in (True, False):
+                frame = ResponseFrame()
+                while not frame.read_from(conn):
+                    pass
+                self.requests.append(json.loads(
+                    TPLinkSmartHomeProtocol.decrypt(frame.payload)))
+                if answered:
+                    conn.sendall(TPLinkSmartHomeProtocol.encrypt(
+                        json.dumps({u"system": {}})))
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
+class TestPooledResend(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _OneShotServer()
+        self.addCleanup(self.server.close)
+        self.protocol = PooledTPLinkSmartHomeProtocol()
+        self.addCleanup(self.protocol.close)
+        self.query(SYSINFO)
+        self.assertEqual(self.protocol.idle_connections, 1)
+
+    def query(self, request):
+        return self.protocol.query(u"127.0.0.1", request,
+                                   port=self.server.port)
+
+    def test_read_is_sent_again(self):
+        self.assertEqual(self.query(SYSINFO), {u"system": {}})
+        self.assertEqual(self.server.requests, [SYSINFO] * 3)
+
+    def test_write_is_not_sent_again(self):
+        request = {u"system": {u"set_relay_state": {u"state": 1}}}
+        with self.assertRaises(socket.error):
+            self.query(request)
+        self.assertEqual(self.server.requests, [SYSINFO, request])
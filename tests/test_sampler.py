@@ -0,0 +1,38 @@
+from __future__ import absolute_import
+
+from .emulated import EmulatedTestCase
+from ..sampler import EmeterSampler
+from ..smartbulb import SmartBulb
+from ..smartplug import SmartPlug
+
+
+class TestEmeterSampler(EmulatedTestCase):
+    PLUGS = 1
+    BULBS = 1
+
+    def test_samples_are_fresh_despite_cache_ttl(self):
+        plug = SmartPlug(self.virtual[0].ip_address, self.protocol(),
+                         cache_ttl=60)
+        plug.seed_cache(dict(self.virtual[0].get_sysinfo({})),
+                        {u"power": 1.0, u"voltage": 1.0, u"current": 1.0,
+                         u"total": 1.0})
+        sampler = EmeterSampler([plug], capacity=10)
+        before = self.virtual[0].requests
+        for tick in range(5):
+            self.assertEqual(sampler.sample(timestamp=1000.0 + tick), 1)
+        self.assertEqual(self.virtual[0].requests - before, 5)
+
+        window = sampler.window(plug, count=5)
+        self.assertEqual(list(window.timestamp),
+                         [1000.0, 1001.0, 1002.0, 1003.0, 1004.0])
+        # the emulated plug draws a randomly varying load
+        self.assertEqual(len(set(window.power)), 5)
+        self.assertNotIn(1.0, list(window.power))
+
+    def test_units_are_normalized(self):
+        plug = SmartPlug(self.virtual[0].ip_address, self.protocol())
+        bulb = SmartBulb(self.virtual[1].ip_address, self.protocol())
+        sampler = EmeterSampler([plug, bulb], capacity=10)
+        self.assertEqual(sampler.sample(timestamp=1000.0), 2)
+        for device in (plug, bulb):
+            self.assertTrue(sampler.latest(device) is not None)
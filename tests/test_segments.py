@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+import io
+import math
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from .. import segments
+from ..segments import (HEADER, MAGIC, RECORD, VERSION, SegmentReader,
+                        SegmentWriter, _segment_name, _store_devices)
+
+
+class TestSegmentReader(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        _store_devices(self.directory, [u"plug"])
+        path = os.path.join(self.directory, _segment_name(1000.0))
+        # stands in for the writer appending to the newest segment
+        self.segment = io.open(path, u"wb")
+        self.addCleanup(self.segment.close)
+        self.segment.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+
+    def append(self, *timestamps):
+        for timestamp in timestamps:
+            self.segment.write(RECORD.pack(timestamp, 0, 1.0, 230.0, 0.01,
+                                           2.0))
+        self.segment.flush()
+
+    @staticmethod
+    def timestamps(records):
+        return [float(record[0]) for record in records]
+
+    def test_reads_records_appended_after_mapping(self):
+        self.append(1000.0, 1001.0)
+        with SegmentReader(self.directory) as reader:
+            first = reader.read()
+            self.assertEqual(self.timestamps(first), [1000.0, 1001.0])
+
+            self.append(1002.0, 1003.0)
+            self.assertEqual(self.timestamps(reader.read()),
+                             [1000.0, 1001.0, 1002.0, 1003.0])
+            self.assertEqual(self.timestamps(reader.read(start=1002.5)),
+                             [1003.0])
+            # records returned before the segment grew stay readable
+            self.assertEqual(self.timestamps(first), [1000.0, 1001.0])
+
+    def test_segment_without_records(self):
+        self.segment.flush()
+        with SegmentReader(self.directory) as reader:
+            self.assertEqual(len(reader.read()), 0)
+            self.append(1000.0)
+            self.assertEqual(self.timestamps(reader.read(start=999.0)),
+                             [1000.0])
+
+
+class TestSegmentWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def read(self):
+        with SegmentReader(self.directory) as reader:
+            return [tuple(record) for record in reader.read()]
+
+    def test_missing_and_invalid_values(self):
+        with SegmentWriter(self.directory) as writer:
+            self.assertTrue(writer.append(1000.0, u"plug", None, 230.0, 0.01,
+                                          2.0))
+            with self.assertRaises(ValueError):
+                writer.append(1001.0, u"plug", u"high", 230.0, 0.01, 2.0)
+        record, = self.read()
+        self.assertTrue(math.isnan(record[2]))
+        self.assertEqual(record[3:], (230.0, 0.01, 2.0))
+
+    def test_failed_batch_is_dropped(self):
+        store = segments._store_devices
+        self.addCleanup(setattr, segments, u"_store_devices", store)
+
+        def fail_once(directory, devices):
+            segments._store_devices = store
+            raise IOError(u"disk full")
+
+        segments._store_devices = fail_once
+        with SegmentWriter(self.directory) as writer:
+            writer.append(1000.0, u"plug", 1.0, 230.0, 0.01, 2.0)
+            deadline = time.time() + 5
+            while not writer.dropped and time.time() < deadline:
+                time.sleep(0.01)
+            # the writer keeps going, storing the devices with the next batch
+            writer.append(1001.0, u"plug", 1.0, 230.0, 0.01, 2.0)
+        self.assertEqual(writer.dropped, 1)
+        self.assertEqual(self.read(), [(1001.0, 0, 1.0, 230.0, 0.01, 2.0)])
+        self.assertEqual(SegmentReader(self.directory).devices, [u"plug"])
+
+    def test_records_written_before_a_failure_are_kept(self):
+        class FailingWriter(SegmentWriter):
+            def _open_segment(self, timestamp):
+                if self._file is not None:
+                    raise IOError(u"disk full")
+                super(FailingWriter, self)._open_segment(timestamp)
+
+        writer = FailingWriter(self.directory, segment_records=2)
+        writer.close()
+        # a single batch, written from the test
+        writer._write([(float(timestamp), u"plug", 1.0, 230.0, 0.01, 2.0)
+                       for timestamp in range(1000, 1005)])
+        writer._file.close()
+        self.assertEqual(writer.dropped, 3)
+        self.assertEqual([record[0] for record in self.read()],
+                         [1000.0, 1001.0])
+
+    def test_close_after_writer_died(self):
+        writer = SegmentWriter(self.directory, queue_size=1)
+        writer._write = lambda samples: exit()
+        writer.append(1000.0, u"plug", 1.0, 230.0, 0.01, 2.0)
+        writer._thread.join()
+        writer.append(1001.0, u"plug", 1.0, 230.0, 0.01, 2.0)
+        writer.close()
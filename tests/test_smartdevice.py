@@ -0,0 +1,343 @@
+from __future__ import absolute_import
+import datetime
+import errno
+import socket
+import sys
+import time
+import traceback
+
+from .emulated import EmulatedTestCase
+from .. import metrics, tracing
+from ..emulator import Profile
+from ..gate import GatedProtocol
+from ..smartdevice import CommunicationError, DeviceError
+from ..smartbulb import SmartBulb
+from ..smartplug import SmartPlug
+
+
+class TestCaching(EmulatedTestCase):
+    PLUGS = 1
+    BULBS = 0
+
+    def plug(self, cache_ttl):
+        return SmartPlug(self.virtual[0].ip_address, self.protocol(),
+                         cache_ttl=cache_ttl)
+
+    def test_sysinfo_is_cached(self):
+        plug = self.plug(cache_ttl=60)
+        before = self.virtual[0].requests
+        plug.alias
+        plug.model
+        plug.is_on
+        self.assertEqual(self.virtual[0].requests - before, 1)
+
+    def test_no_caching_by_default(self):
+        plug = SmartPlug(self.virtual[0].ip_address, self.protocol())
+        before = self.virtual[0].requests
+        plug.alias
+        plug.alias
+        self.assertEqual(self.virtual[0].requests - before, 2)
+
+    def test_cache_expires(self):
+        plug = self.plug(cache_ttl=0.1)
+        plug.alias
+        self.virtual[0].sysinfo[u"alias"] = u"renamed"
+        self.assertEqual(plug.alias, u"plug 0")
+        time.sleep(0.15)
+        self.assertEqual(plug.alias, u"renamed")
+
+    def test_setters_invalidate(self):
+        plug = self.plug(cache_ttl=None)
+        self.assertTrue(plug.is_on)
+        plug.turn_off()
+        self.assertFalse(plug.is_on)
+        plug.alias = u"renamed"
+        self.assertEqual(plug.alias, u"renamed")
+
+    def test_update_and_invalidate(self):
+        plug = self.plug(cache_ttl=None)
+        plug.alias
+        self.virtual[0].sysinfo[u"alias"] = u"renamed"
+        self.assertEqual(plug.alias, u"plug 0")
+        self.assertEqual(plug.update()[u"alias"], u"renamed")
+        self.virtual[0].sysinfo[u"alias"] = u"again"
+        plug.invalidate()
+        self.assertEqual(plug.alias, u"again")
+
+    def test_cache_info(self):
+        plug = self.plug(cache_ttl=60)
+        self.assertEqual(plug.cache_info(), (0, 0, None))
+        plug.alias
+        plug.model
+        plug.mac
+        hits, misses, age = plug.cache_info()
+        self.assertEqual((hits, misses), (2, 1))
+        self.assertGreaterEqual(age, 0)
+        plug.invalidate()
+        self.assertIsNone(plug.cache_info().age)
+
+    def test_realtime_readings_are_not_cached(self):
+        for cache_ttl in (60, None):
+            plug = self.plug(cache_ttl)
+            plug.has_emeter
+            before = self.virtual[0].requests
+            plug.get_emeter_realtime()
+            plug.get_emeter_realtime()
+            self.assertEqual(self.virtual[0].requests - before, 2)
+
+    def test_seeded_readings_are_used_once(self):
+        plug = self.plug(cache_ttl=60)
+        sysinfo = self.virtual[0].get_sysinfo({})
+        plug.seed_cache(dict(sysinfo), {u"power": 12.5})
+        before = self.virtual[0].requests
+        self.assertEqual(plug.get_emeter_realtime(), {u"power": 12.5})
+        self.assertEqual(self.virtual[0].requests, before)
+        self.assertNotEqual(plug.get_emeter_realtime(), {u"power": 12.5})
+        self.assertEqual(self.virtual[0].requests - before, 1)
+
+    def test_seeded_data_serves_first_use_without_caching(self):
+        plug = self.plug(cache_ttl=0)
+        sysinfo = dict(self.virtual[0].get_sysinfo({}), alias=u"seeded")
+        plug.seed_cache(sysinfo, {u"power": 12.5})
+        before = self.virtual[0].requests
+        self.assertEqual(plug.alias, u"seeded")
+        self.assertEqual(plug.get_emeter_realtime(), {u"power": 12.5})
+        self.assertEqual(self.virtual[0].requests, before)
+        self.assertEqual(plug.alias, u"plug 0")
+        self.assertEqual(self.virtual[0].requests - before, 1)
+
+    def test_update_drops_seeded_readings(self):
+        plug = self.plug(cache_ttl=None)
+        plug.seed_cache(dict(self.virtual[0].get_sysinfo({})),
+                        {u"power": 12.5})
+        plug.update()
+        self.assertNotEqual(plug.get_emeter_realtime(), {u"power": 12.5})
+
+
+class _FailingProtocol(object):
+    u"""
+    Protocol wrapper failing the first queries.
+    """
+
+    def __init__(self, protocol, failures):
+        self.protocol = protocol
+        self.failures = failures
+        self.calls = 0
+
+    def query(self, host, request, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise socket.error(errno.ECONNRESET, u"Connection reset")
+        return self.protocol.query(host, request, **kwargs)
+
+
+class TestHedging(EmulatedTestCase):
+    PLUGS = 1
+    BULBS = 0
+
+    def setUp(self):
+        super(TestHedging, self).setUp()
+        self.spans = tracing.SpanCollector()
+        tracing.add_hook(self.spans)
+        self.addCleanup(tracing.remove_hook, self.spans)
+
+    def test_hedged_round_trip_is_traced(self):
+        self.virtual[0].profile = Profile(latency=0.1)
+        plug = SmartPlug(self.virtual[0].ip_address, self.protocol(),
+                         hedge_after=0.02)
+        plug.get_sysinfo()
+
+        operation, = self.spans.spans
+        round_trip, = [child for child in operation.children
+                       if child.kind == tracing.ROUND_TRIP]
+        self.assertTrue(round_trip.attributes[u"hedged"])
+        # annotated by the protocol from the hedging threads
+        self.assertIn(u"phases", round_trip.attributes)
+        self.assertGreater(round_trip.attributes[u"response_bytes"], 0)
+        self.assertIs(tracing.current_span(), None)
+
+    def test_early_failure_is_hedged(self):
+        failing = _FailingProtocol(self.protocol(), failures=1)
+        plug = SmartPlug(self.virtual[0].ip_address, failing, hedge_after=5)
+        start = time.time()
+        self.assertEqual(plug.get_sysinfo()[u"alias"], u"plug 0")
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(failing.calls, 2)
+
+        operation = self.spans.spans[-1]
+        round_trip, = [child for child in operation.children
+                       if child.kind == tracing.ROUND_TRIP]
+        self.assertTrue(round_trip.attributes[u"hedged"])
+
+    def test_error_keeps_traceback(self):
+        for hedge_after in (None, 5):
+            failing = _FailingProtocol(self.protocol(), failures=2)
+            plug = SmartPlug(self.virtual[0].ip_address, failing,
+                             hedge_after=hedge_after)
+            try:
+                plug.get_sysinfo()
+            except CommunicationError:
+                functions = [frame[2] for frame
+                             in traceback.extract_tb(sys.exc_info()[2])]
+            else:
+                self.fail(u"CommunicationError not raised")
+            self.assertEqual(functions[-1], u"query")
+
+    def test_no_hedging_through_gate(self):
+        self.virtual[0].profile = Profile(latency=0.1)
+        plug = SmartPlug(self.virtual[0].ip_address,
+                         GatedProtocol(self.protocol()), hedge_after=0.02)
+        plug.get_sysinfo()
+
+        operation, = self.spans.spans
+        round_trip, = [child for child in operation.children
+                       if child.kind == tracing.ROUND_TRIP]
+        self.assertNotIn(u"hedged", round_trip.attributes)
+
+
+class TestTracing(EmulatedTestCase):
+    PLUGS = 1
+    BULBS = 1
+
+    def setUp(self):
+        super(TestTracing, self).setUp()
+        self.spans = tracing.SpanCollector()
+        tracing.add_hook(self.spans)
+        self.addCleanup(tracing.remove_hook, self.spans)
+
+    def test_slow_query_log(self):
+        log = tracing.SlowQueryLog(threshold=0.05, logger=None)
+        tracing.add_hook(log)
+        self.addCleanup(tracing.remove_hook, log)
+        plug = SmartPlug(self.virtual[0].ip_address, self.protocol())
+        plug.alias
+        self.assertEqual(list(log.entries), [])
+
+        self.virtual[0].profile = Profile(latency=0.1)
+        plug.get_sysinfo()
+        round_trip, operation = log.entries
+        self.assertEqual(round_trip[u"kind"], tracing.ROUND_TRIP)
+        self.assertEqual(round_trip[u"name"], u"system.get_sysinfo")
+        self.assertEqual(round_trip[u"host"], self.virtual[0].ip_address)
+        self.assertEqual(round_trip[u"request"],
+                         {u"system": {u"get_sysinfo": {}}})
+        self.assertGreater(round_trip[u"request_bytes"], 0)
+        self.assertGreater(round_trip[u"response_bytes"], 0)
+        self.assertEqual(set(round_trip[u"phases"]), set(metrics.PHASES))
+        self.assertGreaterEqual(round_trip[u"duration"], 0.1)
+        self.assertEqual(operation[u"kind"], tracing.OPERATION)
+        self.assertEqual(operation[u"name"], u"SmartPlug.get_sysinfo")
+        self.assertEqual(operation[u"round_trips"], 1)
+        self.assertIsNone(operation[u"error"])
+
+    def test_nested_operations(self):
+        bulb = SmartBulb(self.virtual[1].ip_address, self.protocol())
+        before = self.virtual[1].requests
+        repr(bulb)
+        requests = self.virtual[1].requests - before
+
+        operation, = self.spans.spans
+        self.assertEqual(operation.name, u"SmartBulb.__repr__")
+        self.assertEqual(operation.round_trips(), requests)
+        # the properties read by __repr__ are its children, each with the
+        # round trips it made
+        children = [child.name for child in operation.children]
+        for name in (u"alias", u"is_on", u"state_information"):
+            self.assertIn(u"SmartBulb." + name, children)
+        for child in operation.children:
+            self.assertEqual(child.kind, tracing.OPERATION)
+            self.assertGreater(child.round_trips(), 0)
+            self.assertIs(child.parent, operation)
+
+
+class TestQueryBatch(EmulatedTestCase):
+    PLUGS = 1
+    BULBS = 0
+
+    def test_repeated_commands(self):
+        plug = SmartPlug(self.virtual[0].ip_address, self.protocol())
+        year = datetime.date.today().year - 1
+        before = self.virtual[0].requests
+        results = plug.query_batch([
+            (u"system", u"get_sysinfo", None),
+            (u"emeter", u"get_daystat", {u"year": year, u"month": 1}),
+            (u"emeter", u"get_daystat", {u"year": year, u"month": 2}),
+            (u"system", u"get_sysinfo", None),
+            (u"emeter", u"get_daystat", {u"year": year, u"month": 1}),
+            (u"nonexistent", u"get_nothing", None),
+        ])
+        # only the repetition with other arguments needs another request
+        self.assertEqual(self.virtual[0].requests - before, 2)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(results[0][u"alias"], u"plug 0")
+        self.assertEqual(results[3], results[0])
+        self.assertEqual([day[u"month"] for day in results[1][u"day_list"]],
+                         [1] * 31)
+        self.assertEqual([day[u"month"] for day in results[2][u"day_list"]],
+                         [2] * len(results[2][u"day_list"]))
+        self.assertEqual(results[4], results[1])
+        self.assertIsInstance(results[5], DeviceError)
+        self.assertEqual(results[5].err_code, -1)
+
+    def test_communication_errors_are_returned(self):
+        plug = SmartPlug(self.virtual[0].ip_address, self.protocol())
+        self.emulator.stop()
+        results = plug.query_batch([(u"system", u"get_sysinfo", None),
+                                    (u"time", u"get_time", None)])
+        self.assertEqual(len(results), 2)
+        self.assertIsInstance(results[0], CommunicationError)
+        self.assertIs(results[1], results[0])
+
+
+class TestCapabilities(EmulatedTestCase):
+    PLUGS = 1
+    BULBS = 1
+
+    def test_capabilities_are_memoized(self):
+        plug = SmartPlug(self.virtual[0].ip_address, self.protocol(),
+                         cache_ttl=0)
+        before = self.virtual[0].requests
+        has_emeter = plug.has_emeter
+        features = plug._features
+        # a changed feature list under the same firmware is not noticed
+        self.virtual[0].sysinfo[u"feature"] = (u"TIM" if has_emeter
+                                               else u"TIM:ENE")
+        plug.update()
+        self.assertEqual(plug.has_emeter, has_emeter)
+        self.assertEqual(plug._features, features)
+        self.assertEqual(self.virtual[0].requests - before, 2)
+
+    def test_loaded_capabilities_need_no_query(self):
+        bulb = SmartBulb(self.virtual[1].ip_address, self.protocol())
+        sysinfo = dict(self.virtual[1].get_sysinfo({}), is_color=1,
+                       is_dimmable=0)
+        bulb.load_capabilities(sysinfo)
+        before = self.virtual[1].requests
+        self.assertTrue(bulb.is_color)
+        self.assertFalse(bulb.is_dimmable)
+        self.assertEqual(self.virtual[1].requests, before)
+
+    def test_firmware_change_resets_capabilities(self):
+        bulb = SmartBulb(self.virtual[1].ip_address, self.protocol())
+        sysinfo = dict(self.virtual[1].get_sysinfo({}), is_color=0)
+        bulb.load_capabilities(sysinfo)
+        self.assertFalse(bulb.is_color)
+
+        bulb.load_capabilities(dict(sysinfo, is_color=1))
+        self.assertFalse(bulb.is_color)
+        for key in SmartBulb.FIRMWARE_KEYS:
+            changed = dict(sysinfo, is_color=1)
+            changed[key] = u"2.0"
+            bulb.load_capabilities(changed)
+            self.assertTrue(bulb.is_color)
+            bulb.load_capabilities(sysinfo)
+            self.assertFalse(bulb.is_color)
+
+    def test_firmware_update_seen_by_update(self):
+        plug = SmartPlug(self.virtual[0].ip_address, self.protocol())
+        has_emeter = plug.has_emeter
+        self.virtual[0].sysinfo[u"feature"] = (u"TIM" if has_emeter
+                                               else u"TIM:ENE")
+        self.virtual[0].sysinfo[u"sw_ver"] = u"1.5.4 Build 180815 Rel.121440"
+        plug.update()
+        self.assertEqual(plug.has_emeter, not has_emeter)
@@ -0,0 +1,316 @@
+u"""
+Tracing of device operations and the network round trips they make.
+
+    log = tracing.SlowQueryLog(threshold=0.5)
+    tracing.add_hook(log)
+    bulb.state_information
+    for entry in log.entries:
+        print(entry)
+
+Public properties and methods of the device classes open an operation
+span, e.g. "SmartBulb.state_information", and every request sent to a
+device opens a round trip span, e.g. "system.get_sysinfo", as a child of
+the operation it was made for. Spans started by an operation running
+inside another one, like the properties read by __repr__, become its
+children, too. When the request is made by TPLinkSmartHomeProtocol the
+round trip span carries the sizes of the request and response and the
+duration of its connect, send, first byte, receive, decrypt and decode
+phases.
+
+Hooks are notified when spans start and finish. Tracing is active while
+at least one hook is registered; without hooks, the device classes only
+check a module level flag.
+"""
+from __future__ import absolute_import
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+_LOGGER = logging.getLogger(__name__)
+
+ENABLED = False
+
+OPERATION = u"operation"
+ROUND_TRIP = u"round_trip"
+
+_hooks = []  # type: List[Hook]
+_hooks_lock = threading.Lock()
+_local = threading.local()
+
+
+class Span(object):
+    u"""
+    A timed operation, with the spans started while it was running as
+    children.
+    """
+
+    def __init__(self, name, kind=OPERATION, parent=None, attributes=None):
+        self.name = name
+        self.kind = kind
+        self.parent = parent  # type: Optional[Span]
+        self.attributes = attributes or {}  # type: Dict[str, Any]
+        self.children = []  # type: List[Span]
+        self.start = time.time()
+        self.end = None  # type: Optional[float]
+        self.error = None  # type: Optional[str]
+
+    def __repr__(self):
+        return u"<Span %s %s>" % (self.name, u"%.1f ms" % (
+            self.duration * 1000) if self.end is not None else u"running")
+
+    @property
+    def duration(self):
+        u"""
+        Seconds the span took, None while it is running.
+
+        :rtype: float
+        """
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def round_trips(self):
+        u"""
+        Number of round trip spans in this span and its descendants.
+
+        :rtype: int
+        """
+        count = 1 if self.kind == ROUND_TRIP else 0
+        return count + sum(child.round_trips() for child in self.children)
+
+
+class Hook(object):
+    u"""
+    Receiver of span notifications. Subclasses override the methods they
+    need; exceptions raised by hooks are logged and otherwise ignored.
+    """
+
+    def span_started(self, span):
+        u"""
+        Called when a span starts.
+
+        :param Span span: the started span
+        """
+
+    def span_finished(self, span):
+        u"""
+        Called when a span finishes, after all of its children.
+
+        :param Span span: the finished span
+        """
+
+
+def add_hook(hook):
+    u"""
+    Register a hook and enable tracing.
+
+    :param Hook hook: hook to notify
+    """
+    global ENABLED
+    with _hooks_lock:
+        _hooks.append(hook)
+        ENABLED = True
+
+
+def remove_hook(hook):
+    u"""
+    Unregister a hook; tracing stops with the last hook.
+
+    :param Hook hook: hook to remove
+    :raises ValueError: if the hook is not registered
+    """
+    global ENABLED
+    with _hooks_lock:
+        _hooks.remove(hook)
+        ENABLED = bool(_hooks)
+
+
+def _notify(method, span):
+    for hook in list(_hooks):
+        try:
+            getattr(hook, method)(span)
+        except Exception, ex:
+            _LOGGER.warning(u"Tracing hook %s failed: %s", hook, ex)
+
+
+def current_span():
+    u"""
+    Return the innermost running span of this thread.
+
+    :rtype: Span
+    """
+    stack = getattr(_local, u"stack", None)
+    return stack[-1] if stack else None
+
+
+class span(object):
+    u"""
+    Context manager running its block as a span.
+
+        with tracing.span(u"refresh", host=device.ip_address):
+            ...
+    """
+
+    def __init__(self, name, kind=OPERATION, **attributes):
+        self.span = Span(name, kind, attributes=attributes)
+
+    def __enter__(self):
+        stack = getattr(_local, u"stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        if stack:
+            self.span.parent = stack[-1]
+            stack[-1].children.append(self.span)
+        stack.append(self.span)
+        _notify(u"span_started", self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.span.end = time.time()
+        if exc_type is not None:
+            self.span.error = u"%s: %s" % (exc_type.__name__, exc_val)
+        _local.stack.pop()
+        _notify(u"span_finished", self.span)
+
+
+class resume(object):
+    u"""
+    Context manager continuing a running span in another thread, so that
+    the spans and annotations made by its block end up in that span. The
+    span is not started or finished again.
+
+        parent = tracing.current_span()
+
+        def work():
+            with tracing.resume(parent):
+                ...
+    """
+
+    def __init__(self, parent):
+        self.parent = parent
+
+    def __enter__(self):
+        if self.parent is None:
+            return None
+        stack = getattr(_local, u"stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self.parent)
+        return self.parent
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.parent is not None:
+            _local.stack.pop()
+
+
+def request_name(request):
+    u"""
+    Name of a round trip span for a request, e.g. "system.get_sysinfo".
+
+    :param dict request: request sent to the device
+    :rtype: str
+    """
+    return u"+".join(u"%s.%s" % (target, cmd)
+                     for target in sorted(request)
+                     for cmd in sorted(request[target] or {}))
+
+
+def _operation(name, func):
+    @functools.wraps(func)
+    def traced_operation(self, *args, **kwargs):
+        if not ENABLED:
+            return func(self, *args, **kwargs)
+        with span(u"%s.%s" % (type(self).__name__, name),
+                  host=self.ip_address):
+            return func(self, *args, **kwargs)
+    return traced_operation
+
+
+def traced(cls):
+    u"""
+    Class decorator opening an operation span for every public method and
+    property, and for __repr__, defined by the class.
+    """
+    for name, value in list(vars(cls).items()):
+        if name.startswith(u"_") and name != u"__repr__":
+            continue
+        if isinstance(value, property):
+            setattr(cls, name, property(
+                _operation(name, value.fget) if value.fget else None,
+                _operation(name + u" (set)", value.fset)
+                if value.fset else None,
+                value.fdel,
+                value.__doc__))
+        elif callable(value) and not isinstance(value, type):
+            setattr(cls, name, _operation(name, value))
+    return cls
+
+
+class SpanCollector(Hook):
+    u"""
+    Hook keeping the most recently finished top-level spans.
+    """
+
+    def __init__(self, max_spans=1000):
+        self.spans = deque(maxlen=max_spans)
+
+    def span_finished(self, span):
+        if span.parent is None:
+            self.spans.append(span)
+
+
+class SlowQueryLog(Hook):
+    u"""
+    Hook recording round trips and top-level operations slower than a
+    threshold, and logging them as warnings.
+
+    Entries are dicts with the span name, kind, host, start and duration.
+    Round trips also have the request, the request and response sizes and
+    the phase timings when known; operations have the number of round
+    trips they made.
+    """
+    DEFAULT_THRESHOLD = 1.0
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, max_entries=1000,
+                 logger=_LOGGER):
+        u"""
+        :param float threshold: seconds above which a span is recorded
+        :param int max_entries: number of entries kept
+        :param logger: logger to log entries to, None to only keep them
+        """
+        self.threshold = threshold
+        self.entries = deque(maxlen=max_entries)
+        self.logger = logger
+
+    def span_finished(self, span):
+        if span.duration < self.threshold:
+            return
+        if span.kind != ROUND_TRIP and span.parent is not None:
+            return
+        entry = {
+            u"name": span.name,
+            u"kind": span.kind,
+            u"host": span.attributes.get(u"host"),
+            u"start": span.start,
+            u"duration": span.duration,
+            u"error": span.error,
+        }
+        if span.kind == ROUND_TRIP:
+            for key in (u"request", u"request_bytes", u"response_bytes",
+                        u"phases"):
+                if key in span.attributes:
+                    entry[key] = span.attributes[key]
+        else:
+            entry[u"round_trips"] = span.round_trips()
+        self.entries.append(entry)
+        if self.logger is not None:
+            self.logger.warning(u"Slow %s %s on %s: %.3f s %s", span.kind,
+                                span.name, entry[u"host"], span.duration,
+                                dict((key, value) for key, value
+                                     in entry.items()
+                                     if key not in (u"name", u"kind",
+                                                    u"host", u"start",
+                                                    u"duration")))